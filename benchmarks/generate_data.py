@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""
+ベンチマーク用の疑似データを作成します。
+tweet_data_save.py, followers_data_save.py が保存する形式と、ダッシュボード(load_data～load_data4)が読み込む形式で書き出します。
+・tweets.csv / followers.csv: 以前の1ファイル形式（csv）
+・tweets/ / followers/: セグメントとマニフェスト（segment_log.py）
+・rollups/: ロールアップ（rollups.py）
+・rollups/keyword_*: プロフィール欄の頻出ワード（keyword_rank.py、正規表現で分かち書き）
+・follower_snapshots/: フォロワーごとの履歴（follower_snapshots.py、最後の SNAPSHOT_SAVES 回の収集の分）
+・month.csv / analytics.csv: Twitterアナリティクスのcsv
+
+使い方: python benchmarks/generate_data.py --rows 100000 --out /tmp/bench_data
+"""
+
+# 必要なモジュールのインポート
+import argparse
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'twitter_data_analysis'))
+
+from data_format import TWEETS_SCHEMA, FOLLOWERS_SCHEMA
+from segment_log import SegmentWriter
+import rollups
+import keyword_rank
+import follower_snapshots
+
+
+# 1回の収集で保存される行数の目安（この行数ごとに1つのセグメントにする）
+ROWS_PER_SEGMENT = 50000
+
+# データの開始日時・期間と収集の間隔
+START_TIME = pd.Timestamp('2017-04-01')
+DATA_SPAN = pd.Timedelta(days=365 * 4)
+SAVE_INTERVAL = pd.Timedelta(hours=12)
+
+# フォロワーごとの履歴を作る収集の回数と、1回の収集で値が変わるフォロワーの割合
+SNAPSHOT_SAVES = 60
+SNAPSHOT_CHANGE_RATE = 0.05
+
+# テキスト用の単語
+WORDS = np.array(['Python', 'データ分析', 'Twitter', '機械学習', 'streamlit', 'GCP', 'pandas', 'グラフ',
+                  'エンジニア', '勉強中', '統計', 'プログラミング', 'AI', 'Web', 'デザイン', '投資'])
+LOCATIONS = np.array(['東京', '大阪', '福岡', '札幌', 'Japan', '', '名古屋', '横浜'])
+
+
+# 単語を並べたテキストをn件
+def random_texts(rng, n, words=8):
+    picks = WORDS[rng.integers(0, len(WORDS), size=(n, words))]
+    return pd.Series([' '.join(row) for row in picks])
+
+
+# total行を START_TIME から DATA_SPAN の間に等間隔で並べた時の、index行目の日時
+def spread_times(index, total):
+    return (START_TIME + pd.to_timedelta(DATA_SPAN.value * (index / max(total, 1)), unit='ns')).floor('S')
+
+
+# ツイートデータ（TWEETS_SCHEMAの列）の start 行目から n 行
+def make_tweets(rng, start, n, total):
+    index = np.arange(start, start + n)
+    created_at = spread_times(index, total)
+    save_time = created_at.floor('12H') + SAVE_INTERVAL
+    texts = random_texts(rng, n)
+    return pd.DataFrame({
+        'save_time': save_time,
+        'followers': 1000 + index // 10,
+        'tweet_id': 800000000000000000 + index * 1000,
+        'created_at': created_at,
+        'tweet_text': texts,
+        'characters': texts.str.len().astype('int32'),
+        'favorited': rng.poisson(5, n) + (rng.random(n) < 0.001) * rng.integers(100, 10000, n),
+        'retweeted': rng.poisson(1, n),
+    })
+
+
+# フォロワーデータ（FOLLOWERS_SCHEMAの列）の start 行目から n 行
+def make_followers(rng, start, n, total):
+    index = np.arange(start, start + n)
+    save_time = spread_times(index, total).floor('12H')
+    return pd.DataFrame({
+        'save_time': save_time,
+        'user_id': 100000000 + index * 7,
+        'screen_name': ['user{}'.format(i) for i in index],
+        'folowers_count': rng.lognormal(5, 1.5, n).astype('int64'),
+        'friends_count': rng.lognormal(5, 1, n).astype('int64'),
+        'user_name': ['ユーザー{}'.format(i) for i in index],
+        'location': LOCATIONS[rng.integers(0, len(LOCATIONS), n)],
+        'user_url': ['https://example.com/{}'.format(i) for i in index],
+        'description': random_texts(rng, n, words=12),
+    })
+
+
+# チャンクごとにcsv（以前の1ファイル形式）とセグメントに書き出す
+def write_dataset(out_dir, name, schema, make, rows, rng):
+    csv_path = os.path.join(out_dir, name + '.csv')
+    log_dir = os.path.join(out_dir, name)
+    if os.path.exists(csv_path):
+        os.remove(csv_path)
+    shutil.rmtree(log_dir, ignore_errors=True)
+    for start in range(0, rows, ROWS_PER_SEGMENT):
+        df = make(rng, start, min(ROWS_PER_SEGMENT, rows - start), rows)
+        df.to_csv(csv_path, mode='a', index=False, header=start == 0)
+        with SegmentWriter(log_dir, schema) as writer:
+            writer.write(df)
+        yield df
+
+
+# Twitterアナリティクスの月ごとデータ
+def make_month(rng, months=54):
+    dates = pd.date_range('2017-04-01', periods=months, freq='MS')
+    return pd.DataFrame({
+        '日時': dates,
+        'フォロワー数': np.cumsum(rng.integers(50, 300, months)),
+        'インプレッション数': rng.integers(50000, 900000, months),
+        'ツイート数': rng.integers(30, 200, months),
+        'プロフィールアクセス': rng.integers(500, 5000, months),
+    })
+
+
+# Twitterアナリティクスのツイートごとデータ（index付きで保存されたcsvと同じ列）
+def make_analytics(rng, n):
+    times = pd.Timestamp('2020-10-01') + pd.to_timedelta(np.sort(rng.integers(0, 365 * 24 * 3600, n)), unit='s')
+    impressions = rng.lognormal(8, 1, n).astype('int64')
+    return pd.DataFrame({
+        '時間': times,
+        '時刻': times.hour,
+        'ツイート本文': random_texts(rng, n),
+        'インプレッション': impressions,
+        'エンゲージメント': (impressions * rng.uniform(0.01, 0.05, n)).astype('int64'),
+        'ユーザープロフィールクリック': rng.poisson(3, n),
+    })
+
+
+# プロフィール欄の頻出ワード（フォロワーごとの最新のプロフィールから作る）
+def make_keywords(rollup_dir, followers):
+    state, _ = keyword_rank.update(keyword_rank.empty_state(), followers, [], keyword_rank.regex_tokenize)
+    keyword_rank.write_state(rollup_dir, 'regex', state)
+
+
+# フォロワーごとの履歴（データの最後までの SNAPSHOT_SAVES 回の収集で、毎回一部のフォロワーのフォロワー数が変わる）
+def make_snapshots(snapshot_dir, follower_metrics, rng, saves=SNAPSHOT_SAVES):
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    current = follower_metrics[follower_snapshots.STATE_SCHEMA.names].copy()
+    end = START_TIME + DATA_SPAN
+    for i in range(saves):
+        changed = rng.random(len(current)) < SNAPSHOT_CHANGE_RATE
+        current.loc[changed, 'folowers_count'] += rng.integers(-3, 10, changed.sum())
+        follower_snapshots.record(snapshot_dir, current, end - SAVE_INTERVAL * (saves - 1 - i))
+
+
+# すべてのデータを作成
+def generate(out_dir, rows, follower_rows=None, analytics_rows=None, seed=0):
+    rng = np.random.default_rng(seed)
+    follower_rows = follower_rows or rows
+    analytics_rows = analytics_rows or min(rows, 100000)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # ツイートとロールアップ（収集と同じく、チャンクごとにロールアップを更新）
+    follower_counts = []
+    tweet_metrics = rollups.empty_rollup(rollups.TWEET_METRICS)
+    hourly_engagement = rollups.empty_rollup(rollups.HOURLY_ENGAGEMENT)
+    for df in write_dataset(out_dir, 'tweets', TWEETS_SCHEMA, make_tweets, rows, rng):
+        tweet_metrics, hourly_engagement = rollups.update_tweet_metrics(tweet_metrics, hourly_engagement, df)
+        follower_counts.append(df.groupby('save_time')['followers'].last().reset_index())
+    follower_metrics = rollups.empty_rollup(rollups.FOLLOWER_METRICS)
+    profiles = []
+    for df in write_dataset(out_dir, 'followers', FOLLOWERS_SCHEMA, make_followers, follower_rows, rng):
+        follower_metrics = rollups.update_follower_metrics(follower_metrics, df)
+        profiles.append(df[['user_id', 'description']])
+    rollup_dir = os.path.join(out_dir, 'rollups')
+    follower_counts = pd.concat(follower_counts, ignore_index=True).drop_duplicates('save_time', keep='last')
+    rollups.write_rollup(rollup_dir, rollups.FOLLOWER_COUNTS, follower_counts)
+    rollups.write_rollup(rollup_dir, rollups.TWEET_METRICS, tweet_metrics)
+    rollups.write_rollup(rollup_dir, rollups.HOURLY_ENGAGEMENT, hourly_engagement)
+    rollups.write_rollup(rollup_dir, rollups.FOLLOWER_METRICS, follower_metrics)
+    make_keywords(rollup_dir, pd.concat(profiles, ignore_index=True))
+    make_snapshots(os.path.join(out_dir, 'follower_snapshots'), follower_metrics, rng)
+
+    # アナリティクスのcsv
+    make_month(rng).to_csv(os.path.join(out_dir, 'month.csv'), index=False)
+    make_analytics(rng, analytics_rows).to_csv(os.path.join(out_dir, 'analytics.csv'))
+    print('[{}に疑似データを作成しました ツイート: {}行 フォロワー: {}行]'.format(out_dir, rows, follower_rows))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ベンチマーク用の疑似データを作成')
+    parser.add_argument('--rows', type=int, default=100000, help='ツイートの行数 (10000～10000000)')
+    parser.add_argument('--follower-rows', type=int, default=None, help='フォロワーの行数（省略時はツイートと同じ）')
+    parser.add_argument('--analytics-rows', type=int, default=None, help='アナリティクスの行数（省略時は最大100000）')
+    parser.add_argument('--out', default='/tmp/bench_data', help='出力先のフォルダ')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.out, args.rows, args.follower_rows, args.analytics_rows, args.seed)
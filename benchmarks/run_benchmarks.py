@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+"""
+収集スクリプトとダッシュボードで時間のかかる処理の、実行時間とメモリ使用量を計測します。
+generate_data.py で作成した疑似データを使い、結果をJSONで書き出します（コミットごとに比較できるよう、コミットのハッシュも記録）。
+・followers: フォロワーIDの差分(in_id_index)、to_DataFrame、セグメントの保存、頻出ワードの更新
+・tweets: チャンクごとの文字数の計算、セグメント書き込みとロールアップの更新
+・load: load_data～load_data4、ロールアップの読み込み（ダッシュボードと同じ読み込み方）、追加されたセグメントだけの差分更新
+・groupby: ダッシュボードの集計（dashboard_views.py, rollups.py）
+・table: ページ送りの表（並び順の作成、1ページ分の取り出し）と、以前の表全体の並べ替え
+・snapshots: フォロワーごとの履歴の、期間の終わりの状態(state_as_of)と推移(follower_series)
+・figure: ビューごとのグラフ用データ・図の作成・HTMLへの変換
+
+使い方: python benchmarks/run_benchmarks.py --data /tmp/bench_data --rows 100000 --output bench_results.json
+"""
+
+# 必要なモジュールのインポート
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'twitter_data_analysis'))
+sys.path.insert(0, BENCH_DIR)
+
+from data_format import TWEETS_SCHEMA, FOLLOWERS_SCHEMA, TEXT_DTYPE, MONTH_CSV, ANALYTICS_CSV, csv_file, compact_frame, \
+    append_compact, read_csv_typed
+from segment_log import read_log, read_manifest, SegmentWriter, append_segment, LogTail
+import rollups
+import follower_snapshots
+import text_metrics
+import keyword_rank
+import dashboard_views
+from dashboard_views import frames_memory
+import generate_data
+
+
+# followers_idsの1ページの件数
+FOLLOWER_ID_PAGE_SIZE = 5000
+
+# ダッシュボードの期間の初期値(日)（twitter_analysis_streamlit.pyと同じ）
+DEFAULT_WINDOW_DAYS = 30
+
+
+# 処理を計測して結果の辞書を返す
+# 時間はrepeat回のうち最短、メモリ(tracemallocのピーク)は別に1回実行して計測
+def measure(name, func, rows=None, repeat=1):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'name': name, 'rows': rows, 'seconds': min(times), 'peak_mb': peak / 1024 / 1024}
+    print('{:<48} {:>10} rows {:>9.4f} s {:>9.1f} MB'.format(name, rows if rows is not None else '-',
+                                                            result['seconds'], result['peak_mb']))
+    return result
+
+
+# 計測できなかった処理の結果
+def skipped(name, reason):
+    print('{:<48} skipped ({})'.format(name, reason))
+    return {'name': name, 'skipped': reason}
+
+
+# ---- followers_data_save.py ----
+
+def bench_followers(data_dir, repeat):
+    try:
+        import followers_data_save as fds
+    except ImportError as e:  # tweepy, google-cloud-storage が無い環境
+        return [skipped('followers.*', str(e))]
+    results = []
+    user_ids = read_log(os.path.join(data_dir, 'followers'), FOLLOWERS_SCHEMA, columns=['user_id'])['user_id']
+    id_index = np.unique(user_ids.to_numpy(dtype='int64'))
+    # 既存のフォロワーに1割の新しいフォロワーを混ぜたページ
+    rng = np.random.default_rng(0)
+    current = np.concatenate([id_index, id_index.max() + 1 + np.arange(len(id_index) // 10)])
+    rng.shuffle(current)
+    pages = [current[i:i + FOLLOWER_ID_PAGE_SIZE] for i in range(0, len(current), FOLLOWER_ID_PAGE_SIZE)]
+
+    def dedup():
+        for page in pages:
+            page[~fds.in_id_index(page, id_index)]
+    results.append(measure('followers.dedup', dedup, len(current), repeat))
+
+    df = generate_data.make_followers(rng, 0, len(id_index), len(id_index))
+    infos = df.values.tolist()
+
+    def to_dataframe():
+        fds.metric_infos = fds.users_frame(infos)
+        fds.user_infos = fds.metric_infos
+        fds.to_DataFrame()
+    results.append(measure('followers.to_DataFrame', to_dataframe, len(infos), repeat))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results.append(measure('followers.data_save',
+                               lambda: append_segment(tmp, df, FOLLOWERS_SCHEMA), len(df), repeat))
+
+    # 全フォロワーのうち1割のプロフィールが変わった回の頻出ワードの更新と、全員を分かち書きし直す場合
+    state = keyword_rank.read_state(os.path.join(data_dir, 'rollups'), 'regex')
+    profiles = read_log(os.path.join(data_dir, 'followers'), FOLLOWERS_SCHEMA, columns=['user_id', 'description'])
+    changed = rng.random(len(profiles)) < 0.1
+    profiles.loc[changed, 'description'] = profiles.loc[changed, 'description'] + ' 新しいワード'
+    results.append(measure('followers.keyword_update',
+                           lambda: keyword_rank.update(state, profiles, [], keyword_rank.regex_tokenize),
+                           len(profiles), repeat))
+    results.append(measure('followers.keyword_full_rebuild',
+                           lambda: keyword_rank.update(keyword_rank.empty_state(), profiles, [], keyword_rank.regex_tokenize),
+                           len(profiles), repeat))
+    return results
+
+
+# ---- tweet_data_save.py ----
+
+def bench_tweets(data_dir, repeat):
+    df = read_log(os.path.join(data_dir, 'tweets'), TWEETS_SCHEMA)
+    chunk_size = 1000  # tweet_data_save.CHUNK_SIZE
+    results = []
+
+    def write_chunks():
+        with tempfile.TemporaryDirectory() as tmp:
+            with SegmentWriter(tmp, TWEETS_SCHEMA) as writer:
+                for start in range(0, len(df), chunk_size):
+                    writer.write(df.iloc[start:start + chunk_size])
+    results.append(measure('tweets.segment_write_chunks', write_chunks, len(df), repeat))
+
+    def chunk_text_metrics():
+        for start in range(0, len(df), chunk_size):
+            text_metrics.add_text_metrics(df.iloc[start:start + chunk_size])
+    results.append(measure('tweets.text_metrics', chunk_text_metrics, len(df), repeat))
+
+    tweet_metrics = rollups.read_rollup(os.path.join(data_dir, 'rollups'), rollups.TWEET_METRICS)
+    hourly = rollups.read_rollup(os.path.join(data_dir, 'rollups'), rollups.HOURLY_ENGAGEMENT)
+    batch = df.tail(chunk_size)
+    results.append(measure('tweets.update_tweet_metrics',
+                           lambda: rollups.update_tweet_metrics(tweet_metrics, hourly, batch), len(tweet_metrics), repeat))
+    results.append(measure('tweets.build_tweet_rollups', lambda: rollups.build_tweet_rollups(df), len(df), repeat))
+    return results
+
+
+# ---- twitter_analysis_streamlit.py の読み込み ----
+
+def load_log(log_dir, schema, time_range=None):
+    return compact_frame(read_log(log_dir, schema, time_range=time_range, text_dtype=TEXT_DTYPE))
+
+
+def load_month(path):
+    return read_csv_typed(path, MONTH_CSV).set_index('日時')
+
+
+def load_analytics(path):
+    return read_csv_typed(path, ANALYTICS_CSV)
+
+
+def load_rollups(data_dir):
+    return {name: compact_frame(rollups.read_rollup(os.path.join(data_dir, 'rollups'), name)) for name in rollups.SCHEMAS}
+
+
+# フォロワーごとの履歴を表示する期間（ダッシュボードの初期値と同じく、データの最後までの DEFAULT_WINDOW_DAYS 日）
+def snapshot_window():
+    end = generate_data.START_TIME + generate_data.DATA_SPAN
+    return end - pd.Timedelta(days=DEFAULT_WINDOW_DAYS), end
+
+
+# ダッシュボード(load_all)と同じく、すべての表を並行して読み込む
+def load_frames(data_dir, time_range=None):
+    calls = {
+        'tweets': lambda: load_log(os.path.join(data_dir, 'tweets'), TWEETS_SCHEMA, time_range),
+        'followers': lambda: load_log(os.path.join(data_dir, 'followers'), FOLLOWERS_SCHEMA, time_range),
+        'month': lambda: load_month(os.path.join(data_dir, 'month.csv')),
+        'analytics': lambda: load_analytics(os.path.join(data_dir, 'analytics.csv')),
+        'rollups': lambda: load_rollups(data_dir),
+        'snapshots': lambda: dashboard_views.snapshot_frames(os.path.join(data_dir, 'follower_snapshots'), snapshot_window()),
+    }
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = {name: executor.submit(call) for name, call in calls.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+# 以前の読み込み方（型を指定せずに1つずつ読む、比較用）
+def load_frames_untyped(data_dir):
+    month = pd.read_csv(os.path.join(data_dir, 'month.csv'))
+    month['日時'] = pd.to_datetime(month['日時'])
+    analytics = pd.read_csv(os.path.join(data_dir, 'analytics.csv'))
+    analytics['時間'] = pd.to_datetime(analytics['時間'])
+    return {
+        'tweets': read_log(os.path.join(data_dir, 'tweets'), TWEETS_SCHEMA),
+        'followers': read_log(os.path.join(data_dir, 'followers'), FOLLOWERS_SCHEMA),
+        'month': month.set_index('日時'),
+        'analytics': analytics,
+        'rollups': {name: rollups.read_rollup(os.path.join(data_dir, 'rollups'), name) for name in rollups.SCHEMAS},
+    }
+
+
+# ダッシュボードの差分更新（最後のセグメントの前まで読み込んだ状態から、最後のセグメントだけを読んで追加する）
+# (計測する関数, 追加する行数) を返す
+def log_tail_refresh(log_dir, schema):
+    manifest = read_manifest(log_dir)
+    tail = LogTail(log_dir, schema, text_dtype=TEXT_DTYPE, append=append_compact)
+    tail.update(dict(manifest, segments=manifest['segments'][:-1]))
+    frame, watermark = tail.frame, tail.watermark
+
+    def refresh():
+        tail.frame, tail.watermark = frame, watermark
+        tail.update(manifest)
+    return refresh, manifest['segments'][-1]['rows']
+
+
+def bench_load(data_dir, repeat, frames):
+    tweets_dir = os.path.join(data_dir, 'tweets')
+    followers_dir = os.path.join(data_dir, 'followers')
+    last = frames['tweets']['created_at'].max()
+    window = (last - pd.Timedelta(days=DEFAULT_WINDOW_DAYS), last)
+    tweets_tail, tweets_tail_rows = log_tail_refresh(tweets_dir, TWEETS_SCHEMA)
+    followers_tail, followers_tail_rows = log_tail_refresh(followers_dir, FOLLOWERS_SCHEMA)
+    return [
+        measure('load.load_all', lambda: load_frames(data_dir), None, repeat),
+        measure('load.load_all.untyped_sequential', lambda: load_frames_untyped(data_dir), None, repeat),
+        measure('load.load_data', lambda: load_log(tweets_dir, TWEETS_SCHEMA), len(frames['tweets']), repeat),
+        measure('load.load_data.window', lambda: load_log(tweets_dir, TWEETS_SCHEMA, window), len(frames['tweets']), repeat),
+        measure('load.load_data.legacy_csv', lambda: pd.read_csv(os.path.join(data_dir, 'tweets.csv')),
+                len(frames['tweets']), repeat),
+        measure('load.load_data.tail', tweets_tail, tweets_tail_rows, repeat),
+        measure('load.load_data2', lambda: load_log(followers_dir, FOLLOWERS_SCHEMA), len(frames['followers']), repeat),
+        measure('load.load_data2.tail', followers_tail, followers_tail_rows, repeat),
+        measure('load.load_data2.window', lambda: load_log(followers_dir, FOLLOWERS_SCHEMA, window),
+                len(frames['followers']), repeat),
+        measure('load.load_data3', lambda: load_month(os.path.join(data_dir, 'month.csv')), len(frames['month']), repeat),
+        measure('load.load_data4', lambda: load_analytics(os.path.join(data_dir, 'analytics.csv')),
+                len(frames['analytics']), repeat),
+        measure('load.load_rollups', lambda: load_rollups(data_dir), None, repeat),
+    ]
+
+
+# ---- ダッシュボードの集計 ----
+
+def bench_groupby(repeat, frames):
+    tweet_rows = len(frames['rollups'][rollups.TWEET_METRICS])
+    analytics_rows = len(frames['analytics'])
+    return [
+        measure('groupby.followers_by_save_time', lambda: dashboard_views.followers_by_save_time(frames),
+                len(frames['rollups'][rollups.FOLLOWER_COUNTS]), repeat),
+        measure('groupby.metrics_by_created_at', lambda: dashboard_views.metrics_by_created_at(frames), tweet_rows, repeat),
+        measure('groupby.hourly_means', lambda: rollups.hourly_means(frames['rollups'][rollups.HOURLY_ENGAGEMENT]),
+                24, repeat),
+        measure('groupby.analytics_time_index', lambda: dashboard_views.analytics_time_index(frames), analytics_rows, repeat),
+        measure('groupby.analytics_hourly', lambda: dashboard_views.analytics_hourly(frames), analytics_rows, repeat),
+        measure('groupby.wordrank_table', lambda: dashboard_views.wordrank_table(frames),
+                len(frames['rollups'][rollups.KEYWORD_COUNTS]), repeat),
+        measure('export.csv_file.tweets', lambda: csv_file(frames['tweets']).close(), len(frames['tweets']), repeat),
+    ]
+
+
+# ---- ページ送りの表 ----
+
+def bench_tables(repeat, frames):
+    tweets = frames['tweets']
+    followers = frames['followers']
+    tweets_index = dashboard_views.TableIndex(tweets)
+    followers_index = dashboard_views.TableIndex(followers)
+    page_size = dashboard_views.PAGE_SIZES[1]
+
+    def tweets_page():
+        rows = tweets_index.rows(dashboard_views.INDEX_COLUMN, False)
+        return tweets_index.page(rows, 1, page_size)
+
+    def followers_filter_page():
+        rows = followers_index.rows('folowers_count', False, 'description', 'a')
+        return followers_index.page(rows, 2, page_size)
+
+    return [
+        # 以前の表示（表全体を並べ替えてから渡す）
+        measure('table.sort_index.tweets', lambda: tweets.sort_index(ascending=False), len(tweets), repeat),
+        measure('table.order.followers.description',
+                lambda: dashboard_views.TableIndex(followers).order('description'), len(followers), repeat),
+        measure('table.page.tweets', tweets_page, page_size, repeat),
+        measure('table.filter_page.followers', followers_filter_page, page_size, repeat),
+    ]
+
+
+# ---- フォロワーごとの履歴 ----
+
+def bench_snapshots(data_dir, repeat, frames):
+    snapshot_dir = os.path.join(data_dir, 'follower_snapshots')
+    start, end = snapshot_window()
+    as_of = frames['snapshots']['as_of']
+    top_ids = as_of.nlargest(dashboard_views.HISTORY_TOP_K, 'folowers_count')['user_id']
+    return [
+        measure('snapshots.history_segments', lambda: follower_snapshots.history_segments(snapshot_dir, start, end),
+                None, repeat),
+        measure('snapshots.state_as_of', lambda: follower_snapshots.state_as_of(snapshot_dir, end), len(as_of), repeat),
+        measure('snapshots.follower_series.top', lambda: follower_snapshots.follower_series(snapshot_dir, top_ids, (start, end)),
+                len(top_ids), repeat),
+        measure('snapshots.follower_series.all', lambda: follower_snapshots.follower_series(snapshot_dir, None, (start, end)),
+                len(as_of), repeat),
+    ]
+
+
+# ---- ビューごとの図の作成 ----
+
+def bench_figures(repeat, frames):
+    results = []
+    for label, view in dashboard_views.VIEWS.items():
+        data = view.prepare(frames)
+        rows = len(next(iter(data.values())))
+        results.append(measure('figure.prepare.' + view.file_name, lambda: view.prepare(frames), rows, repeat))
+        build = (lambda: view.build(data, None)) if view.ranged else (lambda: view.build(data))
+        results.append(measure('figure.build.' + view.file_name, build, rows, repeat))
+        fig = build()
+        results.append(measure('figure.render_html.' + view.file_name,
+                               lambda: dashboard_views.render_html(view, fig), rows, repeat))
+    return results
+
+
+# 現在のコミットのハッシュ（gitが無い場合はNone）
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(data_dir, repeat, groups):
+    frames = load_frames(data_dir)
+    results = []
+    if 'followers' in groups:
+        results += bench_followers(data_dir, repeat)
+    if 'tweets' in groups:
+        results += bench_tweets(data_dir, repeat)
+    if 'load' in groups:
+        results += bench_load(data_dir, repeat, frames)
+    if 'groupby' in groups:
+        results += bench_groupby(repeat, frames)
+    if 'table' in groups:
+        results += bench_tables(repeat, frames)
+    if 'snapshots' in groups:
+        results += bench_snapshots(data_dir, repeat, frames)
+    if 'figure' in groups:
+        results += bench_figures(repeat, frames)
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pandas': pd.__version__,
+        'data': {'dir': data_dir, 'tweets_rows': len(frames['tweets']), 'followers_rows': len(frames['followers']),
+                 'analytics_rows': len(frames['analytics'])},
+        'memory_mb': {name: round(mb, 3) for name, _, mb in frames_memory(frames)},
+        'memory_mb_untyped': {name: round(mb, 3) for name, _, mb in frames_memory(load_frames_untyped(data_dir))},
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+GROUPS = ('followers', 'tweets', 'load', 'groupby', 'table', 'snapshots', 'figure')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='収集スクリプトとダッシュボードの処理を計測')
+    parser.add_argument('--data', default='/tmp/bench_data', help='疑似データのフォルダ（無い場合は作成）')
+    parser.add_argument('--rows', type=int, default=100000, help='疑似データを作成する場合のツイート・フォロワーの行数')
+    parser.add_argument('--generate', action='store_true', help='疑似データがあっても作り直す')
+    parser.add_argument('--repeat', type=int, default=3, help='時間を計測する回数（最短の時間を記録）')
+    parser.add_argument('--groups', default=','.join(GROUPS), help='計測する処理 ({})'.format(','.join(GROUPS)))
+    parser.add_argument('--output', default='bench_results.json', help='結果のJSONファイル')
+    args = parser.parse_args()
+    if args.generate or not os.path.isdir(os.path.join(args.data, 'tweets')):
+        generate_data.generate(args.data, args.rows)
+    report = run(args.data, args.repeat, set(args.groups.split(',')))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print('[結果を{}に保存しました]'.format(args.output))
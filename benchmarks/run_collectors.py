@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+収集スクリプト(tweet_data_save.py, followers_data_save.py)を疑似API(fake_twitter.py)とローカルの保存先で実行し、
+段階ごとの時間・リクエスト回数と、取得の速さ(件/秒)を計測します。
+作業用のフォルダ(/tmp/...)と保存先は一時フォルダに置き換えるので、Storageや本物のAPIには接続しません。
+--runs を2以上にすると、2回目以降は件数を --growth ずつ増やして、差分だけを取得する通常の実行を計測します。
+
+使い方: python benchmarks/run_collectors.py --followers 20000 --tweets 3200 --time-scale 0.01 --output collectors.json
+"""
+
+# 必要なモジュールのインポート
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'twitter_data_analysis'))
+
+import tweet_data_save
+import followers_data_save
+from multi_account import redirect_paths, run_collector, fetch_span
+from run_benchmarks import git_commit
+
+
+# 1回分の実行（収集スクリプトのmainを呼び、トレーサーの記録を返す）
+def run_once(module, spec, time_scale, storage_dir, work_dir):
+    redirect_paths(module, work_dir)
+    module.FAKE_API = spec
+    module.FAKE_TIME_SCALE = time_scale
+    module.STORAGE_URL = storage_dir
+    result = run_collector(module)
+    result['api'] = module.api.stats()
+    return result
+
+
+def spec_for(followers, tweets, seed):
+    return 'synthetic:followers={},tweets={},seed={}'.format(followers, tweets, seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='疑似APIで収集スクリプトを計測')
+    parser.add_argument('--followers', type=int, default=20000, help='疑似アカウントのフォロワー数')
+    parser.add_argument('--tweets', type=int, default=3200, help='疑似アカウントのツイート数')
+    parser.add_argument('--growth', type=int, default=100, help='2回目以降に増やすフォロワー・ツイートの数')
+    parser.add_argument('--runs', type=int, default=2, help='実行回数（2回目以降は差分の取得）')
+    parser.add_argument('--time-scale', type=float, default=0.01, help='遅延とレート制限の時間枠の倍率')
+    parser.add_argument('--fixture', default=None, help='疑似アカウントの代わりに再生する、記録したレスポンスのファイル')
+    parser.add_argument('--jobs', default='tweets,followers', help='計測する収集スクリプト (tweets,followers)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='collectors_results.json', help='結果のJSONファイル')
+    args = parser.parse_args()
+
+    modules = {'tweets': tweet_data_save, 'followers': followers_data_save}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_dir = os.path.join(tmp, 'storage')
+        os.makedirs(storage_dir)
+        for job in args.jobs.split(','):
+            for run in range(args.runs):
+                followers = args.followers + run * args.growth
+                tweets = args.tweets + run * args.growth
+                spec = args.fixture or spec_for(followers, tweets, args.seed)
+                # 実行ごとに作業用のフォルダを新しくする（Cloud Functionsと同じく、前回のファイルは保存先からダウンロード）
+                work_dir = tempfile.mkdtemp(dir=tmp)
+                result = run_once(modules[job], spec, args.time_scale, storage_dir, work_dir)
+                fetch = fetch_span(result['spans'])
+                result.update(job=job, run=run, spec=spec,
+                              fetched=fetch['rows'], fetch_seconds=fetch['seconds'],
+                              rows_per_second=fetch['rows'] / fetch['seconds'] if fetch['seconds'] else None)
+                results.append(result)
+                print('[{} run {}] {}件 {:.2f}秒 ({:.0f}件/秒)'.format(job, run, fetch['rows'], fetch['seconds'],
+                                                                     result['rows_per_second'] or 0))
+    report = {'commit': git_commit(), 'time_scale': args.time_scale, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1, default=str)
+    print('[結果を{}に保存しました]'.format(args.output))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Storageに保存したセグメント(segment_log.py)を、サイズ・経過時間の条件に合わせて大きなセグメントにまとめます。
+tweet_data_save.py, followers_data_save.pyとは別の[Cloud Functions]にデプロイして、[Cloud Scheduler]で収集と重ならない時刻に定期実行します。
+収集と重なった場合も、マニフェストはダウンロードした世代を条件に書き込むので、後から書いた方がマニフェストを読み直してやり直します
+（古いセグメントは、まとめたマニフェストを書き込めた後に削除します）。
+アカウントの一覧(accounts.json、multi_account.py)を同じフォルダに含めると、アカウントごとの保存先(STORAGE_URL/<アカウント名>/)をまとめます。
+"""
+
+# 必要なモジュールのインポート
+import os
+
+from data_format import TWEETS_SCHEMA, FOLLOWERS_SCHEMA, export_csv
+from follower_snapshots import SNAPSHOT_SCHEMA
+from segment_log import MANIFEST_NAME, MANIFEST_RETRIES, manifest_path, segment_path, read_manifest, plan_compaction, \
+    compact, read_log
+from object_store import ObjectNotFound, PreconditionFailed, open_store
+from multi_account import read_accounts
+
+
+# Storageのバケット名
+BUCKET_NAME = 'ストレージのバケット名を指定'
+
+# 保存先（ローカルのフォルダを指定すると、Storageを使わずに動かせます）
+STORAGE_URL = 'gs://' + BUCKET_NAME
+
+# 保存先を開く（クライアントは使い回し、変わっていないセグメントはダウンロードしない）
+def open_storage():
+    global store
+    store = open_store(STORAGE_URL, writable=True)
+    return store
+
+# まとめるデータ（Storageでの保存先: スキーマ）
+DATASETS = {
+    'tweets/': TWEETS_SCHEMA,
+    'followers/': FOLLOWERS_SCHEMA,
+    'follower_snapshots/keyframes/': SNAPSHOT_SCHEMA,
+    'follower_snapshots/deltas/': SNAPSHOT_SCHEMA,
+}
+
+# アカウントの一覧のファイル（multi_account.pyと同じ形式）。無い場合は保存先の直下のデータだけをまとめる
+ACCOUNTS_PATH = 'accounts.json'
+
+# 作業用のフォルダ
+WORK_DIR = '/tmp/compaction'
+
+# まとめた後に、全データのcsvも書き出してアップロードする場合はTrue
+EXPORT_CSV = False
+
+
+# まとめたセグメントを反映（新しいセグメント → マニフェスト → 古いセグメントの順、読み込み中の画面が壊れないように）
+# マニフェストはダウンロードした世代を条件に書き込み、その間に収集がマニフェストを書き換えていたらFalse
+# （書き込めなかった場合は、アップロードした新しいセグメントを削除し、古いセグメントは残す）
+def publish_compaction(prefix, log_dir, added, removed):
+    for name in added:
+        store.upload(segment_path(log_dir, name), prefix + name)
+    try:
+        store.upload(manifest_path(log_dir), prefix + MANIFEST_NAME, if_unchanged=True)
+    except PreconditionFailed:
+        store.download(prefix + MANIFEST_NAME, manifest_path(log_dir))
+        listed = {seg['name'] for seg in read_manifest(log_dir)['segments']}
+        for name in added:
+            if name not in listed:
+                store.delete(prefix + name)
+        return False
+    for name in removed:
+        store.delete(prefix + name)
+    return True
+
+
+# 1つのデータのセグメントをまとめる
+# 収集と重なってマニフェストを書き込めなかった場合は、マニフェストを読み直してMANIFEST_RETRIES回までやり直す
+def compact_dataset(prefix, schema):
+    log_dir = os.path.join(WORK_DIR, prefix.strip('/'))
+    os.makedirs(log_dir, exist_ok=True)
+    for _ in range(MANIFEST_RETRIES):
+        try:
+            store.download(prefix + MANIFEST_NAME, manifest_path(log_dir))
+        except ObjectNotFound:
+            print('[{}のマニフェストはまだありません]'.format(prefix))
+            return
+        manifest = read_manifest(log_dir)
+        groups = plan_compaction(manifest)
+        if not groups:
+            print('[{} まとめるセグメントはありません]'.format(prefix))
+            break
+        # まとめる対象のセグメントだけダウンロード
+        for group in groups:
+            for seg in group:
+                store.download(prefix + seg['name'], segment_path(log_dir, seg['name']))
+        added, removed = compact(log_dir, schema, groups, manifest)
+        if publish_compaction(prefix, log_dir, added, removed):
+            print('[{} {}個のセグメントを{}個にまとめました]'.format(prefix, len(removed), len(added)))
+            break
+        print('[{} 収集がマニフェストを書き換えたので、まとめ直します]'.format(prefix))
+    else:
+        print('[{} 収集と重なり続けたので、次の実行でまとめます]'.format(prefix))
+        return
+    if EXPORT_CSV:
+        for seg in manifest['segments']:
+            path = segment_path(log_dir, seg['name'])
+            if not os.path.isfile(path):
+                store.download(prefix + seg['name'], path)
+        csv_path = log_dir + '.csv'
+        export_csv(read_log(log_dir, schema, manifest=manifest), csv_path)
+        store.upload(csv_path, prefix.strip('/') + '.csv')
+        print('[{}のcsvを書き出しました]'.format(prefix))
+
+
+# まとめるアカウントの保存先（保存先の中の <アカウント名>/、アカウントの一覧が無い場合は保存先の直下だけ）
+def account_prefixes():
+    if ACCOUNTS_PATH is None or not os.path.isfile(ACCOUNTS_PATH):
+        return ['']
+    return [account['screen_name'] + '/' for account in read_accounts(ACCOUNTS_PATH)['accounts']]
+
+
+# main関数を実行(GCPのCloud Functions用にevent,contextが引数に)
+def main(event, context):
+    open_storage()
+    for account_prefix in account_prefixes():
+        for prefix, schema in DATASETS.items():
+            compact_dataset(account_prefix + prefix, schema)
@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+
+"""
+twitter_analysis_streamlit.py で表示する図表(ビュー)の一覧です。
+ビューごとに「グラフ用データの作成(prepare)」と「図の作成(build)」を分けて登録しておき、
+画面では選択されたビューだけを作成します（streamlitを使わないので、単体でも読み込めます）。
+"""
+
+# 必要なモジュールのインポート
+import collections
+import threading
+import numpy as np
+import pandas as pd
+from bokeh.embed import file_html
+from bokeh.resources import CDN
+from bokeh.plotting import figure, ColumnDataSource
+from bokeh.layouts import column
+from bokeh.models import RangeTool, HoverTool, DatetimeTickFormatter, Range1d
+
+from data_format import frame_bytes
+import rollups
+import downsample
+import follower_snapshots
+
+
+# ビュー（表示名、ダウンロード用のファイル名、データ作成、図の作成）
+# ranged=True のビューは、図の作成に詳細表示する期間 (開始, 終了) も渡す（Noneは全期間）
+class View:
+    def __init__(self, label, file_name, prepare, build, use_container_width=False, stats=None, ranged=False):
+        self.label = label
+        self.file_name = file_name
+        self.prepare = prepare
+        self.build = build
+        self.use_container_width = use_container_width
+        self.stats = stats
+        self.ranged = ranged
+
+
+# 表示名 -> ビュー（登録した順にラジオボタンに並ぶ）
+VIEWS = {}
+
+
+# ビューを登録するデコレーター（デコレートした関数が図の作成、prepareがデータ作成）
+def view(label, file_name, prepare, use_container_width=False, stats=None, ranged=False):
+    def register(build):
+        VIEWS[label] = View(label, file_name, prepare, build, use_container_width, stats, ranged)
+        return build
+    return register
+
+
+# 読み込んだデータのキー（revalidateが返す保存先のファイルの世代と、表示する期間）
+# 行数が変わらない書き換え(ロールアップの更新など)でもファイルの世代が変わるので、古いデータを使わない
+def data_key(generations, time_range):
+    return tuple(sorted(generations.items())) + (time_range,)
+
+
+# 読み込んだ表ごとの行数とメモリ使用量(MB)
+def frames_memory(frames, prefix=''):
+    rows = []
+    for name in sorted(frames):
+        frame = frames[name]
+        if isinstance(frame, dict):
+            rows.extend(frames_memory(frame, prefix + name + '/'))
+        else:
+            rows.append((prefix + name, len(frame), frame_bytes(frame) / 1024 / 1024))
+    return rows
+
+
+# 件数とサイズの上限を超えたら、いちばん長く使われていないものから捨てるキャッシュ
+# (複数のセッションから同時に使うのでロックする)
+class LRUCache:
+    def __init__(self, max_entries=32, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self.bytes > self.max_bytes and len(self._entries) > 1):
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# ---- ページ送りの表 ----
+
+# インデックスで並べ替える時の名前
+INDEX_COLUMN = '(インデックス)'
+
+# 1ページの行数の選択肢
+PAGE_SIZES = (50, 100, 500)
+
+# 絞り込みの結果を覚えておく数（表ごと）
+FILTER_CACHE_ENTRIES = 16
+
+
+# 表の列ごとの並び順と絞り込みの結果を覚えておき、選んだページの行だけを取り出す
+# 並び順は列ごとに最初に使った時だけ計算するので、ページ送りや並べ替えの切り替えでは表全体を並べ替えない
+# （データのバージョンごとに作り、全セッションで共通に使う）
+class TableIndex:
+    def __init__(self, table):
+        self.table = table
+        self._orders = {}
+        self._masks = LRUCache(max_entries=FILTER_CACHE_ENTRIES)
+        self._lock = threading.Lock()
+
+    # 絞り込みできる列（文字列とcategoryの列）
+    def text_columns(self):
+        return [name for name in self.table.columns
+                if isinstance(self.table[name].dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(self.table[name].dtype)
+                or self.table[name].dtype == object]
+
+    # 列の並び順（行の位置の配列、昇順・降順とも欠損値は最後）
+    def order(self, column, ascending=True):
+        with self._lock:
+            if (column, ascending) not in self._orders:
+                values = pd.Series(self.table.index) if column == INDEX_COLUMN else self.table[column].reset_index(drop=True)
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    # 追加した行のカテゴリーは後ろに付くので、カテゴリーを文字の順に並べ直してから並べ替える
+                    values = values.cat.reorder_categories(values.cat.categories.sort_values())
+                order = values.sort_values(kind='stable', na_position='last').index.to_numpy()
+                valid = int(values.notna().sum())
+                self._orders[(column, True)] = order
+                self._orders[(column, False)] = np.concatenate([order[:valid][::-1], order[valid:]])
+            return self._orders[(column, ascending)]
+
+    # 列に文字を含む行（大文字・小文字は区別しない）
+    def mask(self, column, text):
+        key = (column, text)
+        mask = self._masks.get(key)
+        if mask is None:
+            values = self.table[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # categoryはカテゴリーごとに1回だけ調べる
+                hit = np.asarray(values.cat.categories.astype(str).str.contains(text, case=False, regex=False), dtype=bool)
+                codes = values.cat.codes.to_numpy()
+                mask = (codes >= 0) & hit[codes]
+            else:
+                mask = values.astype(str).str.contains(text, case=False, regex=False).to_numpy(dtype=bool)
+            self._masks.put(key, mask)
+        return mask
+
+    # 並べ替え・絞り込みした行の位置の配列
+    def rows(self, sort_column=INDEX_COLUMN, ascending=True, filter_column=None, text=''):
+        order = self.order(sort_column, ascending)
+        if filter_column is not None and text:
+            order = order[self.mask(filter_column, text)[order]]
+        return order
+
+    # ページ(1から)の行だけの表
+    def page(self, rows, page, page_size):
+        start = (page - 1) * page_size
+        return self.table.iloc[rows[start:start + page_size]]
+
+
+# ページ数
+def page_count(rows, page_size):
+    return max(1, -(-len(rows) // page_size))
+
+
+# 図をHTMLに変換（ダウンロード用・表示用）
+def render_html(view, fig):
+    return file_html(fig, CDN, view.label).encode('utf-8')
+
+
+# 詳細表示する期間（x_rangeがNoneなら全期間、データが無い場合はNone）
+def detail_range(data, x_range):
+    if len(data['x']) == 0:
+        return None
+    if x_range is None:
+        return data['x'][0], data['x'][-1]
+    return x_range
+
+
+# データがまだ無い時に表示する空の図（収集前やアナリティクスのファイルが無い時）
+def empty_figure(title):
+    p = figure(tools="save", title=title + ' (データがありません)', plot_width=800, plot_height=400, x_axis_type='datetime')
+    p.line(x=[], y=[])
+    p.xgrid.grid_line_color = None
+    p.ygrid.grid_line_color = None
+    return p
+
+
+# 図全体の高さ(px)（column でまとめた図は合計）
+def figure_height(fig):
+    children = getattr(fig, 'children', None)
+    if children:
+        return sum(figure_height(child) for child in children)
+    return fig.plot_height
+
+
+# ---- 表とグラフで共通に使うデータ ----
+
+# 保存時間ごとのフォロワー数(ロールアップ)
+def followers_by_save_time(frames):
+    return frames['rollups'][rollups.FOLLOWER_COUNTS].set_index('save_time')
+
+
+# ツイート時間でグループ分け(ツイートごとの最新の値のロールアップ)
+def metrics_by_created_at(frames):
+    return frames['rollups'][rollups.TWEET_METRICS].groupby('created_at')[['favorited', 'retweeted']].mean()
+
+
+# 頻出ワードランキングに表示するワードの数
+WORDRANK_TOP_K = 100
+
+# 推移を表示するフォロワーの数（期間の終わりのフォロワー数の上位）
+HISTORY_TOP_K = 10
+
+
+# フォロワーごとの履歴(follower_snapshots.py)から、期間の終わりの状態と、上位のフォロワーの期間中の推移を作る
+# snapshot_dir には follower_snapshots.history_segments のセグメントがそろっていること
+def snapshot_frames(snapshot_dir, time_range, top_k=HISTORY_TOP_K):
+    as_of = follower_snapshots.state_as_of(snapshot_dir, time_range[1])
+    top_ids = as_of.nlargest(top_k, 'folowers_count')['user_id']
+    series = follower_snapshots.follower_series(snapshot_dir, top_ids, time_range)
+    return {'as_of': as_of, 'series': series}
+
+# フォロワー プロフィール欄の頻出ワードランキング（収集時に更新しているワードごとの人数の上位）
+def wordrank_table(frames):
+    return rollups.top_keywords(frames['rollups'][rollups.KEYWORD_COUNTS], WORDRANK_TOP_K)[['word', 'count']]
+
+
+# Twitterアナリティクスのツイートごとデータ（時間順）
+def analytics_time_index(frames):
+    time_index_df = frames['analytics'].sort_values(by='時間').set_index('時間')
+    return time_index_df.drop(columns='Unnamed: 0', errors='ignore')
+
+
+# Twitterアナリティクスのツイートデータ(ツイート時刻ごと)
+def analytics_time_df(frames):
+    return frames['analytics'][["時刻", "ツイート本文", "インプレッション", "エンゲージメント", "ユーザープロフィールクリック"]]
+
+
+# 外れ値を除いた時刻ごとの平均と件数 (df_mean, df_count)
+def analytics_hourly(frames):
+    time_df = analytics_time_df(frames)
+    # 1パーセンタイル、99パーセンタイルを指定
+    q_min = time_df['インプレッション'].quantile(0.01)
+    q_max = time_df['インプレッション'].quantile(0.99)
+    # 1パーセンタイル以下、99パーセンタイル以上の外れ値を除去
+    new_time_df = time_df.query('@q_min < インプレッション < @q_max')
+    # 時刻ごとのツイート数
+    df_count = new_time_df.groupby(["時刻"]).count()
+    # 時刻ごとの平均インプレッション数
+    df_mean = new_time_df.groupby(["時刻"]).mean(numeric_only=True)
+    return df_mean, df_count
+
+
+# ---- フォロワー数 最新 ----
+
+def prepare_followers_num(frames):
+    df_save_time = followers_by_save_time(frames)
+    x = df_save_time.index
+    return dict(x=x, y=df_save_time['followers'], date=x.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+@view('フォロワー数 最新', 'followers_num_new.html', prepare_followers_num)
+def build_followers_num(data):
+    source = ColumnDataSource(data=dict(data))
+
+    # tooltips設定
+    TOOLTIPS = [('date and time', '@date'), ('followers', '@y')]
+
+    # グラフ全体の設定
+    fig1 = figure(tools = "hover, save", tooltips=TOOLTIPS,
+               title='最新フォロワー数', plot_width=800, plot_height=400,
+               x_axis_label='date', y_axis_label='followers', x_axis_type='datetime', background_fill_color='DarkGreen')
+
+    # X軸の設定
+    x_format = "%m/%d"
+    fig1.xaxis.formatter = DatetimeTickFormatter(days=[x_format], months=[x_format], years=[x_format])
+
+    # 折れ線図
+    fig1.line('x', 'y', line_width=3, legend_label='フォロワー数', source=source, color='Aqua')
+
+    # 散布図
+    fig1.circle('x', 'y', size=15, fill_alpha=0.5, source=source, color='Aqua')
+
+    # 凡例の位置
+    fig1.legend.location = 'top_left'
+    return fig1
+
+
+# ---- ツイートごと いいね数 最新 ----
+
+def prepare_favorited(frames):
+    df_created_at = metrics_by_created_at(frames)
+    x = df_created_at.index
+    return dict(x=x, y=df_created_at['favorited'].astype(int), date=x.astype(str))
+
+
+@view('ツイートごと いいね数 最新', 'favorited_new.html', prepare_favorited, ranged=True)
+def build_favorited(data, x_range=None):
+    # 上段は選択した期間だけ（点が多すぎる時だけ間引く）、下段は全期間を横幅に合わせて間引く（突出した値は残す）
+    detail = detail_range(data, x_range)
+    if detail is None:
+        return empty_figure('ツイートごとの「いいね数」')
+    start, end = detail
+    source = ColumnDataSource(data=downsample.detail(data, ['y'], start, end))
+    overview = downsample.overview(data, ['y'])
+
+    # tooltips設定
+    TOOLTIPS = [('ツイート日時', '@date'), ('いいね数', '@y')]
+
+    # グラフ全体の設定
+    p = figure(tools = "hover, save", tooltips=TOOLTIPS, title='ツイートごとの「いいね数」 (2017/4～最新更新)', plot_width=800, plot_height=400,
+               x_range = [start, end], x_axis_label='ツイート日時', y_axis_label='favorited', x_axis_type='datetime', background_fill_color='DarkGreen')
+
+    # X軸の設定
+    x_format = "%Y/%m/%d"
+    p.xaxis.formatter = DatetimeTickFormatter(days=[x_format], months=[x_format], years=[x_format])
+
+    # 折れ線図
+    p.line('x', 'y', legend_label='「いいね」数', source=source, color='Magenta')
+
+    # 散布図
+    p.asterisk('x', 'y', size=10, fill_alpha=0.5, source=source, color='Magenta')
+
+    # 凡例の位置
+    p.legend.location = 'top_left'
+
+    # rangetoolの作成
+    # rangetoolは、グラフの描画範囲をスライダーで変更することができます。
+    # rangetool用のグラフの設定を追加
+    select = figure(title="上段のグラフの表示範囲をスライダーで指定",
+                    plot_height=100, plot_width=800, y_range=p.y_range,
+                    x_axis_type="datetime", y_axis_type=None,
+                    tools="", toolbar_location=None, background_fill_color="#efefef")
+
+    # Rangetoolの設定
+    range_rool = RangeTool(x_range=p.x_range) # Rangetoolのx_rangeの範囲を設定（p.x_range)
+    range_rool.overlay.fill_color = "navy"    # overlay.fill_colorはスライダーの色を指定
+    range_rool.overlay.fill_alpha = 0.2       # 透明度の指定
+
+    select.line(x=overview['x'], y=overview['y']) # p.lineと同様にx軸とy軸の設定
+    select.ygrid.grid_line_color = None
+    select.add_tools(range_rool) # range_roolを追加
+    select.toolbar.active_multi = range_rool
+    return column(p, select)
+
+
+# ---- 時刻ごと いいね数 最新 ----
+
+def prepare_hours(frames):
+    df_hour = rollups.hourly_means(frames['rollups'][rollups.HOURLY_ENGAGEMENT])
+    return dict(x=df_hour.index, y=df_hour['favorited'].astype(int), y2=df_hour['retweeted'].astype(int))
+
+
+def stats_hours(frames):
+    df_created_at = metrics_by_created_at(frames)
+    return [('いいね数の平均', df_created_at['favorited'].mean()),
+            ('いいね数の中央値', df_created_at['favorited'].median()),
+            ('リツイート数の平均', df_created_at['retweeted'].mean()),
+            ('リツイート数の中央値', df_created_at['retweeted'].median())]
+
+
+@view('時刻ごと いいね数 最新', 'hours_new.html', prepare_hours, stats=stats_hours)
+def build_hours(data):
+    source = ColumnDataSource(data=dict(data))
+
+    # tooltips設定
+    TOOLTIPS1 = [('時刻', '@x'), ('いいね数', '@y')]
+    TOOLTIPS2 = [('時刻', '@x'), ('リツイート数', '@y2')]
+
+    # グラフ全体の設定
+    p1 = figure(tools = "hover, save", tooltips=TOOLTIPS1, title='いいね数 (時刻ごと平均)  2017年4月～最新更新',
+                plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='いいね数',
+                background_fill_color='DarkGreen')
+
+    p2 = figure(tools = "hover, save", tooltips=TOOLTIPS2, title='リツイート数 (時刻ごと平均)  2017年4月～最新更新',
+                plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='リツイート数',
+                background_fill_color='DarkGreen')
+
+    # 棒グラフ
+    p1.vbar(x='x', width=0.5, top='y', legend_label='いいね数(平均)', source=source, color='Lime')
+    p2.vbar(x='x', width=0.5, top='y2', legend_label='リツイート数(平均)', source=source, color='Magenta')
+
+    # 凡例の位置
+    p1.legend.location = 'top_left'
+    p2.legend.location = 'top_left'
+    return column(p1, p2)
+
+
+# ---- フォロワーごと フォロワー数 最新 ----
+
+def prepare_followers_data(frames):
+    # フォロワーごとの最新の値(ロールアップ)
+    df_followers_mean = frames['rollups'][rollups.FOLLOWER_METRICS].set_index('user_id')
+    return dict(x=df_followers_mean['folowers_count'], y=df_followers_mean['friends_count'])
+
+
+@view('フォロワーごと フォロワー数 最新', 'followers_data_new.html', prepare_followers_data, use_container_width=True)
+def build_followers_data(data):
+    source = ColumnDataSource(data=dict(data))
+
+    # tooltips設定
+    TOOLTIPS4 = [('フォロワー数', '@x'), ('フォロー数', '@y')]
+
+    # グラフ全体の設定
+    fig4 = figure(tools = "hover, save", tooltips=TOOLTIPS4, title='フォロワーごとの「フォロワー数」「フォロー数」(2017/4～最新更新)',
+                plot_width=800, plot_height=400, x_axis_label='フォロワー数', y_axis_label='フォロー数',
+                background_fill_color='Darkgreen')
+
+    # 散布図
+    fig4.circle('x', 'y', size=15, fill_alpha=0.7, source=source, color='Aqua', legend_label='「フォロワー数」と「フォロー数」')
+
+    # 凡例の位置
+    fig4.legend.location = 'top_left'
+    return fig4
+
+
+# ---- フォロワーごと フォロワー数 推移 ----
+
+def prepare_follower_history(frames):
+    # 期間の終わりの状態と、フォロワー数の上位のフォロワーごとの推移(follower_snapshots.py)
+    as_of = frames['snapshots']['as_of']
+    lines = [dict(x=series['save_time'], y=series['folowers_count'], date=series['save_time'].astype(str),
+                  user_id=series['user_id'].astype(str))
+             for _, series in frames['snapshots']['series'].groupby('user_id', sort=False)]
+    return dict(x=as_of['folowers_count'], y=as_of['friends_count'], lines=lines)
+
+
+@view('フォロワーごと フォロワー数 推移', 'followers_history.html', prepare_follower_history, use_container_width=True)
+def build_follower_history(data):
+    source = ColumnDataSource(data=dict(x=data['x'], y=data['y']))
+
+    # tooltips設定
+    TOOLTIPS1 = [('フォロワー数', '@x'), ('フォロー数', '@y')]
+    TOOLTIPS2 = [('ユーザーID', '@user_id'), ('保存日時', '@date'), ('フォロワー数', '@y')]
+
+    # グラフ全体の設定
+    p1 = figure(tools = "hover, save", tooltips=TOOLTIPS1, title='フォロワーごとの「フォロワー数」「フォロー数」(選択した期間の終わり時点)',
+                plot_width=800, plot_height=400, x_axis_label='フォロワー数', y_axis_label='フォロー数',
+                background_fill_color='Darkgreen')
+    p2 = figure(tools = "hover, save", tooltips=TOOLTIPS2,
+                title='フォロワーごとの「フォロワー数」の推移 (期間の終わりのフォロワー数 上位{}人)'.format(HISTORY_TOP_K),
+                plot_width=800, plot_height=400, x_axis_label='保存日時', y_axis_label='フォロワー数', x_axis_type='datetime',
+                background_fill_color='Darkgreen')
+
+    # X軸の設定
+    x_format = "%Y/%m/%d"
+    p2.xaxis.formatter = DatetimeTickFormatter(days=[x_format], months=[x_format], years=[x_format])
+
+    # 散布図と、フォロワーごとの階段状の折れ線（値は次の保存まで変わらない）
+    p1.circle('x', 'y', size=15, fill_alpha=0.7, source=source, color='Aqua', legend_label='「フォロワー数」と「フォロー数」')
+    for line in data['lines']:
+        line_source = ColumnDataSource(data=line)
+        p2.step('x', 'y', mode='after', source=line_source, color='Lime')
+        p2.circle('x', 'y', size=5, source=line_source, color='Lime')
+
+    # 凡例の位置
+    p1.legend.location = 'top_left'
+    return column(p1, p2)
+
+
+# ---- フォロワー 頻出ワードランク ----
+
+def prepare_wordrank(frames):
+    # 横棒グラフで上から順になるようにソート
+    df_wordrank_sort = wordrank_table(frames).sort_index(ascending=False)
+    return dict(x=df_wordrank_sort['count'], y=df_wordrank_sort['word'])
+
+
+@view('フォロワー 頻出ワードランク', 'follower_wordrank.html', prepare_wordrank)
+def build_wordrank(data):
+    source = ColumnDataSource(data=dict(data))
+
+    # tooltips設定
+    TOOLTIPS = [('キーワード', '@y'), ('人数', '@x')]
+
+    # グラフ全体の設定
+    fig_word = figure(tools = "hover, save", tooltips=TOOLTIPS, title='フォロワー プロフィール欄の頻出ワード (現在のフォロワー)',
+                plot_width=800, plot_height=1600, x_axis_label='人数', y_axis_label='word', y_range=list(data['y']),
+                background_fill_color='Navy')
+
+    fig_word.hbar(y='y', height=0.8, left=0, right='x', source=source, color='Lime')
+    return fig_word
+
+
+# ---- 月間インプレッション フォロワー ----
+
+def prepare_monthly(frames):
+    df_month = frames['month']
+    x = df_month.index
+    return dict(x=x, y=df_month['フォロワー数'], y2=df_month['インプレッション数'], y3=df_month['ツイート数'],
+                y4=df_month['プロフィールアクセス'], date=x.astype(str), date2=x.strftime('%Y-%m'))
+
+
+@view('月間インプレッション フォロワー', 'monthly_data.html', prepare_monthly)
+def build_monthly(data):
+    x = data['x']
+    source = ColumnDataSource(data=dict(data))
+
+    # tooltips設定
+    TOOLTIPS_1 = [('date', '@date'), ('followers', '@y')]
+    TOOLTIPS_2 = [('date', '@date2'), ('Impression', '@y2')]
+    TOOLTIPS_3 = [('date', '@date2'), ('Tweets', '@y3')]
+    TOOLTIPS_4 = [('date', '@date2'), ('Profile Access', '@y4')]
+
+    # グラフ全体の設定
+    p1 = figure(tools = "hover, save", tooltips=TOOLTIPS_1, title='月ごとフォロワー数(2017/4-2021/9)', plot_width=800, plot_height=400,
+               x_axis_label='date', y_axis_label='followers', x_axis_type='datetime',
+               background_fill_color='Navy')
+
+    p2 = figure(tools = "hover, save", tooltips=TOOLTIPS_2, title='月間インプレッション数(2017/4-2021/9 Monthly)', plot_width=800, plot_height=400,
+               x_axis_label='date', y_axis_label='Impression', x_axis_type='datetime',
+               background_fill_color='Navy')
+
+    p3 = figure(tools = "hover, save", tooltips=TOOLTIPS_3, title='月間ツイート数(2017/4-2021/9 Monthly)', plot_width=800, plot_height=400,
+               x_axis_label='date', y_axis_label='Tweets', x_axis_type='datetime',
+               background_fill_color='Navy')
+
+    p4 = figure(tools = "hover, save", tooltips=TOOLTIPS_4, title='月間プロフィールアクセス数(2017/4-2021/9 Monthly)', plot_width=800, plot_height=400,
+               x_axis_label='date', y_axis_label='Profile Access', x_axis_type='datetime',
+               background_fill_color='Navy')
+
+    # X軸の設定
+    x_format = "%Y/%m"
+    p1.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
+    p2.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
+    p3.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
+    p4.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
+
+    # y軸の設定
+    p2.y_range=Range1d(start=0,end=1000000)
+
+    # 折れ線図
+    p1.line('x', 'y', legend_label='フォロワー数', source=source, color='Aqua')
+
+    # 棒グラフ
+    p2.vbar(x=x, width=0.5, bottom=0, top=data['y2'], color='Lime', legend_label='インプレッション数')
+    p3.vbar(x=x, width=0.5, bottom=0, top=data['y3'], color='Yellow', legend_label='ツイート数')
+    p4.vbar(x=x, width=0.5, bottom=0, top=data['y4'], color='Magenta', legend_label='プロフィールアクセス数')
+
+    # 散布図
+    p1.circle('x', 'y', size=10, fill_alpha=0.5, source=source, color='Aqua')
+    p2.cross('x', 'y2', size=10, fill_alpha=0.5, source=source, color='Lime')
+    p3.asterisk('x', 'y3', size=10, fill_alpha=0.5, source=source, color='Yellow')
+    p4.square('x', 'y4', size=10, fill_alpha=0.5, source=source, color='Magenta')
+
+    # 凡例の位置
+    p1.legend.location = 'top_left'
+    p2.legend.location = 'top_left'
+    p3.legend.location = 'top_left'
+    p4.legend.location = 'top_left'
+    return column(p1, p2, p3, p4)
+
+
+# ---- ツイートごとインプレッション数 ----
+
+def prepare_impression(frames):
+    time_index_df = analytics_time_index(frames)
+    # 空のcsvは日時の列にならないので、日時に揃える
+    x = pd.DatetimeIndex(time_index_df.index)
+    return dict(x=x, y=time_index_df['インプレッション'], y2=time_index_df['エンゲージメント'],
+                date=x.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+@view('ツイートごとインプレッション数', 'impression.html', prepare_impression, ranged=True)
+def build_impression(data, x_range=None):
+    # 上段は選択した期間だけ（点が多すぎる時だけ間引く）、下段は全期間を横幅に合わせて間引く（突出した値は残す）
+    detail = detail_range(data, x_range)
+    if detail is None:
+        return empty_figure('インプレッション数とエンゲージメント数 (ツイートごと)')
+    start, end = detail
+    source = ColumnDataSource(data=downsample.detail(data, ['y', 'y2'], start, end))
+    overview = downsample.overview(data, ['y'])
+
+    # tooltips設定
+    hover_tool_5 = HoverTool(tooltips = [('date', '@date'), ('Impressiion', '@y')], mode='mouse')
+    hover_tool_6 = HoverTool(tooltips = [('date', '@date'), ('Engagement', '@y2')], mode='mouse')
+
+    # グラフ全体の設定
+    p1 = figure(tools=[hover_tool_6, hover_tool_5], title='インプレッション数とエンゲージメント数 (ツイートごと)  2020年10月～2021年9月',
+                plot_width=800, plot_height=400, x_axis_label='date', y_axis_label='Impression', x_axis_type='datetime',
+               x_range = [start, end], y_range= [0, 100000], background_fill_color='Navy')
+
+    # X軸の設定
+    x_format = "%Y/%m"
+    p1.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
+
+    # 折れ線図
+    p1.vbar(x='x', top='y', legend_label='インプレッション数', source=source, color='Lime')
+    p1.vbar(x='x', top='y2', legend_label='エンゲージメント数', source=source, color='Magenta')
+
+    # 散布図
+    p1.asterisk('x', 'y', size=10, fill_alpha=0.5, source=source, color='Lime')
+    p1.asterisk('x', 'y2', size=10, fill_alpha=0.5, source=source, color='Magenta')
+
+    # 凡例の位置
+    p1.legend.location = 'top_left'
+
+    # rangetoolの作成
+    # rangetoolは、グラフの描画範囲をスライダーで変更することができます。
+    # rangetool用のグラフの設定を追加
+    select1 = figure(title="上段のグラフの表示範囲をスライダーで指定",
+                    plot_height=100, plot_width=800, y_range= [0, 500000],
+                    x_axis_type="datetime", y_axis_type=None,
+                    tools="", toolbar_location=None, background_fill_color="#efefef")
+
+    # Rangetoolの設定
+    range_tool = RangeTool(x_range=p1.x_range) # Rangetoolのx_rangeの範囲を設定
+    range_tool.overlay.fill_color = "Navy"    # overlay.fill_colorはスライダーの色を指定
+    range_tool.overlay.fill_alpha = 0.2       # 透明度の指定
+
+    select1.line(x=overview['x'], y=overview['y']) # p.lineと同様にx軸とy軸の設定
+    select1.ygrid.grid_line_color = None
+    select1.add_tools(range_tool) # range_roolを追加
+    select1.toolbar.active_multi = range_tool
+    return column(p1, select1)
+
+
+# ---- 時刻ごとインプレッション数 ----
+
+def prepare_hourly(frames):
+    df_mean, df_count = analytics_hourly(frames)
+    return dict(x=df_mean.index, x4=df_count.index, y=df_mean['インプレッション'].astype(int),
+                y2=df_mean['エンゲージメント'].astype(int), y3=df_mean['ユーザープロフィールクリック'].astype(int),
+                y4=df_count['インプレッション'])
+
+
+@view('時刻ごとインプレッション数', 'hourly_data.html', prepare_hourly)
+def build_hourly(data):
+    source = ColumnDataSource(data=dict(data))
+
+    # tooltips設定
+    TOOLTIPS_11 = [('hour', '@x'), ('Impressiion', '@y')]
+    TOOLTIPS_12 = [('hour', '@x'), ('Engagement', '@y2')]
+    TOOLTIPS_13 = [('hour', '@x'), ('Profile Access', '@y3')]
+    TOOLTIPS_14 = [('hour', '@x4'), ('Tweet', '@y4')]
+
+    # グラフ全体の設定
+    p1 = figure(tools = "hover, save", tooltips=TOOLTIPS_11, title='インプレッション数 (時刻ごと平均)  2020年10月～2021年9月 ※外れ値を処理',
+                plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Impression',
+                background_fill_color='Navy')
+
+    p2 = figure(tools = "hover, save", tooltips=TOOLTIPS_12, title='エンゲージメント数 (時刻ごと平均)  2020年10月～2021年9月 ※外れ値を処理',
+                plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Engagement',
+                background_fill_color='Navy')
+
+    p3 = figure(tools = "hover, save", tooltips=TOOLTIPS_13, title='プロフィールアクセス数 (時刻ごと平均)  2020年10月～2021年9月 ※外れ値を処理',
+                plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Profile Access',
+                background_fill_color='Navy')
+
+    p4 = figure(tools = "hover, save", tooltips=TOOLTIPS_14, title='ツイート数 (時刻ごと件数)  2020年10月～2021年9月 ※外れ値を処理',
+                plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Tweet',
+                background_fill_color='Navy')
+
+    # 棒グラフ
+    p1.vbar(x='x', width=0.5, top='y', legend_label='インプレッション数(平均)', source=source, color='Lime')
+    p2.vbar(x='x', width=0.5, top='y2', legend_label='エンゲージメント数(平均)', source=source, color='Magenta')
+    p3.vbar(x='x', width=0.5, top='y3', legend_label='プロフィールアクセス数(平均)', source=source, color='OrangeRed')
+    p4.vbar(x='x4', width=0.5, top='y4', legend_label='ツイート数', source=source, color='AquaMarine')
+
+    # 凡例の位置
+    p1.legend.location = 'top_left'
+    p2.legend.location = 'top_left'
+    p3.legend.location = 'top_left'
+    p4.legend.location = 'top_left'
+    return column(p1, p2, p3, p4)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+ツイートとフォロワーのデータを型付きの列指向フォーマット(Parquet / Arrow IPC)で読み書きします。
+tweet_data_save.py, followers_data_save.py, twitter_analysis_streamlit.py から共通で使います。
+csvは書き出し(エクスポート)専用です。過去のcsvファイルは読み込み時に同じ型へ変換します。
+"""
+
+# 必要なモジュールのインポート
+import gzip
+import os
+import tempfile
+import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+
+# 保存フォーマット（拡張子で判別）
+PARQUET = 'parquet'
+ARROW = 'arrow'
+CSV = 'csv'
+
+# csvを書き出す時に1回で変換する行数
+CSV_CHUNK_ROWS = 50000
+
+# ツイートデータのスキーマ（tweet_data_save.pyで保存する列）
+# partition_column はセグメントを日付で分ける・期間で絞り込む時に使う列
+TWEETS_SCHEMA = pa.schema([
+    ('save_time', pa.timestamp('us')),
+    ('followers', pa.int64()),
+    ('tweet_id', pa.int64()),
+    ('created_at', pa.timestamp('us')),
+    ('tweet_text', pa.string()),
+    ('characters', pa.int32()),  # URL・@メンションを除いて重み付けした文字数(text_metrics.py)
+    ('favorited', pa.int64()),
+    ('retweeted', pa.int64()),
+], metadata={'partition_column': 'created_at'})
+
+# フォロワーデータのスキーマ（followers_data_save.pyで保存する列）
+FOLLOWERS_SCHEMA = pa.schema([
+    ('save_time', pa.timestamp('us')),
+    ('user_id', pa.int64()),
+    ('screen_name', pa.string()),
+    ('folowers_count', pa.int64()),
+    ('friends_count', pa.int64()),
+    ('user_name', pa.string()),
+    ('location', pa.string()),
+    ('user_url', pa.string()),
+    ('description', pa.string()),
+], metadata={'partition_column': 'save_time'})
+
+
+# 文字列の列の型（pyarrowの文字列、pandasが対応していない場合はobject）
+# objectはPythonの文字列を1つずつ持つので、pyarrowの文字列より数倍のメモリを使う
+def _text_dtype():
+    try:
+        return pd.StringDtype('pyarrow')
+    except (ImportError, TypeError, ValueError):
+        return object
+
+TEXT_DTYPE = _text_dtype()
+
+# ダッシュボードでcategoryにする、値の種類が少ない文字列の列
+CATEGORY_COLUMNS = ('location',)
+
+# ダッシュボードで読み込むcsvの列と型（pd.read_csvの引数、使わない列は読み込まず、日時は読み込み時に変換）
+MONTH_CSV = dict(usecols=['日時', 'フォロワー数', 'インプレッション数', 'ツイート数', 'プロフィールアクセス'],
+                 parse_dates=['日時'])
+ANALYTICS_CSV = dict(usecols=['時間', '時刻', 'ツイート本文', 'インプレッション', 'エンゲージメント', 'ユーザープロフィールクリック'],
+                     dtype={'ツイート本文': TEXT_DTYPE}, parse_dates=['時間'])
+
+
+# 日付で分ける列（スキーマに指定が無い場合はNone）
+def partition_column(schema):
+    metadata = schema.metadata or {}
+    column = metadata.get(b'partition_column')
+    return column.decode('utf-8') if column is not None else None
+
+
+# ファイルパスの拡張子からフォーマットを判別
+def file_format(path):
+    ext = os.path.splitext(path)[1].lstrip('.').lower()
+    if ext in ('arrow', 'feather', 'ipc'):
+        return ARROW
+    if ext == 'csv':
+        return CSV
+    return PARQUET
+
+
+# 保存フォーマットに合わせたファイルパスを作成 (例: /tmp/tweets + parquet -> /tmp/tweets.parquet)
+def with_format(path_without_ext, fmt):
+    return '{}.{}'.format(path_without_ext, fmt)
+
+
+# pandasのDataFrameをスキーマの型にそろえる（csv由来の文字列IDや日時もここで変換）
+def coerce(df, schema):
+    df = df[schema.names].copy()
+    for field in schema:
+        col = df[field.name]
+        if pa.types.is_timestamp(field.type):
+            df[field.name] = pd.to_datetime(col)
+        elif pa.types.is_integer(field.type):
+            df[field.name] = pd.to_numeric(col).astype(field.type.to_pandas_dtype())
+        elif pa.types.is_string(field.type):
+            df[field.name] = col.astype(object).where(col.notna(), None)
+    return df
+
+
+# DataFrameをスキーマ付きのArrowテーブルに変換
+def to_table(df, schema):
+    return pa.Table.from_pandas(coerce(df, schema), schema=schema, preserve_index=False)
+
+
+# ファイルを読み込んでDataFrameを返す（columnsで必要な列だけ読み込み可能）
+# time_range=(開始, 終了) を指定すると、partition_columnがその期間の行だけを返す
+# （parquetは読み込み時に絞り込むので、期間外のrow groupは読まない）
+# text_dtype を指定すると、文字列の列をPythonの文字列を作らずにその型(TEXT_DTYPE)で読み込む
+def read_table(path, schema, columns=None, time_range=None, text_dtype=None):
+    fmt = file_format(path)
+    column = partition_column(schema) if time_range is not None else None
+    read_columns = columns if columns is None or column is None or column in columns else list(columns) + [column]
+    if fmt == PARQUET:
+        filters = None
+        if column is not None:
+            start, end = pd.Timestamp(time_range[0]), pd.Timestamp(time_range[1])
+            filters = [(column, '>=', start), (column, '<=', end)]
+        if text_dtype is None:
+            df = pd.read_parquet(path, columns=read_columns, filters=filters)
+        else:
+            df = pq.read_table(path, columns=read_columns, filters=filters).to_pandas(
+                types_mapper={pa.string(): text_dtype}.get)
+    elif fmt == ARROW:
+        if text_dtype is None:
+            df = pd.read_feather(path, columns=read_columns)
+        else:
+            df = feather.read_table(path, columns=read_columns).to_pandas(types_mapper={pa.string(): text_dtype}.get)
+    else:
+        # 過去のcsvファイルはスキーマの型に変換してから返す
+        df = coerce(pd.read_csv(path), schema)
+    if column is not None and fmt != PARQUET:
+        df = df[df[column].between(pd.Timestamp(time_range[0]), pd.Timestamp(time_range[1]))]
+    return df[columns].reset_index(drop=True) if columns else df.reset_index(drop=True)
+
+
+# DataFrameをスキーマの型で保存（csvは指定しても書き出し専用のexport_csvを使う）
+def write_table(df, path, schema):
+    fmt = file_format(path)
+    table = to_table(df, schema)
+    if fmt == PARQUET:
+        pq.write_table(table, path, compression='zstd')
+    elif fmt == ARROW:
+        feather.write_feather(table, path, compression='zstd')
+    else:
+        export_csv(df, path)
+
+
+# 少しずつ書き込むためのライター（write_table(pyarrowのテーブル)とclose()を持つ）
+# parquetはrow group、arrowはrecord batchごとに書き出すので、全体をメモリに持たない
+def open_writer(path, schema):
+    fmt = file_format(path)
+    if fmt == PARQUET:
+        return pq.ParquetWriter(path, schema, compression='zstd')
+    if fmt == ARROW:
+        return pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+    raise ValueError('csvは書き出し専用です: {}'.format(path))
+
+
+# csvに書き出し（エクスポート専用）
+def export_csv(df, path):
+    df.to_csv(path, index=False)
+
+
+# 表をcsvのバイト列で少しずつ返す（ヘッダーは最初だけ、index=Trueで行名も書き出す）
+def iter_csv_chunks(df, chunk_rows=CSV_CHUNK_ROWS, index=True):
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(header=start == 0, index=index).encode('utf-8')
+
+
+# 表のcsvを一時ファイルに書き出して、読み込み用に開いたファイルを返す（ダウンロード用、compress=Trueならgzipで圧縮）
+# チャンクごとに変換・圧縮しながら書き込むので、csv全体をメモリに持たない
+# 一時ファイルは開いたまま削除するので、返したファイルを閉じる(捨てる)と消える
+def csv_file(df, compress=False, chunk_rows=CSV_CHUNK_ROWS, dir=None):
+    fd, path = tempfile.mkstemp(suffix='.csv.gz' if compress else '.csv', dir=dir)
+    try:
+        with open(fd, 'wb') as f:
+            out = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+            for chunk in iter_csv_chunks(df, chunk_rows):
+                out.write(chunk)
+            if compress:
+                out.close()
+        return open(path, 'rb')
+    finally:
+        os.remove(path)
+
+
+# 読み込んだ表をメモリの少ない型にする（ダッシュボード用）
+# 整数は値が収まるいちばん小さい型、categoriesの列はcategory、それ以外の文字列はTEXT_DTYPE
+def compact_frame(df, categories=CATEGORY_COLUMNS):
+    df = df.copy()
+    for name in df.columns:
+        col = df[name]
+        if pd.api.types.is_integer_dtype(col.dtype):
+            df[name] = pd.to_numeric(col, downcast='integer')
+        elif name in categories and (col.dtype == object or pd.api.types.is_string_dtype(col.dtype)):
+            df[name] = col.astype('category')
+        elif col.dtype == object:
+            df[name] = col.astype(TEXT_DTYPE)
+    return df
+
+
+# compact_frame済みの表に新しい行を追加（差分の読み込み用、新しい行もcompact_frameしてから追加）
+# 整数は両方が収まる型になり、categoryの列はカテゴリーをあわせてcategoryのままにする
+def append_compact(df, tail, categories=CATEGORY_COLUMNS):
+    tail = compact_frame(tail, categories)
+    if df is None or len(df) == 0:
+        return tail
+    if len(tail) == 0:
+        return df
+    combined = pd.concat([df, tail], ignore_index=True)
+    for name in combined.columns:
+        if isinstance(df[name].dtype, pd.CategoricalDtype) and not isinstance(combined[name].dtype, pd.CategoricalDtype):
+            combined[name] = union_categoricals([df[name], tail[name].astype('category')])
+    return combined
+
+
+# csvを列と型を指定して読み込み（specは MONTH_CSV などのpd.read_csvの引数）
+def read_csv_typed(path, spec):
+    return compact_frame(pd.read_csv(path, **spec))
+
+
+# 表のメモリ使用量(バイト、文字列の中身も含む)
+def frame_bytes(df):
+    return int(df.memory_usage(deep=True, index=True).sum())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+長い時系列グラフのデータ点を、表示する幅(ピクセル)に合わせて減らします。
+区間ごとに最小値と最大値の点を残すので、突出した値(バズったツイートなど)は減らしても必ず残ります。
+残す点のインデックスを返すので、同じ行の他の列(日時の文字列など)もそろえて取り出せます。
+"""
+
+# 必要なモジュールのインポート
+import numpy as np
+
+
+# 全体表示(RangeToolの下段)の点の数の目安（横幅800pxに対して1pxあたり最小・最大の2点）
+OVERVIEW_POINTS = 1600
+
+# 詳細表示(上段)で、選択した期間に含まれる点がこれより多い場合だけ減らす
+DETAIL_MAX_POINTS = 5000
+
+
+# 区間ごとに最小値・最大値の点を残す（最初と最後の点も残す）
+# 複数の列を渡すと、すべての列の最小値・最大値の点を残す
+def minmax_indices(n_points, ys):
+    n = len(ys[0]) if ys else 0
+    if n <= n_points:
+        return np.arange(n)
+    n_buckets = max(1, n_points // 2)
+    starts = np.linspace(0, n, n_buckets + 1).astype(np.int64)[:-1]
+    keep = [np.array([0, n - 1])]
+    for y in ys:
+        y = np.asarray(y, dtype=float)
+        y_min = np.where(np.isnan(y), np.inf, y)
+        y_max = np.where(np.isnan(y), -np.inf, y)
+        # 区間ごとの最小値・最大値の位置（reduceatで区間の値を求め、その値の最初の位置を探す）
+        bucket = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+        mins = np.minimum.reduceat(y_min, starts)
+        maxs = np.maximum.reduceat(y_max, starts)
+        is_min = y_min == mins[bucket]
+        is_max = y_max == maxs[bucket]
+        first_min = np.unique(bucket[is_min], return_index=True)[1]
+        first_max = np.unique(bucket[is_max], return_index=True)[1]
+        keep.append(np.flatnonzero(is_min)[first_min])
+        keep.append(np.flatnonzero(is_max)[first_max])
+    return np.unique(np.concatenate(keep))
+
+
+# 辞書の各列から、インデックスの行だけを取り出す
+def take(data, indices):
+    return {name: np.asarray(values)[indices] for name, values in data.items()}
+
+
+# x(日時) が start～end の範囲の行だけを取り出す（x は昇順なので二分探索）
+def window(data, start, end, x_name='x'):
+    x = np.asarray(data[x_name])
+    lo = np.searchsorted(x, np.datetime64(start), side='left')
+    hi = np.searchsorted(x, np.datetime64(end), side='right')
+    return take(data, np.arange(lo, hi))
+
+
+# 全体表示用に減らしたデータ
+def overview(data, y_names, n_points=OVERVIEW_POINTS):
+    return take(data, minmax_indices(n_points, [data[name] for name in y_names]))
+
+
+# 詳細表示用のデータ（選択した期間は全件、多すぎる場合だけ最小値・最大値を残して減らす）
+def detail(data, y_names, start, end, max_points=DETAIL_MAX_POINTS):
+    data = window(data, start, end)
+    return take(data, minmax_indices(max_points, [data[name] for name in y_names]))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""
+Twitter APIの代わりに使うローカルの疑似APIです（tweepy.APIと同じメソッド名・戻り値の形）。
+収集スクリプトの FAKE_API を指定すると、認証せずにこの疑似APIからデータを取得するので、
+ノートPCでも毎回同じデータ・同じ条件で取得の速さを計測できます。
+・followers_ids: カーソルでのページ送り(1ページ5000件)
+・lookup_users: 100件までの一括取得（凍結・削除済みのアカウントは返さない）
+・user_timeline: since_id / max_id での取得（最新の3200件まで）
+・statuses_lookup: 100件までのツイートの一括取得（いいね数・リツイート数の取り直し用）
+・get_user
+リクエストごとにレスポンスの遅延を入れ、エンドポイントごとに15分の時間枠で回数を数えて、超えたら429エラーを返します。
+データは、件数を指定して作る疑似アカウント(SyntheticAccount)か、本物のAPIのレスポンスを記録したファイル(Recorderで記録)から返します。
+"""
+
+# 必要なモジュールのインポート
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime
+from types import SimpleNamespace
+
+from request_scheduler import RATE_LIMITS, WINDOW_SECONDS
+
+
+# レスポンスの遅延（エンドポイントごとの中央値(秒)、ばらつきは対数正規分布）
+LATENCY = {
+    'followers/ids': 0.35,
+    'users/lookup': 0.45,
+    'users/show': 0.15,
+    'statuses/user_timeline': 0.30,
+    'statuses/lookup': 0.30,
+}
+LATENCY_SIGMA = 0.3
+
+# 1ページ・1リクエストあたりの最大件数
+FOLLOWER_IDS_PAGE_SIZE = 5000
+LOOKUP_MAX_USERS = 100
+LOOKUP_MAX_STATUSES = 100
+TIMELINE_MAX_COUNT = 200
+
+# user_timelineで取得できるのは最新の3200件まで
+TIMELINE_LIMIT = 3200
+
+# created_at の形式（Twitter API v1.1）
+CREATED_AT_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+# メソッド名とレート制限のエンドポイント
+ENDPOINTS = {
+    'followers_ids': 'followers/ids',
+    'lookup_users': 'users/lookup',
+    'get_user': 'users/show',
+    'user_timeline': 'statuses/user_timeline',
+    'statuses_lookup': 'statuses/lookup',
+}
+
+
+# レート制限エラー（request_scheduler.is_rate_limit_error / reset_seconds で扱える形）
+class RateLimitExceeded(Exception):
+    api_code = 88
+
+    def __init__(self, endpoint, reset_in):
+        super().__init__('Rate limit exceeded: {}'.format(endpoint))
+        self.reason = str(self)
+        self.response = SimpleNamespace(status_code=429,
+                                        headers={'x-rate-limit-reset': str(time.time() + reset_in)})
+
+
+# 記録したファイルに無いリクエスト
+class FixtureMiss(LookupError):
+    pass
+
+
+# APIのJSONをtweepyのモデルと同じように属性で読めるオブジェクトにする（entitiesなどはdictのまま）
+def to_user(data):
+    user = SimpleNamespace(**data)
+    user._json = data
+    return user
+
+
+def to_status(data):
+    status = SimpleNamespace(**data)
+    status._json = data
+    status.created_at = datetime.strptime(data['created_at'], CREATED_AT_FORMAT)
+    status.user = to_user(data['user'])
+    return status
+
+
+# 同じリクエストには同じ値を返す乱数（スレッドの実行順によらない）
+def seeded_random(*keys):
+    return random.Random(zlib.crc32(json.dumps(keys, sort_keys=True, default=str).encode('utf-8')))
+
+
+# 件数を指定して作る疑似アカウント（フォロワーはn_followers人、ツイートはn_tweets件）
+# 同じ引数なら毎回同じデータになり、件数を増やすと新しいフォロワー・ツイートが先頭に追加される
+class SyntheticAccount:
+    FIRST_USER_ID = 1000000000
+    FIRST_TWEET_ID = 850000000000000000
+    TWEET_ID_STEP = 1000000
+    WORDS = ['Python', 'データ分析', 'Twitter', '機械学習', 'streamlit', 'GCP', 'pandas', 'グラフ',
+             'エンジニア', '勉強中', '統計', 'プログラミング', 'AI', 'Web', 'デザイン', '投資']
+    LOCATIONS = ['東京', '大阪', '福岡', '札幌', 'Japan', '', '名古屋', '横浜']
+
+    def __init__(self, screen_name='fake_account', n_followers=10000, n_tweets=3200, seed=0,
+                 start=datetime(2017, 4, 1), end=datetime(2021, 9, 30), suspended_rate=0.01):
+        self.screen_name = screen_name
+        self.n_followers = n_followers
+        self.n_tweets = n_tweets
+        self.seed = seed
+        self.start = start
+        self.end = end
+        self.suspended_rate = suspended_rate
+
+    # i番目(古い順)のフォロワーのID
+    def follower_id(self, i):
+        return self.FIRST_USER_ID + i * 13
+
+    def user_json(self, user_id):
+        rng = seeded_random(self.seed, 'user', user_id)
+        words = ' '.join(rng.choice(self.WORDS) for _ in range(rng.randint(3, 12)))
+        return {
+            'id': user_id,
+            'id_str': str(user_id),
+            'screen_name': 'user{}'.format(user_id),
+            'name': 'ユーザー{}'.format(user_id % 100000),
+            'location': rng.choice(self.LOCATIONS),
+            'url': 'https://example.com/{}'.format(user_id) if rng.random() < 0.3 else None,
+            'description': words,
+            'followers_count': int(rng.lognormvariate(5, 1.5)),
+            'friends_count': int(rng.lognormvariate(5, 1)),
+        }
+
+    def is_suspended(self, user_id):
+        return seeded_random(self.seed, 'suspended', user_id).random() < self.suspended_rate
+
+    def account_json(self):
+        data = self.user_json(0)
+        data.update(id=1, id_str='1', screen_name=self.screen_name, followers_count=self.n_followers)
+        return data
+
+    # i番目(古い順)のツイート
+    def status_json(self, i):
+        rng = seeded_random(self.seed, 'status', i)
+        tweet_id = self.FIRST_TWEET_ID + i * self.TWEET_ID_STEP
+        created_at = self.start + (self.end - self.start) * ((i + 1) / max(self.n_tweets, 1))
+        text = ' '.join(rng.choice(self.WORDS) for _ in range(rng.randint(3, 20)))
+        kind = rng.random()
+        if kind < 0.1:
+            text = 'RT @user{}: {}'.format(rng.randint(1, 10 ** 6), text)
+        elif kind < 0.2:
+            text = '@user{} {}'.format(rng.randint(1, 10 ** 6), text)
+        urls = []
+        if rng.random() < 0.3:
+            url = 'https://t.co/{:010x}'.format(rng.getrandbits(40))
+            urls.append({'url': url, 'expanded_url': 'https://example.com/{}'.format(i),
+                         'indices': [len(text) + 1, len(text) + 1 + len(url)]})
+            text = text + ' ' + url
+        return {
+            'id': tweet_id,
+            'id_str': str(tweet_id),
+            'created_at': created_at.strftime(CREATED_AT_FORMAT),
+            'text': text,
+            'entities': {'urls': urls, 'user_mentions': [], 'hashtags': []},
+            'favorite_count': int(rng.expovariate(0.2)),
+            'retweet_count': int(rng.expovariate(1.0)),
+            'user': {'id': 1, 'id_str': '1', 'screen_name': self.screen_name,
+                     'followers_count': self.n_followers * (i + 1) // max(self.n_tweets, 1)},
+        }
+
+    # followers_ids: 新しいフォロワーから順に、カーソル(何件目から)ごとに5000件
+    def followers_ids(self, cursor=-1, **params):
+        offset = 0 if cursor == -1 else cursor
+        last = self.n_followers - 1
+        ids = [self.follower_id(last - i) for i in range(offset, min(offset + FOLLOWER_IDS_PAGE_SIZE, self.n_followers))]
+        next_cursor = offset + len(ids) if offset + len(ids) < self.n_followers else 0
+        return {'ids': ids, 'previous_cursor': -offset if offset else 0, 'next_cursor': next_cursor}
+
+    def lookup_users(self, user_ids=(), **params):
+        first = self.follower_id(0)
+        return [self.user_json(user_id) for user_id in user_ids[:LOOKUP_MAX_USERS]
+                if (user_id - first) % 13 == 0 and 0 <= (user_id - first) // 13 < self.n_followers
+                and not self.is_suspended(user_id)]
+
+    def get_user(self, **params):
+        return self.account_json()
+
+    # user_timeline: 新しい順に、since_idより新しく(含まない) max_id以下(含む) のツイートをcount件
+    def user_timeline(self, count=20, since_id=None, max_id=None, **params):
+        newest = self.n_tweets - 1
+        oldest = max(0, self.n_tweets - TIMELINE_LIMIT)
+        if max_id is not None:
+            newest = min(newest, (max_id - self.FIRST_TWEET_ID) // self.TWEET_ID_STEP)
+        if since_id is not None:
+            oldest = max(oldest, (since_id - self.FIRST_TWEET_ID) // self.TWEET_ID_STEP + 1)
+        last = max(newest - min(count, TIMELINE_MAX_COUNT) + 1, oldest)
+        return [self.status_json(i) for i in range(newest, last - 1, -1)]
+
+    # statuses_lookup: 指定したIDのうち、存在するツイートだけ（100件まで）
+    def statuses_lookup(self, id_=(), **params):
+        indices = ((tweet_id - self.FIRST_TWEET_ID) // self.TWEET_ID_STEP for tweet_id in id_[:LOOKUP_MAX_STATUSES]
+                   if (tweet_id - self.FIRST_TWEET_ID) % self.TWEET_ID_STEP == 0)
+        return [self.status_json(i) for i in indices if 0 <= i < self.n_tweets]
+
+
+# Recorderで記録したファイルからレスポンスを返す（記録に無いリクエストは FixtureMiss）
+class Fixture:
+    def __init__(self, path):
+        self.responses = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[request_key(record['method'], record['params'])] = record['response']
+
+    def respond(self, method, params):
+        key = request_key(method, params)
+        if key not in self.responses:
+            raise FixtureMiss('記録に無いリクエストです: {}'.format(key))
+        return self.responses[key]
+
+
+# 記録・再生でリクエストを見分けるキー（Noneの引数は省く）
+def request_key(method, params):
+    return json.dumps([method, {k: v for k, v in params.items() if v is not None}], sort_keys=True)
+
+
+# 疑似API（tweepy.APIの代わりに収集スクリプトへ渡す）
+# sourceは SyntheticAccount か Fixture、time_scaleで遅延とレート制限の時間枠をまとめて縮める
+class FakeTwitterAPI:
+    def __init__(self, source, latency=LATENCY, limits=RATE_LIMITS, window=WINDOW_SECONDS, time_scale=1.0,
+                 seed=0, sleep=time.sleep, clock=time.monotonic):
+        self.source = source
+        self.latency = {name: seconds * time_scale for name, seconds in latency.items()}
+        self.limits = limits
+        self.window = window * time_scale
+        self.seed = seed
+        self.sleep = sleep
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._stats = {name: {'calls': 0, 'rate_limited': 0, 'latency_seconds': 0.0} for name in limits}
+
+    # 時間枠の回数を数え、超えていればRateLimitExceeded、そうでなければ遅延を入れてレスポンスを返す
+    def _call(self, method, params):
+        endpoint = ENDPOINTS[method]
+        with self._lock:
+            now = self.clock()
+            started, used = self._windows.get(endpoint, (now, 0))
+            if now - started >= self.window:
+                started, used = now, 0
+            if used >= self.limits[endpoint]:
+                self._stats[endpoint]['rate_limited'] += 1
+                raise RateLimitExceeded(endpoint, started + self.window - now)
+            self._windows[endpoint] = (started, used + 1)
+            self._stats[endpoint]['calls'] += 1
+        if isinstance(self.source, Fixture):
+            response = self.source.respond(method, params)
+        else:
+            response = getattr(self.source, method)(**params)
+        delay = self.latency.get(endpoint, 0) * seeded_random(self.seed, method, params).lognormvariate(0, LATENCY_SIGMA)
+        with self._lock:
+            self._stats[endpoint]['latency_seconds'] += delay
+        self.sleep(delay)
+        return response
+
+    # エンドポイントごとのリクエスト回数・429の回数・遅延の合計
+    def stats(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def followers_ids(self, id=None, screen_name=None, cursor=-1, count=None):
+        data = self._call('followers_ids', {'id': id, 'screen_name': screen_name, 'cursor': cursor, 'count': count})
+        return data['ids'], (data['previous_cursor'], data['next_cursor'])
+
+    def lookup_users(self, user_ids=None, screen_names=None):
+        data = self._call('lookup_users', {'user_ids': list(user_ids) if user_ids is not None else None,
+                                           'screen_names': screen_names})
+        return [to_user(user) for user in data]
+
+    def get_user(self, id=None, screen_name=None):
+        return to_user(self._call('get_user', {'id': id, 'screen_name': screen_name}))
+
+    def user_timeline(self, screen_name=None, count=None, since_id=None, max_id=None):
+        data = self._call('user_timeline', {'screen_name': screen_name, 'count': count,
+                                            'since_id': since_id, 'max_id': max_id})
+        return [to_status(status) for status in data]
+
+    def statuses_lookup(self, id_=None, trim_user=None):
+        data = self._call('statuses_lookup', {'id_': list(id_) if id_ is not None else None, 'trim_user': trim_user})
+        return [to_status(status) for status in data]
+
+
+# 本物のtweepy.APIを包んで、リクエストとレスポンス(JSON)をファイルに記録する（Fixtureで再生できる）
+class Recorder:
+    def __init__(self, api, path):
+        self.api = api
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _record(self, method, params, response):
+        line = json.dumps({'method': method, 'params': {k: v for k, v in params.items() if v is not None},
+                           'response': response}, ensure_ascii=False)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+    def followers_ids(self, id=None, screen_name=None, cursor=-1, count=None):
+        params = {'id': id, 'screen_name': screen_name, 'cursor': cursor, 'count': count}
+        ids, (previous_cursor, next_cursor) = self.api.followers_ids(**{k: v for k, v in params.items() if v is not None})
+        self._record('followers_ids', params, {'ids': ids, 'previous_cursor': previous_cursor, 'next_cursor': next_cursor})
+        return ids, (previous_cursor, next_cursor)
+
+    def lookup_users(self, user_ids=None, screen_names=None):
+        params = {'user_ids': list(user_ids) if user_ids is not None else None, 'screen_names': screen_names}
+        users = self.api.lookup_users(**{k: v for k, v in params.items() if v is not None})
+        self._record('lookup_users', params, [user._json for user in users])
+        return users
+
+    def get_user(self, id=None, screen_name=None):
+        params = {'id': id, 'screen_name': screen_name}
+        user = self.api.get_user(**{k: v for k, v in params.items() if v is not None})
+        self._record('get_user', params, user._json)
+        return user
+
+    def user_timeline(self, screen_name=None, count=None, since_id=None, max_id=None):
+        params = {'screen_name': screen_name, 'count': count, 'since_id': since_id, 'max_id': max_id}
+        statuses = self.api.user_timeline(**{k: v for k, v in params.items() if v is not None})
+        self._record('user_timeline', params, [status._json for status in statuses])
+        return statuses
+
+    def statuses_lookup(self, id_=None, trim_user=None):
+        params = {'id_': list(id_) if id_ is not None else None, 'trim_user': trim_user}
+        statuses = self.api.statuses_lookup(**{k: v for k, v in params.items() if v is not None})
+        self._record('statuses_lookup', params, [status._json for status in statuses])
+        return statuses
+
+
+# 収集スクリプトのFAKE_APIの指定から疑似APIを作成
+# 'synthetic' または 'synthetic:followers=20000,tweets=3200,seed=1' で疑似アカウント、それ以外は記録したファイルのパス
+def open_api(spec, time_scale=1.0):
+    if spec == 'synthetic' or spec.startswith('synthetic:'):
+        options = dict(item.split('=') for item in spec.partition(':')[2].split(',') if item)
+        seed = int(options.get('seed', 0))
+        source = SyntheticAccount(n_followers=int(options.get('followers', 10000)),
+                                  n_tweets=int(options.get('tweets', 3200)), seed=seed)
+        return FakeTwitterAPI(source, time_scale=time_scale, seed=seed)
+    return FakeTwitterAPI(Fixture(spec), time_scale=time_scale)
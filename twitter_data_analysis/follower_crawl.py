@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""
+フォロワーの取得(followers_idsのページ送りとユーザー情報の一括取得)を、途中から再開できるように保存しながら進めます。
+1回の実行(Cloud Functionsの制限時間内)で終わらなくても、ページごとに次のカーソルと取得したユーザー情報を保存しておき、
+次の実行で続きから取得します。すべてのページを取得し終えた時だけ、フォロワーのデータ・履歴・インデックスを更新します。
+・crawl.json: 取得の状態（開始日時、次のカーソル、取得済みのIDのページ数、IDの取得が終わったか）
+・ids-000000.npy: followers_idsの1ページ分のID（新しい順）
+・shard-000/: 担当するページのユーザー情報(セグメント、segment_log.py)と、取得済みのページ・取得に失敗したID(shard.json)
+shards を2以上にすると、IDのページをページ番号で分け、各担当(シャード)が別々の実行で並行してユーザー情報を取得します。
+"""
+
+# 必要なモジュールのインポート
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from data_format import FOLLOWERS_SCHEMA, PARQUET
+from segment_log import MANIFEST_NAME, read_manifest, read_log, append_segment
+
+
+# ファイル名
+STATE_NAME = 'crawl.json'
+SHARD_STATE_NAME = 'shard.json'
+
+
+# 新しい取得の状態（カーソル-1から開始）
+def new_state(started_at):
+    return {'started_at': started_at.isoformat(timespec='seconds'), 'cursor': -1, 'pages': 0, 'listed': False}
+
+
+def state_path(crawl_dir):
+    return os.path.join(crawl_dir, STATE_NAME)
+
+
+# JSONを読み込み（無い場合はNone）
+def _read_json(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# JSONを書き込み（一時ファイルに書いてから置き換える）
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+# 取得の状態を読み込み（途中の取得が無い場合はNone）
+def read_state(crawl_dir):
+    return _read_json(state_path(crawl_dir))
+
+
+def write_state(crawl_dir, state):
+    _write_json(state_path(crawl_dir), state)
+
+
+# 取得の開始日時（ユーザー情報の保存日時にする）
+def started_at(state):
+    return datetime.fromisoformat(state['started_at'])
+
+
+# ---- followers_ids のページ ----
+
+def ids_name(page):
+    return 'ids-{:06d}.npy'.format(page)
+
+
+def ids_path(crawl_dir, page):
+    return os.path.join(crawl_dir, ids_name(page))
+
+
+# 1ページ分のIDを保存して、状態を次のカーソルへ進める（次のカーソルが0ならIDの取得は終わり）
+def save_page(crawl_dir, state, ids, next_cursor):
+    page = state['pages']
+    np.save(ids_path(crawl_dir, page), np.asarray(ids, dtype='int64'))
+    state['pages'] = page + 1
+    state['cursor'] = next_cursor
+    state['listed'] = next_cursor == 0
+    write_state(crawl_dir, state)
+    return page
+
+
+def load_page(crawl_dir, page):
+    return np.load(ids_path(crawl_dir, page))
+
+
+# 取得したすべてのIDをページ順(新しい順)に並べた配列
+def listed_ids(crawl_dir, state):
+    pages = [load_page(crawl_dir, page) for page in range(state['pages'])]
+    return np.concatenate(pages) if pages else np.empty(0, dtype='int64')
+
+
+# ---- シャード（ユーザー情報を取得する担当） ----
+
+def shard_dir(crawl_dir, shard):
+    return os.path.join(crawl_dir, 'shard-{:03d}'.format(shard))
+
+
+def shard_state_path(crawl_dir, shard):
+    return os.path.join(shard_dir(crawl_dir, shard), SHARD_STATE_NAME)
+
+
+# シャードの取得済みのページと、取得に失敗したID（ページ番号ごと）（別の取得の記録、または無い場合は空）
+def read_shard_state(crawl_dir, shard, state):
+    shard_state = _read_json(shard_state_path(crawl_dir, shard))
+    if shard_state is None or shard_state['started_at'] != state['started_at']:
+        return {'started_at': state['started_at'], 'hydrated': [], 'failed': {}}
+    shard_state.setdefault('failed', {})
+    return shard_state
+
+
+# シャードの取得済みのページを読み込み、前の取得の記録だった場合は手元のセグメントも削除して始め直す
+def open_shard(crawl_dir, shard, state):
+    shard_state = read_shard_state(crawl_dir, shard, state)
+    if not shard_state['hydrated']:
+        shutil.rmtree(shard_dir(crawl_dir, shard), ignore_errors=True)
+    return shard_state
+
+
+def write_shard_state(crawl_dir, shard, shard_state):
+    _write_json(shard_state_path(crawl_dir, shard), shard_state)
+
+
+# シャードが担当するページ（ページ番号をシャード数で割った余りで分ける）
+def shard_pages(pages, shard, shards):
+    return [page for page in range(pages) if page % shards == shard]
+
+
+# シャードがまだユーザー情報を取得していないページ（IDを取得済みのページのうち）
+def pending_pages(state, shard_state, shard, shards):
+    done = set(shard_state['hydrated'])
+    return [page for page in shard_pages(state['pages'], shard, shards) if page not in done]
+
+
+# ユーザー情報の取得に失敗したIDが残っているページ
+def failed_pages(shard_state):
+    return sorted(int(page) for page in shard_state['failed'])
+
+
+def failed_ids(shard_state, page):
+    return np.asarray(shard_state['failed'][str(page)], dtype='int64')
+
+
+# 1ページ分のユーザー情報を保存して、取得済みにする（追加したセグメント名を返す）
+# failedは取得に失敗したID。ページは取得済みにして、失敗したIDだけを後で取得し直す（取得し直して保存すると置き換わる）
+# 同じページを2回保存した場合(保存後に止まってやり直した場合)は、読み込む時に重複を除く
+def save_users(crawl_dir, shard, shard_state, page, df, fmt=PARQUET, failed=()):
+    name = append_segment(shard_dir(crawl_dir, shard), df, FOLLOWERS_SCHEMA, fmt)
+    shard_state['hydrated'] = sorted(set(shard_state['hydrated']) | {page})
+    if len(failed):
+        shard_state['failed'][str(page)] = [int(user_id) for user_id in failed]
+    else:
+        shard_state['failed'].pop(str(page), None)
+    write_shard_state(crawl_dir, shard, shard_state)
+    return name
+
+
+# すべてのページのIDを取得し、すべてのシャードがユーザー情報を(失敗したIDも含めて)取得し終えたかどうか
+def is_complete(crawl_dir, state, shards):
+    if not state['listed']:
+        return False
+    for shard in range(shards):
+        shard_state = read_shard_state(crawl_dir, shard, state)
+        if pending_pages(state, shard_state, shard, shards) or shard_state['failed']:
+            return False
+    return True
+
+
+# すべてのシャードのユーザー情報を、followers_idsの並び順(新しい順)で1つのDataFrameにする
+def read_users(crawl_dir, state, shards):
+    frames = [read_log(shard_dir(crawl_dir, shard), FOLLOWERS_SCHEMA) for shard in range(shards)]
+    users = pd.concat(frames, ignore_index=True).drop_duplicates('user_id', keep='last')
+    order = pd.Index(pd.unique(listed_ids(crawl_dir, state))).get_indexer(users['user_id'])
+    users, order = users[order >= 0], order[order >= 0] # 今回のIDのページに無い行(前の取得の残り)は除く
+    return users.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+
+
+# 保存先と同期するファイル（crawl_dirからの相対パス）
+def state_files(shards):
+    files = [STATE_NAME]
+    for shard in range(shards):
+        files.append(os.path.join(os.path.basename(shard_dir('', shard)), SHARD_STATE_NAME))
+        files.append(os.path.join(os.path.basename(shard_dir('', shard)), MANIFEST_NAME))
+    return files
+
+
+# 読み込みに必要なファイル（IDのページとシャードのセグメント、crawl_dirからの相対パス）
+def data_files(crawl_dir, state, shards):
+    files = [ids_name(page) for page in range(state['pages'])]
+    for shard in range(shards):
+        manifest = read_manifest(shard_dir(crawl_dir, shard))
+        files.extend(os.path.join(os.path.basename(shard_dir('', shard)), seg['name']) for seg in manifest['segments'])
+    return files
+
+
+# 取得が終わった後に、手元のファイルを削除
+def clear(crawl_dir):
+    shutil.rmtree(crawl_dir, ignore_errors=True)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+フォロワーごとの「フォロワー数」「フォロー数」の履歴を、前回からの差分(デルタ)と定期的な全件(キーフレーム)で保存します。
+followers_data_save.py が毎回、全フォロワーの現在の値を渡し、変わったフォロワーの分だけを記録します。
+・keyframes/: KEYFRAME_INTERVAL ごとの全フォロワーの値（セグメント、segment_log.py）
+・deltas/: キーフレームの間の変化（値は前回との差、フォロー解除は値を0に戻す行）
+・state.parquet: 最新の状態（次の差分の計算用）
+ある時刻の状態は、その時刻以前の最新のキーフレームに、そこからの差分を足して作ります。
+ダッシュボードは history_segments で期間の読み込みに必要なセグメントだけをダウンロードし、
+state_as_of(期間の終わりの状態)と follower_series(フォロワーごとの推移)を表示します。
+"""
+
+# 必要なモジュールのインポート
+import os
+from datetime import timedelta
+
+import pandas as pd
+import pyarrow as pa
+
+from data_format import PARQUET, with_format, coerce, read_table, write_table
+from segment_log import read_manifest, read_log, append_segment, select_segments
+
+
+# 履歴のスキーマ（キーフレームは値そのもの、差分は前回との差を folowers_count / friends_count に入れる）
+SNAPSHOT_SCHEMA = pa.schema([
+    ('save_time', pa.timestamp('us')),
+    ('user_id', pa.int64()),
+    ('kind', pa.int8()),
+    ('folowers_count', pa.int64()),
+    ('friends_count', pa.int64()),
+], metadata={'partition_column': 'save_time'})
+
+# 最新の状態のスキーマ
+STATE_SCHEMA = pa.schema([
+    ('user_id', pa.int64()),
+    ('folowers_count', pa.int64()),
+    ('friends_count', pa.int64()),
+])
+
+# 記録する値
+METRICS = ['folowers_count', 'friends_count']
+
+# 行の種類（キーフレーム、差分、フォロー解除）
+KEYFRAME = 0
+DELTA = 1
+REMOVED = 2
+
+# キーフレームを保存する間隔（この間隔より前のキーフレームしか無ければ、次はキーフレームを保存）
+KEYFRAME_INTERVAL = timedelta(days=7)
+
+# 期間を片側だけ指定する時に使う、データより前・後の時刻
+EPOCH = pd.Timestamp('1970-01-01')
+FAR_FUTURE = pd.Timestamp('2200-01-01')
+
+# フォルダ・ファイル名
+KEYFRAMES = 'keyframes'
+DELTAS = 'deltas'
+STATE_NAME = os.path.basename(with_format('state', PARQUET))
+
+
+def keyframes_dir(snapshot_dir):
+    return os.path.join(snapshot_dir, KEYFRAMES)
+
+
+def deltas_dir(snapshot_dir):
+    return os.path.join(snapshot_dir, DELTAS)
+
+
+def state_path(snapshot_dir):
+    return os.path.join(snapshot_dir, STATE_NAME)
+
+
+# スキーマの列だけを持つ空のDataFrame
+def empty_frame(schema):
+    return pd.DataFrame({field.name: pd.Series(dtype=field.type.to_pandas_dtype()) for field in schema})
+
+
+# 最新の状態を読み込み（無い場合は空）
+def read_state(snapshot_dir):
+    path = state_path(snapshot_dir)
+    if not os.path.isfile(path):
+        return empty_frame(STATE_SCHEMA)
+    return read_table(path, STATE_SCHEMA)
+
+
+# 最後のキーフレームの時刻（無い場合はNone）
+def last_keyframe_time(snapshot_dir):
+    segments = read_manifest(keyframes_dir(snapshot_dir))['segments']
+    if not segments:
+        return None
+    return max(pd.Timestamp(seg['max_time']) for seg in segments)
+
+
+# 今回キーフレームを保存するかどうか
+def needs_keyframe(snapshot_dir, save_time, interval=KEYFRAME_INTERVAL):
+    last = last_keyframe_time(snapshot_dir)
+    return last is None or pd.Timestamp(save_time) - last >= interval
+
+
+# 前回の状態と今回の値の差分（変わったフォロワー・新しいフォロワーは差、フォロー解除は値を0に戻す差）
+# 今回の値が無いフォロワー(凍結などで取得できなかった)は変化なしとみなす
+def diff_state(state, current, removed_ids=()):
+    previous = state.set_index('user_id')[METRICS]
+    current = current.set_index('user_id')[METRICS]
+    current = current[~current.index.isin(removed_ids)]
+    before = previous.reindex(current.index, fill_value=0)
+    delta = current - before
+    changed = (delta != 0).any(axis=1) | ~current.index.isin(previous.index)
+    delta = delta[changed].assign(kind=DELTA)
+    removed = previous[previous.index.isin(removed_ids)]
+    removed = (-removed).assign(kind=REMOVED)
+    rows = pd.concat([delta, removed]).rename_axis('user_id').reset_index()
+    return rows[['user_id', 'kind'] + METRICS]
+
+
+# 今回の値とフォロー解除を反映した状態
+def apply_state(state, current, removed_ids=()):
+    current = current[~current['user_id'].isin(removed_ids)]
+    state = state[~state['user_id'].isin(current['user_id']) & ~state['user_id'].isin(removed_ids)]
+    return pd.concat([state, current[STATE_SCHEMA.names]], ignore_index=True).sort_values('user_id', ignore_index=True)
+
+
+# 今回の値(user_id, folowers_count, friends_count)を記録して、追加したセグメント名を返す
+# 戻り値は (キーフレームのセグメント名, 差分のセグメント名)（保存しなかった方はNone）
+def record(snapshot_dir, current, save_time, removed_ids=(), fmt=PARQUET):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    current = coerce(current, STATE_SCHEMA).drop_duplicates('user_id', keep='last')
+    state = read_state(snapshot_dir)
+    new_state = apply_state(state, current, removed_ids)
+    keyframe = delta = None
+    if needs_keyframe(snapshot_dir, save_time):
+        rows = new_state.assign(kind=KEYFRAME)
+        keyframe = append_segment(keyframes_dir(snapshot_dir), rows.assign(save_time=save_time),
+                                  SNAPSHOT_SCHEMA, fmt)
+    else:
+        rows = diff_state(state, current, removed_ids)
+        delta = append_segment(deltas_dir(snapshot_dir), rows.assign(save_time=save_time),
+                               SNAPSHOT_SCHEMA, fmt)
+    write_table(new_state, state_path(snapshot_dir), STATE_SCHEMA)
+    return keyframe, delta
+
+
+# 時刻t以前の最新のキーフレームの時刻（無い場合はNone）
+# キーフレームは時刻順に並んでいるので、最小の時刻がt以前のセグメントのうち最後のものだけを読む
+def keyframe_time_before(snapshot_dir, t):
+    t = pd.Timestamp(t)
+    log_dir = keyframes_dir(snapshot_dir)
+    manifest = read_manifest(log_dir)
+    candidates = [seg for seg in manifest['segments'] if pd.Timestamp(seg['min_time']) <= t]
+    if not candidates:
+        return None
+    seg = max(candidates, key=lambda seg: seg['min_time'])
+    times = read_log(log_dir, SNAPSHOT_SCHEMA, columns=['save_time'],
+                     manifest={'segments': [seg]}, time_range=(seg['min_time'], t))['save_time']
+    return times.max() if len(times) > 0 else None
+
+
+# 期間(start, end)の state_as_of・follower_series が読むセグメント名 {KEYFRAMES: [...], DELTAS: [...]}
+# start以前の最新のキーフレームのセグメントから end までを選ぶ（ダッシュボードはこれだけをダウンロードする）
+def history_segments(snapshot_dir, start, end):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    keyframes = read_manifest(keyframes_dir(snapshot_dir))
+    before = [pd.Timestamp(seg['min_time']) for seg in keyframes['segments'] if pd.Timestamp(seg['min_time']) <= start]
+    first = max(before) if before else EPOCH
+    return {
+        KEYFRAMES: [seg['name'] for seg in select_segments(keyframes, (first, end))],
+        DELTAS: [seg['name'] for seg in select_segments(read_manifest(deltas_dir(snapshot_dir)), (first, end))],
+    }
+
+
+# キーフレームと差分を時刻順に読み込む
+# startを指定すると、start以前の最新のキーフレームから読み込む（それ以前の履歴は読まない）
+def read_history(snapshot_dir, start=None, end=None):
+    keyframe_time = keyframe_time_before(snapshot_dir, start) if start is not None else None
+    time_range = None
+    if keyframe_time is not None or end is not None:
+        time_range = (keyframe_time if keyframe_time is not None else EPOCH,
+                      end if end is not None else FAR_FUTURE)
+    keyframes = read_log(keyframes_dir(snapshot_dir), SNAPSHOT_SCHEMA, time_range=time_range)
+    deltas = read_log(deltas_dir(snapshot_dir), SNAPSHOT_SCHEMA, time_range=time_range)
+    rows = pd.concat([keyframes, deltas], ignore_index=True)
+    return rows.sort_values(['save_time', 'kind'], kind='mergesort', ignore_index=True)
+
+
+# 差分を足し合わせて値にする（フォロワーごとに、キーフレームの行で値をリセット）
+def accumulate(rows):
+    epoch = (rows['kind'] == KEYFRAME).astype('int64').groupby(rows['user_id']).cumsum()
+    values = rows[METRICS].groupby([rows['user_id'], epoch]).cumsum()
+    return rows[['save_time', 'user_id', 'kind']].join(values)
+
+
+# 時刻tの状態（その時点のフォロワーごとの「フォロワー数」「フォロー数」）
+# t以前の最新のキーフレームと、そこからtまでの差分だけを読む
+def state_as_of(snapshot_dir, t):
+    t = pd.Timestamp(t)
+    keyframe_time = keyframe_time_before(snapshot_dir, t)
+    if keyframe_time is None:
+        keyframes = empty_frame(SNAPSHOT_SCHEMA)
+        deltas = read_log(deltas_dir(snapshot_dir), SNAPSHOT_SCHEMA, time_range=(EPOCH, t))
+    else:
+        keyframes = read_log(keyframes_dir(snapshot_dir), SNAPSHOT_SCHEMA, time_range=(keyframe_time, keyframe_time))
+        deltas = read_log(deltas_dir(snapshot_dir), SNAPSHOT_SCHEMA, time_range=(keyframe_time, t))
+        deltas = deltas[deltas['save_time'] > keyframe_time]
+    rows = pd.concat([keyframes, deltas], ignore_index=True).sort_values('save_time', kind='mergesort')
+    grouped = rows.groupby('user_id')
+    state = grouped[METRICS].sum()
+    state = state[grouped['kind'].last() != REMOVED]
+    return state.reset_index()[STATE_SCHEMA.names]
+
+
+# フォロワーごとの値の推移（値が変わった時点とキーフレームの時点、フォロー解除した時点は含めない）
+# user_idsを省略すると全フォロワー、time_range=(開始, 終了)で期間を指定
+def follower_series(snapshot_dir, user_ids=None, time_range=None):
+    start, end = time_range if time_range is not None else (None, None)
+    rows = read_history(snapshot_dir, start, end)
+    if user_ids is not None:
+        rows = rows[rows['user_id'].isin(user_ids)].reset_index(drop=True)
+    series = accumulate(rows)
+    series = series[series['kind'] != REMOVED]
+    if start is not None:
+        series = series[series['save_time'] >= pd.Timestamp(start)]
+    return series[['save_time', 'user_id'] + METRICS].reset_index(drop=True)
@@ -1,19 +1,32 @@
 #!/usr/bin/env python3
 
 """
-Twitter APIからフォロワーに関するデータを分析用に取得して、定期的にcsvファイルに保存します。
+Twitter APIからフォロワーに関するデータを分析用に取得して、定期的にParquetファイル(追記専用のセグメント)に保存します。
 （ID、スクリーン名、フォロワー数、フォロー数、ユーザー名、場所、URL、プロフィール）
 [Google Cloud Platform]の[Cloud Functions]にデプロイして、[Cloud Scheduler]で定期実行します。
-[Storge]にcsvを更新して保存します。
+[Storge]には毎回、新しいフォロワーだけのセグメントとマニフェストをアップロードします。
+フォロワーが多く1回の実行で取得しきれない場合は、ページごとに途中まで保存して次の実行で続きから取得します(follower_crawl.py)。
 """
 
 # 必要なモジュールのインポート
 import tweepy
 from datetime import datetime, timedelta
 import os
-import csv
+import time
+import numpy as np
 import pandas as pd
-from google.cloud import storage
+
+from data_format import FOLLOWERS_SCHEMA, PARQUET, with_format, read_table
+from request_scheduler import RequestScheduler
+from segment_log import MANIFEST_NAME, manifest_path, segment_path, read_manifest, append_segment, read_log, \
+    upload_segments
+from object_store import open_store
+from instrumentation import Tracer
+import fake_twitter
+import rollups
+import follower_snapshots
+import follower_crawl
+import keyword_rank
 
 
 # Twitterアカウント名(@含まず、＠以降)、各種ツイッターのキーを入力
@@ -23,6 +36,17 @@ def input_twitter_info():
     global CONSUMER_SECRET
     global ACCESS_KEY
     global ACCESS_SECRET
+    # 複数アカウントの実行(multi_account.py)では、指定されたアカウントと認証情報を使う
+    if ACCOUNT is not None:
+        screen_name = ACCOUNT['screen_name']
+        CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET = (
+            ACCOUNT.get(key) for key in ('consumer_key', 'consumer_secret', 'access_key', 'access_secret'))
+        return screen_name, CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET
+    # 疑似APIを使う場合は入力しない
+    if FAKE_API is not None:
+        screen_name = FAKE_SCREEN_NAME
+        CONSUMER_KEY = CONSUMER_SECRET = ACCESS_KEY = ACCESS_SECRET = None
+        return screen_name, CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET
     while True:
         screen_name = input('Twitterアカウント名(@含まず、@以降)を入力して下さい: ') # Twitterアカウント名を入力
         CONSUMER_KEY = input('TwitterAPIのCONSUMER_KEYを入力して下さい: ') # TwitterAPIのキーが必要
@@ -35,6 +59,24 @@ def input_twitter_info():
     return screen_name, CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET
 
 
+# Twitter APIの代わりにローカルの疑似API(fake_twitter.py)を使う場合に指定（Noneなら本物のAPI）
+# 'synthetic' または 'synthetic:followers=20000,tweets=3200' で疑似アカウント、ファイルのパスで記録したレスポンスを再生
+FAKE_API = None
+FAKE_SCREEN_NAME = 'fake_account'  # 記録したレスポンスを再生する場合は、記録したアカウント名
+
+# 疑似APIの遅延とレート制限の時間枠を縮める倍率（0.01なら15分の時間枠が9秒）
+FAKE_TIME_SCALE = 1.0
+
+# 複数アカウントの実行(multi_account.py)で指定する、アカウント名と認証情報の辞書（Noneなら入力する）
+ACCOUNT = None
+
+# 同じ認証情報を使う他のアカウントと共有する、エンドポイントごとのトークンバケット（multi_account.pyで指定）
+# Noneならこの実行だけでレート制限を数える
+RATE_BUCKETS = None
+
+# 本物のAPIのレスポンスを記録するファイル（Noneなら記録しない、記録したファイルはFAKE_APIで再生できる）
+RECORD_FIXTURE = None
+
 # 現在時刻
 now_time = datetime.now() + timedelta(hours=9)
 
@@ -42,113 +84,520 @@ now_time = datetime.now() + timedelta(hours=9)
 # OAuth認証
 def authTwitter():
     global api
+    global scheduler
+    # 疑似APIの場合は、時間枠を縮めた分だけスケジューラーの時間枠も縮める
+    if FAKE_API is not None:
+        api = fake_twitter.open_api(FAKE_API, FAKE_TIME_SCALE)
+        scheduler = RequestScheduler(window=api.window, buckets=RATE_BUCKETS)
+        return api
     auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
     auth.set_access_token(ACCESS_KEY, ACCESS_SECRET)
-    #APIインスタンスを作成、レート制限が補充されるまで待機
-    api = tweepy.API(auth, wait_on_rate_limit = True)
+    #APIインスタンスを作成、レート制限の待機はスケジューラーで行う（待っている間も他のエンドポイントは実行）
+    api = tweepy.API(auth)
+    if RECORD_FIXTURE is not None:
+        api = fake_twitter.Recorder(api, RECORD_FIXTURE)
+    scheduler = RequestScheduler(buckets=RATE_BUCKETS)
     return api
 
-# データ保存用のファイルパス
-FILE_PATH = '/tmp/followers.csv'
+# 保存フォーマット(parquet または arrow)
+DATA_FORMAT = PARQUET
+
+# データ保存用のフォルダ（セグメントとマニフェストを置く）
+LOG_DIR = '/tmp/followers'
+
+# Storageでのセグメントとマニフェストの保存先
+LOG_PREFIX = 'followers/'
+
+# 以前の1ファイル形式のパス（初回にセグメントへ移行するためだけに読み込む）
+LEGACY_FILE_PATH = with_format('/tmp/followers', PARQUET)
+CSV_PATH = '/tmp/followers.csv'
+
+# フォロワーIDインデックス（現在のフォロワーIDをソートしたint64配列）のファイルパス
+ID_INDEX_PATH = '/tmp/followers_ids.npy'
+
+# フォロー解除したユーザーを記録するファイルパス
+UNFOLLOWERS_PATH = '/tmp/unfollowers.csv'
+
+# ダッシュボード用の集計結果(ロールアップ)を置くフォルダとStorageでの保存先
+ROLLUP_DIR = '/tmp/rollups'
+ROLLUP_PREFIX = 'rollups/'
+
+# フォロワーごとの値の履歴(差分とキーフレーム)を置くフォルダとStorageでの保存先
+SNAPSHOT_DIR = '/tmp/follower_snapshots'
+SNAPSHOT_PREFIX = 'follower_snapshots/'
+
+# 既存のフォロワーのユーザー情報も毎回取得して、フォロワー数・フォロー数の変化を記録する場合はTrue
+# (users/lookupのリクエスト数がフォロワー数÷100回になります)
+REFRESH_METRICS = True
+
+# プロフィール欄の頻出ワードの分かち書きの方法（'auto'はMeCabがあればMeCab、無ければ正規表現。keyword_rank.py）
+KEYWORD_TOKENIZER = 'auto'
+
+# 途中から再開できるフォロワーの取得(follower_crawl.py)の作業用フォルダとStorageでの保存先
+CRAWL_DIR = '/tmp/followers_crawl'
+CRAWL_PREFIX = 'followers_crawl/'
+
+# 1回の実行で取得を続ける時間（Cloud Functionsのタイムアウトより短くする。残りは次の実行で続きから取得）
+CRAWL_TIME_BUDGET = timedelta(minutes=7)
+
+# ユーザー情報を取得する担当(シャード)の数
+# 2以上にすると、属性の無い実行はIDの取得と最後の保存だけを行い、ユーザー情報は
+# Pub/Subのメッセージに属性 shard=0, 1, ... を付けた別の実行が、それぞれ担当するページを並行して取得する
+CRAWL_SHARDS = 1
+
+# Storageのバケット名
+BUCKET_NAME = 'ストレージのバケット名を指定'
+
+# 保存先（ローカルのフォルダを指定すると、Storageを使わずに動かせます）
+STORAGE_URL = 'gs://' + BUCKET_NAME
+
+# 段階ごとの計測結果をPrometheusのテキスト形式で保存するファイル（Noneなら保存せず、JSONのログだけ出力）
+METRICS_FILE = None
 
-# ファイルが存在するかどうか確認
+# 保存先を開く（クライアントは使い回し、変わっていないファイルはダウンロード・アップロードしない）
+def open_storage():
+    global store
+    store = open_store(STORAGE_URL, writable=True)
+    return store
+
+# セグメントが存在するかどうか確認
 def is_file():
     global file_check
-    file_check = os.path.isfile(FILE_PATH)
+    global manifest
+    manifest = read_manifest(LOG_DIR)
+    file_check = len(manifest['segments']) > 0
     return file_check
 
-# ファイルをpandas読み取り
-def read_csv():
-    global df
+
+# 以前の1ファイル形式(parquet/csv)のデータがあれば、最初のセグメントとして取り込む
+def migrate_legacy_file():
+    global file_check
     if file_check:
-        df = pd.read_csv(FILE_PATH)
-        return df
+        return
+    store.download_if_exists(os.path.basename(LEGACY_FILE_PATH), LEGACY_FILE_PATH)
+    if not os.path.isfile(LEGACY_FILE_PATH):
+        store.download_if_exists(os.path.basename(CSV_PATH), CSV_PATH)
+    for path in (LEGACY_FILE_PATH, CSV_PATH):
+        if os.path.isfile(path):
+            name = append_segment(LOG_DIR, read_table(path, FOLLOWERS_SCHEMA), FOLLOWERS_SCHEMA,
+                                  DATA_FORMAT, manifest)
+            if name is not None:
+                upload_segments(store, LOG_DIR, LOG_PREFIX, [name])
+                file_check = True
+                print('[{}をセグメントに移行しました]'.format(path))
+            break
+
+
+# 保存済みのセグメントをすべてダウンロード（IDインデックスやロールアップが無い時だけ使う）
+def download_segments():
+    for seg in manifest['segments']:
+        path = segment_path(LOG_DIR, seg['name'])
+        if not os.path.isfile(path):
+            store.download(LOG_PREFIX + seg['name'], path)
+
+
+# 保存済みの全フォロワーのuser_idを読み込み（IDインデックスが無い時だけ使う）
+def read_user_ids():
+    download_segments()
+    return read_log(LOG_DIR, FOLLOWERS_SCHEMA, columns=['user_id'], manifest=manifest)['user_id']
+
+
+# フォロワーIDインデックスを読み込み
+# インデックスがまだ無い場合は、既存のデータのuser_idから作成する
+def read_id_index():
+    global id_index
+    global index_check
+    index_check = os.path.isfile(ID_INDEX_PATH)
+    if index_check:
+        id_index = np.load(ID_INDEX_PATH)
+    elif file_check:
+        id_index = np.unique(read_user_ids().to_numpy(dtype='int64'))
+    else:
+        id_index = np.empty(0, dtype='int64')
+    return id_index
 
 
-# フォロワー情報を入れる空のリストを用意
-user_infos = []
+# idsのうちソート済みのindexに含まれるものをTrueにした配列を返す（二分探索なので履歴の件数に比例しない）
+def in_id_index(ids, index):
+    if index.size == 0:
+        return np.zeros(ids.shape, dtype=bool)
+    pos = np.searchsorted(index, ids)
+    pos[pos == index.size] = 0
+    return index[pos] == ids
+
+
+# 今回の新しいフォロワーの情報（取得が終わった時にfollower_crawlから読み込む）
+user_infos = pd.DataFrame(columns=FOLLOWERS_SCHEMA.names)
+
+# 今回ユーザー情報を取得したフォロワー全員の情報（REFRESH_METRICSがFalseの場合は新しいフォロワーだけ）
+metric_infos = pd.DataFrame(columns=FOLLOWERS_SCHEMA.names)
+
+# ユーザー情報の一括取得(users/lookup)は1リクエストあたり最大100件
+LOOKUP_BATCH_SIZE = 100
+
+
+# ユーザー情報を保存用の1行に変換（FOLLOWERS_SCHEMAの列順と同じ）
+def to_user_info(user):
+    return [now_time, user.id_str, user.screen_name, user.followers_count, user.friends_count,
+            user.name, user.location, user.url, user.description]
+
+
+# ユーザー情報のリストをDataFrameに変換
+def users_frame(infos):
+    return pd.DataFrame(data=infos, columns=FOLLOWERS_SCHEMA.names)
+
+
+# followers_idsを1ページ取得して、(IDのリスト, 次のカーソル)を返す
+def fetch_follower_id_page(cursor):
+    while True:
+        try:
+            follower_ids, (_, next_cursor) = scheduler.call('followers/ids', api.followers_ids,
+                                                            id=screen_name, cursor=cursor)
+        except ConnectionError as e:
+            print(e)
+            continue # 同じカーソルで再取得
+        return follower_ids, next_cursor
+
+
+# 1回分のusers/lookupを実行して、(ユーザー情報のリスト, かかった秒数)を返す
+def lookup_batch(batch):
+    start = time.perf_counter()
+    users = api.lookup_users(user_ids=batch)
+    return users, time.perf_counter() - start
+
+
+# users/lookupのエラーコード: 指定したIDのユーザーが1人もいない（全員が凍結・削除済み）
+NO_USER_MATCHES = 17
+
+
+# フォロワーIDを100件ずつまとめてユーザー情報に変換（1件ずつget_userを呼ばない）
+# 各まとまりはスケジューラーで並行して実行する。(ユーザー情報のリスト, 取得に失敗したIDのリスト)を返す
+def hydrate_users(follower_ids):
+    infos = []
+    failed = []
+    batches = [follower_ids[i:i + LOOKUP_BATCH_SIZE] for i in range(0, len(follower_ids), LOOKUP_BATCH_SIZE)]
+    futures = [scheduler.submit('users/lookup', lookup_batch, batch) for batch in batches]
+    for batch, future in zip(batches, futures):
+        try:
+            users, elapsed = future.result()
+        except tweepy.error.TweepError as e:
+            if e.api_code != NO_USER_MATCHES:
+                print(e.reason)
+                failed.extend(batch) # 次の実行で取得し直す
+                continue
+            users, elapsed = [], 0.0
+        print('[lookup_users] {}/{}件 {:.2f}秒'.format(len(users), len(batch), elapsed))
+        # lookup_usersの戻り値は順不同なので、followers_idsの並び順（新しい順）に戻す
+        users_by_id = {user.id: user for user in users}
+        for follower_id in batch:
+            user = users_by_id.get(follower_id)
+            if user is not None: # 凍結・削除済みのアカウントは返ってこない
+                infos.append(to_user_info(user))
+    return infos, failed
+
+
+# ---- 途中から再開できる取得（follower_crawl.py） ----
+
+# 取得用のファイルをダウンロード（状態のファイルは毎回、IDのページとセグメントは手元に無い時だけ）
+def crawl_download(names, always=False):
+    for name in names:
+        path = os.path.join(CRAWL_DIR, name)
+        if always or not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            store.download_if_exists(CRAWL_PREFIX + name, path)
+
+
+# 取得用のファイルをアップロード（ページごとに、データのファイルを先に、状態のファイルを後に）
+def crawl_upload(names):
+    for name in names:
+        store.upload(os.path.join(CRAWL_DIR, name), CRAWL_PREFIX + name)
+
+
+# Pub/Subのメッセージの属性 shard（ユーザー情報を取得する担当）。無い場合はNone（IDの取得と最後の保存を行う実行）
+def event_shard(event):
+    if CRAWL_SHARDS == 1 or not isinstance(event, dict):
+        return None
+    shard = (event.get('attributes') or {}).get('shard')
+    return None if shard is None else int(shard)
+
+
+# 取得の状態を読み込み（途中の取得が無ければ新しく始める）
+# ユーザー情報の保存日時は、何回かの実行に分かれても取得を始めた日時にそろえる
+def read_crawl_state(hydrate_shard):
+    global crawl_state
+    global shard_state
+    global now_time
+    crawl_download(follower_crawl.state_files(CRAWL_SHARDS), always=True)
+    crawl_state = follower_crawl.read_state(CRAWL_DIR)
+    if crawl_state is None:
+        crawl_state = follower_crawl.new_state(now_time)
+    now_time = follower_crawl.started_at(crawl_state)
+    shard_state = None
+    if hydrate_shard is not None:
+        shard_state = follower_crawl.open_shard(CRAWL_DIR, hydrate_shard, crawl_state)
+    return crawl_state
+
+
+# followers_idsの次のページを取得して保存（すぐに次の実行が続きから取得できるようにアップロード）
+def crawl_id_page():
+    follower_ids, next_cursor = fetch_follower_id_page(crawl_state['cursor'])
+    page = follower_crawl.save_page(CRAWL_DIR, crawl_state, follower_ids, next_cursor)
+    crawl_upload([follower_crawl.ids_name(page), follower_crawl.STATE_NAME])
+    print('[フォロワーID {}ページ目: {}件]'.format(page + 1, len(follower_ids)))
+
+
+# 1ページ分のユーザー情報を取得して保存（新しいフォロワー、REFRESH_METRICSがTrueならページ全員）
+# idsを指定した場合は、そのID(前に取得に失敗したID)だけを取得し直す
+def crawl_users_page(shard, page, ids=None):
+    if ids is None:
+        crawl_download([follower_crawl.ids_name(page)])
+        ids = follower_crawl.load_page(CRAWL_DIR, page)
+        if not REFRESH_METRICS:
+            ids = ids[~in_id_index(ids, id_index)]
+    users, failed = hydrate_users(ids.tolist())
+    infos = users_frame(users)
+    if failed:
+        print('[{}ページ目: ユーザー情報の取得に失敗した{}件を後で取得し直します]'.format(page + 1, len(failed)))
+    name = follower_crawl.save_users(CRAWL_DIR, shard, shard_state, page, infos, DATA_FORMAT, failed)
+    shard_name = os.path.basename(follower_crawl.shard_dir(CRAWL_DIR, shard))
+    names = [] if name is None else [os.path.join(shard_name, name)]
+    crawl_upload(names + [os.path.join(shard_name, MANIFEST_NAME),
+                          os.path.join(shard_name, follower_crawl.SHARD_STATE_NAME)])
+    return len(infos)
+
+
+# 制限時間内に終わらないリクエストは次の実行に回す
+def within_budget(deadline, endpoint):
+    return time.monotonic() + scheduler.wait_time(endpoint) < deadline
+
+
+# 制限時間まで、取得していないページのユーザー情報の取得とfollowers_idsのページ送りを続ける
+# 取得に失敗したIDは、1回の実行でページごとに1回だけ取得し直す（続けて失敗する場合は次の実行に回す）
+# shardがNoneの実行はIDを取得し、CRAWL_SHARDSが1ならユーザー情報も同じ実行で取得する（担当0）
+def crawl(shard, hydrate_shard, deadline):
+    global fetched_rows
+    fetched_rows = 0
+    refreshed = False
+    retried = set()
+    while True:
+        if hydrate_shard is not None:
+            pending = follower_crawl.pending_pages(crawl_state, shard_state, hydrate_shard, CRAWL_SHARDS)
+            retry = [page for page in follower_crawl.failed_pages(shard_state) if page not in retried]
+            if pending or retry:
+                if not within_budget(deadline, 'users/lookup'):
+                    break
+                if pending:
+                    fetched_rows += crawl_users_page(hydrate_shard, pending[0])
+                else:
+                    retried.add(retry[0])
+                    fetched_rows += crawl_users_page(hydrate_shard, retry[0],
+                                                     follower_crawl.failed_ids(shard_state, retry[0]))
+                continue
+        if crawl_state['listed']:
+            break
+        if shard is None:
+            if not within_budget(deadline, 'followers/ids'):
+                break
+            crawl_id_page()
+        elif refreshed:
+            break # 取得済みのIDのページは全部取得したので、次の実行でIDの続きを取得する
+        else:
+            # 別の実行が取得したIDのページを確認
+            crawl_download([follower_crawl.STATE_NAME], always=True)
+            crawl_state.update(follower_crawl.read_state(CRAWL_DIR) or {})
+            refreshed = True
+    return fetched_rows
 
 
 #設定したTwitterアカウントのフォロワー情報を取得（ID、スクリーン名、フォロワー数、フォロー数、ユーザー名、場所、URL、プロフィール）
-def get_data():
+# followers_idsのページとユーザー情報はページごとに保存し、制限時間(CRAWL_TIME_BUDGET)を過ぎたら次の実行で続きから取得する
+# すべて取得し終えたら、followers_idsのIDだけでインデックスと差分を取り、新しいフォロワーだけをフォロワーのデータに追加
+# REFRESH_METRICSがTrueなら既存のフォロワーのユーザー情報も取得して、フォロワー数・フォロー数の履歴に使う
+def get_data(shard=None):
     global user_infos
-    cursor = -1
-    if not file_check:
-        while cursor != 0:
-            itr = tweepy.Cursor(api.followers_ids, id=screen_name, cursor=cursor).pages()
-            try:
-                for follower_id in itr.next():
-                    try:
-                        user = api.get_user(follower_id)
-                        user_info = [now_time, user.id_str, user.screen_name, user.followers_count, user.friends_count,
-                                     user.name, user.location, user.url, user.description]
-                        print(user.screen_name)
-                        user_infos.append(user_info)
-                    except tweepy.error.TweepError as e:
-                        print(e.reason)
-            except ConnectionError as e:
-              print(e.reason)
-            cursor = itr.next_cursor
-    # ファイルに重複がないデータのみリストに追加
+    global metric_infos
+    global id_index
+    global unfollower_ids
+    global crawl_complete
+    deadline = time.monotonic() + CRAWL_TIME_BUDGET.total_seconds()
+    hydrate_shard = 0 if shard is None and CRAWL_SHARDS == 1 else shard
+    read_crawl_state(hydrate_shard)
+    crawl(shard, hydrate_shard, deadline)
+    crawl_complete = shard is None and follower_crawl.is_complete(CRAWL_DIR, crawl_state, CRAWL_SHARDS)
+    if not crawl_complete:
+        print('[取得の途中です: フォロワーID {}ページ, ユーザー情報 {}件 (次の実行で続きから取得します)]'.format(
+            crawl_state['pages'], fetched_rows))
+        return user_infos
+    crawl_download(follower_crawl.data_files(CRAWL_DIR, crawl_state, CRAWL_SHARDS))
+    current_ids = np.unique(follower_crawl.listed_ids(CRAWL_DIR, crawl_state))
+    metric_infos = follower_crawl.read_users(CRAWL_DIR, crawl_state, CRAWL_SHARDS)
+    is_new = ~in_id_index(metric_infos['user_id'].to_numpy(dtype='int64'), id_index)
+    user_infos = metric_infos[is_new].reset_index(drop=True)
+    # インデックスにあって今回のフォロワーにないIDはフォロー解除
+    # (インデックスを既存のデータから作成した初回は、過去の解除分が混ざるので記録しない)
+    if index_check:
+        unfollower_ids = np.setdiff1d(id_index, current_ids, assume_unique=True)
     else:
-        for follower_id in tweepy.Cursor(api.followers_ids, id=screen_name, cursor=cursor).items(100):
-            user = api.get_user(follower_id)
-            user_info = [now_time, user.id_str, user.screen_name, user.followers_count, user.friends_count,
-                         user.name, user.location, user.url, user.description]
-            # user_idがファイルに存在するかどうか判定
-            if not str(user.id_str) in list(df['user_id']):
-                print(user.screen_name)
-                user_infos.append(user_info)
+        unfollower_ids = np.empty(0, dtype='int64')
+    # インデックスには、今回のフォロワーのうち既にインデックスにあるIDと、ユーザー情報を取得できたIDだけを入れる
+    # (users/lookupが失敗したIDは入れずに、次回の取得で新しいフォロワーとしてもう一度取得する)
+    hydrated_ids = metric_infos['user_id'].to_numpy(dtype='int64')
+    id_index = np.union1d(np.intersect1d(id_index, current_ids, assume_unique=True),
+                          hydrated_ids[in_id_index(hydrated_ids, current_ids)])
+    print('[新規フォロワー: {}件 フォロー解除: {}件]'.format(len(user_infos), len(unfollower_ids)))
     print("[処理が完了しました]")
     return user_infos
 
 
-# フォロワー情報のリストをpandasのDataFrameに変換
+# 取得が終わった後に、Storageと手元の取得用のファイルを削除（状態のファイルは最後に削除）
+def crawl_clear():
+    for name in follower_crawl.data_files(CRAWL_DIR, crawl_state, CRAWL_SHARDS) + follower_crawl.state_files(CRAWL_SHARDS)[::-1]:
+        store.delete(CRAWL_PREFIX + name)
+    follower_crawl.clear(CRAWL_DIR)
+
+
+# フォロワー情報をDataFrameにまとめる（df_newは今回の新しいフォロワーだけ、df_currentは取得した全員）
 def to_DataFrame():
     global df_new
-    list1= user_infos
-    columns1 = ['save_time', 'user_id', 'screen_name', 'folowers_count', 
-                'friends_count', 'user_name', 'location', 'user_url', 'description']
-    df1 = pd.DataFrame(data=list1, columns=columns1)
-    df2 = df1.sort_index(ascending=False)
-    if file_check:
-        df_new = pd.concat([df, df2])
-    else:
-        df_new = df2
+    global df_current
+    df_new = user_infos.sort_index(ascending=False)
+    df_current = metric_infos
     return df_new
 
 
-# csvファイルに保存
+# 新しいフォロワーを1つのセグメントとして保存（過去のデータは読み書きしない）
 def data_save():
-    df_new.to_csv(FILE_PATH, index = False)
-    print('[csvファイル保存しました]')
-   
+    global new_segment
+    new_segment = append_segment(LOG_DIR, df_new, FOLLOWERS_SCHEMA, DATA_FORMAT, manifest)
+    if new_segment is None:
+        print('[新しいフォロワーはいません]')
+    else:
+        print('[セグメント{}を保存しました]'.format(new_segment))
+
+
+# フォロワーごとの最新の値(ロールアップ)を、今回取得したフォロワーの分だけ更新して保存
+# ロールアップがまだ無く、セグメントだけある場合は全履歴から作り直す
+def rollup_save():
+    path = rollups.rollup_path(ROLLUP_DIR, rollups.FOLLOWER_METRICS)
+    if os.path.isfile(path):
+        follower_metrics = rollups.read_rollup(ROLLUP_DIR, rollups.FOLLOWER_METRICS)
+    elif file_check:
+        download_segments()
+        follower_metrics = rollups.update_follower_metrics(
+            rollups.empty_rollup(rollups.FOLLOWER_METRICS), read_log(LOG_DIR, FOLLOWERS_SCHEMA, manifest=manifest))
+    else:
+        follower_metrics = rollups.empty_rollup(rollups.FOLLOWER_METRICS)
+    follower_metrics = rollups.update_follower_metrics(follower_metrics, df_current)
+    rollups.write_rollup(ROLLUP_DIR, rollups.FOLLOWER_METRICS, follower_metrics)
+    print('[ロールアップを保存しました]')
+
 
-# Storageへのアップロード処理
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)  
+# フォロワーのプロフィール欄の頻出ワードを、新しいフォロワーとプロフィールが変わったフォロワーの分だけ更新
+# まだ無い場合は、既存のデータから現在のフォロワーの最新のプロフィールで作る
+def keyword_save():
+    global keyword_files
+    method = keyword_rank.tokenizer_name(KEYWORD_TOKENIZER)
+    state = keyword_rank.read_state(ROLLUP_DIR, method)
+    batch = df_current
+    if state is None:
+        state = keyword_rank.empty_state()
+        # REFRESH_METRICSがTrueなら、今回取得した全員のプロフィールで作れる
+        if file_check and not REFRESH_METRICS:
+            download_segments()
+            history = read_log(LOG_DIR, FOLLOWERS_SCHEMA, columns=['save_time', 'user_id', 'description'],
+                               manifest=manifest).sort_values('save_time', kind='stable')
+            history = history[in_id_index(history['user_id'].to_numpy(dtype='int64'), id_index)]
+            batch = pd.concat([history, df_current[history.columns]], ignore_index=True)
+    state, tokenized = keyword_rank.update(state, batch, unfollower_ids, keyword_rank.open_tokenizer(method))
+    keyword_files = keyword_rank.write_state(ROLLUP_DIR, method, state)
+    print('[頻出ワードを更新しました 分かち書き: {}件 ワード: {}件]'.format(tokenized, len(state['counts'])))
 
 
-# Storageからのダウンロード処理
-def download_blob(bucket_name, source_blob_name, destination_file_name):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+# フォロワーごとのフォロワー数・フォロー数の変化(差分、定期的にキーフレーム)を保存
+def snapshot_save():
+    global new_snapshots
+    keyframe, delta = follower_snapshots.record(SNAPSHOT_DIR, df_current, now_time, unfollower_ids, DATA_FORMAT)
+    new_snapshots = []
+    if keyframe is not None:
+        new_snapshots.append((follower_snapshots.KEYFRAMES, keyframe))
+        print('[キーフレーム{}を保存しました]'.format(keyframe))
+    if delta is not None:
+        new_snapshots.append((follower_snapshots.DELTAS, delta))
+        print('[差分{}を保存しました]'.format(delta))
+
+
+# フォロワーIDインデックスとフォロー解除の記録を保存
+def id_index_save():
+    np.save(ID_INDEX_PATH, id_index)
+    if len(unfollower_ids) > 0:
+        df_unfollowers = pd.DataFrame({'save_time': now_time, 'user_id': unfollower_ids})
+        df_unfollowers.to_csv(UNFOLLOWERS_PATH, mode='a', index=False,
+                              header=not os.path.isfile(UNFOLLOWERS_PATH))
+    print('[フォロワーIDインデックスを保存しました]')
+   
+
 
 # main関数を実行(GCPのCloud Functions用にevent,contextが引数に)
 # トリガーをpub/subに設定、ファイルダウンロードしてデータ追加してアップロード
+# 段階(ダウンロード → 認証 → 読み込み → 取得 → 変換 → 保存 → アップロード)ごとに計測してログに出力
+# 取得が制限時間内に終わらなかった場合は、取得の途中までを保存して終了（次の実行で続きから取得）
 def main(event, context):
     input_twitter_info()
-    download_blob('ストレージのバケット名を指定', 'ストレージに保存されているファイル名を指定', FILE_PATH)
-    authTwitter()
-    is_file()
-    read_csv()
-    get_data()
-    to_DataFrame()    
-    data_save()
-    upload_blob('ストレージのバケット名を指定', FILE_PATH, 'ストレージに保存するファイル名を指定')
-
+    tracer = Tracer('followers')
+    with tracer.span('main'):
+        with tracer.span('download'):
+            open_storage()
+            os.makedirs(LOG_DIR, exist_ok=True)
+            store.download_if_exists(LOG_PREFIX + MANIFEST_NAME, manifest_path(LOG_DIR))
+            os.makedirs(ROLLUP_DIR, exist_ok=True)
+            follower_metrics_file = rollups.rollup_file_name(rollups.FOLLOWER_METRICS)
+            store.download_if_exists(ROLLUP_PREFIX + follower_metrics_file, os.path.join(ROLLUP_DIR, follower_metrics_file))
+            for path in keyword_rank.state_files(ROLLUP_DIR, keyword_rank.tokenizer_name(KEYWORD_TOKENIZER)):
+                store.download_if_exists(ROLLUP_PREFIX + os.path.basename(path), path)
+            store.download_if_exists(os.path.basename(ID_INDEX_PATH), ID_INDEX_PATH)
+            for sub_dir in (follower_snapshots.KEYFRAMES, follower_snapshots.DELTAS):
+                os.makedirs(os.path.join(SNAPSHOT_DIR, sub_dir), exist_ok=True)
+                store.download_if_exists(SNAPSHOT_PREFIX + sub_dir + '/' + MANIFEST_NAME, manifest_path(os.path.join(SNAPSHOT_DIR, sub_dir)))
+            store.download_if_exists(SNAPSHOT_PREFIX + follower_snapshots.STATE_NAME, follower_snapshots.state_path(SNAPSHOT_DIR))
+            store.download_if_exists(os.path.basename(UNFOLLOWERS_PATH), UNFOLLOWERS_PATH)
+        with tracer.span('auth'):
+            authTwitter()
+            tracer.attach(scheduler)
+        with tracer.span('read') as span:
+            is_file()
+            migrate_legacy_file()
+            read_id_index()
+            span.add_rows(len(id_index))
+        with tracer.span('fetch') as span:
+            get_data(event_shard(event))
+            span.add_rows(fetched_rows)
+        # すべてのページを取得し終えた時だけ、フォロワーのデータ・履歴・インデックスを更新する
+        if crawl_complete:
+            with tracer.span('transform') as span:
+                to_DataFrame()
+                span.add_rows(len(df_current))
+            with tracer.span('save') as span:
+                data_save()
+                rollup_save()
+                keyword_save()
+                snapshot_save()
+                id_index_save()
+                span.add_rows(len(df_new))
+            # 新しいセグメントとマニフェストだけをアップロード
+            with tracer.span('upload'):
+                if new_segment is not None:
+                    upload_segments(store, LOG_DIR, LOG_PREFIX, [new_segment])
+                store.upload(os.path.join(ROLLUP_DIR, follower_metrics_file), ROLLUP_PREFIX + follower_metrics_file)
+                for path in keyword_files:
+                    store.upload(path, ROLLUP_PREFIX + os.path.basename(path))
+                for sub_dir, name in new_snapshots:
+                    upload_segments(store, os.path.join(SNAPSHOT_DIR, sub_dir), SNAPSHOT_PREFIX + sub_dir + '/', [name])
+                store.upload(follower_snapshots.state_path(SNAPSHOT_DIR), SNAPSHOT_PREFIX + follower_snapshots.STATE_NAME)
+                store.upload(ID_INDEX_PATH, os.path.basename(ID_INDEX_PATH))
+                if os.path.isfile(UNFOLLOWERS_PATH):
+                    store.upload(UNFOLLOWERS_PATH, os.path.basename(UNFOLLOWERS_PATH))
+                crawl_clear()
+    print(scheduler.metrics())
+    scheduler.shutdown()
+    if METRICS_FILE is not None:
+        tracer.write_prometheus(METRICS_FILE)
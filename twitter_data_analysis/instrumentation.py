@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+収集スクリプトとダッシュボードの処理を段階(スパン)ごとに計測します。
+スパンごとに実行時間・APIのリクエスト回数・レート制限の待ち時間・処理した行数・メモリ(RSS)のピークを記録し、
+開始時と終了時に1行のJSONをログに出力します（Cloud Loggingでは構造化ログとして検索できます）。
+Cloud Functionsがタイムアウトした時も、開始だけ記録されて終了が無いスパンで、どの段階で止まったかが分かります。
+集計した値はPrometheusのテキスト形式で、ファイルへの書き出しやhttpでの公開もできます。
+"""
+
+# 必要なモジュールのインポート
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Prometheusのメトリクス名の接頭辞
+METRIC_PREFIX = 'twitter_stage'
+
+# スパンの記録の項目（これ以外はspan()に渡したラベル）
+RECORD_FIELDS = ('severity', 'message', 'event', 'job', 'span', 'started_at', 'seconds', 'api_calls', 'rate_limited',
+                 'rate_limit_wait_seconds', 'rows', 'peak_rss_mb', 'rss_mb', 'error')
+
+# 手元に残すスパンの記録の件数（古いものから捨てる、集計には件数に関係なくすべて含める）
+MAX_RECORDS = 1000
+
+
+# /proc/self/status (Linux) からメモリの値(kB)を読む（読めない場合はNone）
+def _proc_status(key):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# 現在のRSS(バイト)
+def current_rss():
+    return _proc_status('VmRSS')
+
+
+# プロセスのRSSのピーク(バイト)
+def peak_rss():
+    peak = _proc_status('VmHWM')
+    if peak is not None:
+        return peak
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+# RSSのピークを現在の値に戻す（Linuxのみ、できた場合はTrue）
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# スケジューラーの全エンドポイントの合計（リクエスト回数、レート制限エラーの回数、待ち時間）
+def scheduler_totals(scheduler):
+    if scheduler is None:
+        return {'calls': 0, 'rate_limited': 0, 'wait_seconds': 0.0}
+    endpoints = scheduler.metrics()['endpoints'].values()
+    return {
+        'calls': sum(stats['calls'] for stats in endpoints),
+        'rate_limited': sum(stats['rate_limited'] for stats in endpoints),
+        'wait_seconds': sum(stats['wait_seconds'] for stats in endpoints),
+    }
+
+
+# 計測中の1つの段階（rowsに処理した行数を入れる）
+class Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.rows = None
+        self.peak = 0
+
+    def add_rows(self, n):
+        self.rows = (self.rows or 0) + n
+
+
+# スパンの記録と集計
+# reset_peak=True ならスパンの開始時にRSSのピークを戻して、スパンごとのピークを記録する
+# （複数のセッションが同時に動くダッシュボードではFalseにして、プロセス全体のピークを記録する）
+# max_records は records に残す件数（ずっと動き続けるダッシュボードでは0にして残さない）
+class Tracer:
+    def __init__(self, job, scheduler=None, log_file=None, reset_peak=True, max_records=MAX_RECORDS):
+        self.job = job
+        self.scheduler = scheduler
+        self.log_file = log_file
+        self.reset_peak = reset_peak
+        self.records = collections.deque(maxlen=max_records)
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    # APIのリクエスト回数・待ち時間を記録するスケジューラーを設定（認証後に作成されるため）
+    def attach(self, scheduler):
+        self.scheduler = scheduler
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _log(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        print(line, flush=True)
+        if self.log_file is not None:
+            with self._lock, open(self.log_file, 'a') as f:
+                f.write(line + '\n')
+
+    # スパン以外の値を1行のJSONでログに出力（メモリ使用量など）
+    def event(self, message, **fields):
+        self._log(dict(severity='INFO', message=message, event=message, job=self.job, **fields))
+
+    # 段階を計測する（ネストしたスパンの名前は 親/子 になる）
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        stack = self._stack()
+        if stack:
+            name = stack[-1].name + '/' + name
+        span = Span(name, labels)
+        # 親のスパンのピークを確定してからピークを戻す
+        peak = peak_rss() or 0
+        for parent in stack:
+            parent.peak = max(parent.peak, peak)
+        if self.reset_peak:
+            reset_peak_rss()
+        stack.append(span)
+        before = scheduler_totals(self.scheduler)
+        started_at = datetime.now().isoformat(timespec='milliseconds')
+        self._log(dict(severity='INFO', message='start {}'.format(name), event='start',
+                       job=self.job, span=name, started_at=started_at, **labels))
+        start = time.perf_counter()
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            after = scheduler_totals(self.scheduler)
+            span.peak = max(span.peak, peak_rss() or 0)
+            stack.pop()
+            for parent in stack:
+                parent.peak = max(parent.peak, span.peak)
+            rss = current_rss()
+            record = dict(
+                severity='ERROR' if error else 'INFO',
+                message='end {} {:.3f}s'.format(name, seconds),
+                event='end',
+                job=self.job,
+                span=name,
+                started_at=started_at,
+                seconds=round(seconds, 6),
+                api_calls=after['calls'] - before['calls'],
+                rate_limited=after['rate_limited'] - before['rate_limited'],
+                rate_limit_wait_seconds=round(after['wait_seconds'] - before['wait_seconds'], 6),
+                rows=span.rows,
+                peak_rss_mb=round(span.peak / 1024 / 1024, 1) if span.peak else None,
+                rss_mb=round(rss / 1024 / 1024, 1) if rss is not None else None,
+                error=error,
+                **labels)
+            self._add(record, span.peak)
+            self._log(record)
+
+    # スパンに付けたラベル（span(name, view=...) のキーワード引数）
+    @staticmethod
+    def _labels(record):
+        return {key: value for key, value in record.items() if key not in RECORD_FIELDS}
+
+    # Prometheus用の集計（スパンごとの回数と合計、最後の値）
+    def _add(self, record, peak):
+        key = (record['span'], tuple(sorted(self._labels(record).items())), record['error'] is not None)
+        with self._lock:
+            self.records.append(record)
+            totals = self._totals.setdefault(key, {'runs': 0, 'seconds': 0.0, 'api_calls': 0, 'rows': 0,
+                                                   'rate_limit_wait_seconds': 0.0, 'last_seconds': 0.0,
+                                                   'peak_rss_bytes': 0})
+            totals['runs'] += 1
+            totals['seconds'] += record['seconds']
+            totals['api_calls'] += record['api_calls']
+            totals['rows'] += record['rows'] or 0
+            totals['rate_limit_wait_seconds'] += record['rate_limit_wait_seconds']
+            totals['last_seconds'] = record['seconds']
+            totals['peak_rss_bytes'] = max(totals['peak_rss_bytes'], peak)
+
+    # 集計をPrometheusのテキスト形式で返す
+    def prometheus_text(self):
+        metrics = [
+            ('runs_total', 'counter', 'スパンの実行回数', 'runs'),
+            ('seconds_total', 'counter', 'スパンの実行時間の合計(秒)', 'seconds'),
+            ('last_seconds', 'gauge', '最後に実行した時の実行時間(秒)', 'last_seconds'),
+            ('api_calls_total', 'counter', 'Twitter APIのリクエスト回数', 'api_calls'),
+            ('rate_limit_wait_seconds_total', 'counter', 'レート制限で待った時間(秒)', 'rate_limit_wait_seconds'),
+            ('rows_total', 'counter', '処理した行数', 'rows'),
+            ('peak_rss_bytes', 'gauge', 'スパン中のRSSのピーク(バイト)', 'peak_rss_bytes'),
+        ]
+        with self._lock:
+            totals = sorted(self._totals.items())
+        lines = []
+        for suffix, kind, help_text, field in metrics:
+            name = '{}_{}'.format(METRIC_PREFIX, suffix)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (span, labels, failed), values in totals:
+                labels = ''.join(',{}="{}"'.format(key, value) for key, value in labels)
+                lines.append('{}{{job="{}",stage="{}"{},error="{}"}} {}'.format(
+                    name, self.job, span, labels, 'true' if failed else 'false', values[field]))
+        return '\n'.join(lines) + '\n'
+
+    # Prometheusのテキスト形式でファイルに書き出す（node_exporterのtextfileコレクター用）
+    def write_prometheus(self, path):
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(path + '.tmp', path)
+
+    # Prometheusのテキスト形式をhttpで公開する（/metrics、別スレッドで動かす）
+    def serve_prometheus(self, port, host='0.0.0.0'):
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = tracer.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
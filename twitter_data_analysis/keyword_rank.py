@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+フォロワーのプロフィール欄(description)の頻出ワードを、収集のたびに変わった分だけ更新します。
+・keyword_counts(rollups.py): ワードごとの、そのワードをプロフィールに含む現在のフォロワーの人数
+・keyword_profiles: フォロワーごとのプロフィールのハッシュ（前回から変わったかどうかの確認用）
+・keyword_terms: プロフィールのハッシュごとの分かち書きの結果（同じプロフィールは1回だけ分かち書きする）
+新しいフォロワーとプロフィールが変わったフォロワーだけを分かち書きし、前のプロフィールのワードを引いて新しいワードを足します。
+フォロー解除したフォロワーのワードは引きます。全員のプロフィールを毎回分かち書きし直すことはありません。
+MeCab(mecab-python3)があれば名詞を、無ければ正規表現でカタカナ・漢字・英単語を切り出します。
+"""
+
+# 必要なモジュールのインポート
+import os
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from data_format import PARQUET, with_format, read_table, write_table
+import rollups
+
+try:
+    import MeCab
+except ImportError:  # MeCabが無い環境では正規表現で切り出す
+    MeCab = None
+
+
+# 状態のテーブルの名前とスキーマ（分かち書きの方法ごとに別のファイルにする）
+PROFILES = 'keyword_profiles'
+PROFILES_SCHEMA = pa.schema([
+    ('user_id', pa.int64()),
+    ('profile_hash', pa.int64()),
+])
+
+TERMS = 'keyword_terms'
+TERMS_SCHEMA = pa.schema([
+    ('profile_hash', pa.int64()),
+    ('terms', pa.string()),  # 空白区切りのワード（重複なし）
+])
+
+# ワードの区切り
+TERM_SEPARATOR = ' '
+
+# 除くワード（URLの一部、よくある英単語）
+STOPWORDS = {'http', 'https', 'www', 'com', 'jp', 'co', 'the', 'and', 'for', 'you', 'are', 'with', 'from', 'this',
+             'that', 'not', 'all', 'rt', 'dm', 'amp'}
+
+# 正規表現での切り出し（2文字以上のカタカナ・漢字、英数字の単語）
+URL_RE = re.compile(r'https?://\S+|\S+@\S+')
+TOKEN_RE = re.compile(r'[ァ-ヴー]{2,}|[一-龥々〆ヶ]{2,}|[a-z][a-z0-9_+#]*[a-z0-9+#]')
+
+# MeCabで残す品詞（名詞のうち、数・代名詞・非自立・接尾を除く）
+MECAB_EXCLUDED = {'数', '代名詞', '非自立', '接尾'}
+
+
+# プロフィールを正規化（全角英数字を半角に、英字は小文字に、URL・メールアドレスは除く）
+def normalize(text):
+    return URL_RE.sub(' ', unicodedata.normalize('NFKC', text).lower())
+
+
+# 正規表現でワードを切り出す
+def regex_tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+# MeCabで名詞を切り出す
+def mecab_tokenizer():
+    tagger = MeCab.Tagger()
+
+    def tokenize(text):
+        terms = []
+        node = tagger.parseToNode(normalize(text))
+        while node:
+            features = node.feature.split(',')
+            if features[0] == '名詞' and features[1] not in MECAB_EXCLUDED and len(node.surface) >= 2:
+                terms.append(node.surface)
+            node = node.next
+        return terms
+    return tokenize
+
+
+# 分かち書きの方法の名前（'mecab', 'regex', 'auto'はMeCabがあればmecab）
+def tokenizer_name(method='auto'):
+    if method == 'mecab' or (method == 'auto' and MeCab is not None):
+        return 'mecab'
+    return 'regex'
+
+
+# 分かち書きの関数
+def open_tokenizer(method='auto'):
+    return mecab_tokenizer() if tokenizer_name(method) == 'mecab' else regex_tokenize
+
+
+# プロフィール1件のワード（1人のプロフィールに同じワードが何回あっても1回と数える）
+def profile_terms(tokenize, text):
+    return TERM_SEPARATOR.join(sorted(set(term for term in tokenize(text) if term not in STOPWORDS)))
+
+
+# プロフィールのハッシュ（int64）
+def profile_hashes(descriptions):
+    return pd.util.hash_pandas_object(descriptions.fillna('').astype(str), index=False).to_numpy().view('int64')
+
+
+# 状態のテーブルのパス（分かち書きの方法ごと）
+def table_path(state_dir, name, method):
+    return with_format(os.path.join(state_dir, '{}_{}'.format(name, method)), PARQUET)
+
+
+# 状態のファイルのパス（プロフィールのハッシュ、分かち書きの結果、ワードごとの人数）
+def state_files(state_dir, method):
+    return [table_path(state_dir, PROFILES, method), table_path(state_dir, TERMS, method),
+            rollups.rollup_path(state_dir, rollups.KEYWORD_COUNTS)]
+
+
+# 状態の読み込み（無い場合はNone、初回は全フォロワーから作る）
+def read_state(state_dir, method):
+    paths = state_files(state_dir, method)
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    return {
+        'profiles': read_table(paths[0], PROFILES_SCHEMA),
+        'terms': read_table(paths[1], TERMS_SCHEMA),
+        'counts': rollups.read_rollup(state_dir, rollups.KEYWORD_COUNTS),
+    }
+
+
+def empty_state():
+    return {
+        'profiles': pd.DataFrame({'user_id': pd.Series(dtype='int64'), 'profile_hash': pd.Series(dtype='int64')}),
+        'terms': pd.DataFrame({'profile_hash': pd.Series(dtype='int64'), 'terms': pd.Series(dtype=object)}),
+        'counts': rollups.empty_rollup(rollups.KEYWORD_COUNTS),
+    }
+
+
+# 状態の保存（保存したファイルのパスを返す）
+def write_state(state_dir, method, state):
+    paths = state_files(state_dir, method)
+    os.makedirs(state_dir, exist_ok=True)
+    write_table(state['profiles'], paths[0], PROFILES_SCHEMA)
+    write_table(state['terms'], paths[1], TERMS_SCHEMA)
+    rollups.write_rollup(state_dir, rollups.KEYWORD_COUNTS, state['counts'])
+    return paths
+
+
+# ハッシュごとのワードを、ワードごとの人数にする（ハッシュが重複していればその人数分）
+def _term_counts(terms_by_hash, hashes):
+    terms = terms_by_hash.reindex(hashes).dropna()
+    terms = terms[terms != ''].str.split(TERM_SEPARATOR).explode()
+    return terms.value_counts()
+
+
+# フォロワーのデータ(followersのスキーマ)と、フォロー解除したフォロワーのIDで更新
+# 新しいフォロワーとプロフィールが変わったフォロワーだけを分かち書きして、ワードごとの人数を差分で更新する
+# (状態, 分かち書きした件数)を返す
+def update(state, followers, removed_ids, tokenize):
+    latest = followers[['user_id', 'description']].drop_duplicates('user_id', keep='last')
+    user_ids = pd.to_numeric(latest['user_id']).astype('int64').to_numpy()
+    hashes = profile_hashes(latest['description'])
+    profiles = state['profiles'].set_index('user_id')['profile_hash']
+    terms_by_hash = state['terms'].set_index('profile_hash')['terms']
+
+    # 前回と比べて、新しい・変わったフォロワー
+    pos = profiles.index.get_indexer(user_ids)
+    known = pos >= 0
+    previous = np.zeros(len(user_ids), dtype='int64')
+    previous[known] = profiles.to_numpy()[pos[known]]
+    changed = ~known | (previous != hashes)
+    removed = profiles[profiles.index.isin(np.asarray(removed_ids, dtype='int64'))]
+
+    # 分かち書きしていないプロフィールだけを分かち書き
+    added_hashes = hashes[changed]
+    missing = ~pd.Index(added_hashes).isin(terms_by_hash.index)
+    new_profiles = (pd.DataFrame({'profile_hash': added_hashes[missing],
+                                  'description': latest['description'].to_numpy()[changed][missing]})
+                    .drop_duplicates('profile_hash'))
+    new_terms = pd.Series([profile_terms(tokenize, text) for text in new_profiles['description'].fillna('')],
+                          index=new_profiles['profile_hash'], dtype=object)
+    terms_by_hash = pd.concat([terms_by_hash, new_terms])
+
+    # 前のプロフィールのワードを引いて、新しいプロフィールのワードを足す
+    subtracted = np.concatenate([previous[changed & known], removed.to_numpy()])
+    delta = _term_counts(terms_by_hash, added_hashes).sub(_term_counts(terms_by_hash, subtracted), fill_value=0)
+    counts = state['counts'].set_index('word')['count'].add(delta, fill_value=0)
+    counts = counts[counts > 0].astype('int64').sort_values(ascending=False, kind='stable')
+
+    # フォロワーごとのハッシュを更新し、どのフォロワーも使っていない分かち書きの結果は消す
+    profiles = profiles[~profiles.index.isin(removed.index)]
+    profiles = pd.concat([profiles[~profiles.index.isin(user_ids[changed])],
+                          pd.Series(added_hashes, index=user_ids[changed])])
+    terms_by_hash = terms_by_hash[terms_by_hash.index.isin(profiles.to_numpy())]
+    state = {
+        'profiles': profiles.rename_axis('user_id').rename('profile_hash').reset_index(),
+        'terms': terms_by_hash.rename_axis('profile_hash').rename('terms').reset_index(),
+        'counts': counts.rename_axis('word').rename('count').reset_index(),
+    }
+    return state, len(new_profiles)
+
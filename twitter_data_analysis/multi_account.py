@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+複数のTwitterアカウントのデータ収集(tweet_data_save.py, followers_data_save.py)を、1回の実行でまとめて行います。
+アカウントの一覧(accounts.json)を読み込み、アカウントと収集の組み合わせごとにプロセスプールで並行して実行します。
+・保存先: アカウントごとに STORAGE_URL/<アカウント名>/ に保存します（1アカウントの時と同じファイル構成）
+・レート制限: 同じ認証情報を使うアカウントの間では、エンドポイントごとのトークンバケットを共有します
+  （レート制限は認証情報ごとに数えられるため）。別の認証情報のアカウントは、それぞれの回数を並行して使います
+・実行後に、アカウントごとの取得件数・時間・取得の速さ(件/秒)・APIのリクエスト回数・レート制限の待ち時間を出力します
+全体の時間は、アカウントの数ではなく、認証情報ごとのレート制限の回数で決まります。
+
+使い方: python multi_account.py accounts.json --storage gs://バケット名 --processes 8
+"""
+
+# 必要なモジュールのインポート
+import argparse
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.managers import BaseManager
+
+from request_scheduler import RATE_LIMITS, WINDOW_SECONDS, LockedTokenBucket
+from instrumentation import Tracer
+
+
+# 収集の名前と、実行するスクリプト
+JOBS = {'tweets': 'tweet_data_save', 'followers': 'followers_data_save'}
+
+# アカウントの一覧のファイル（Cloud Functionsでは同じフォルダに含める）
+# {"credentials": {"main": {"consumer_key": ..., "consumer_secret": ..., "access_key": ..., "access_secret": ...}},
+#  "accounts": [{"screen_name": "アカウント名", "credential": "main", "jobs": ["tweets", "followers"]}],
+#  "settings": {"DATA_FORMAT": "parquet"}}
+# settings には収集スクリプトの定数(大文字の名前)を指定でき、アカウントごとの settings が優先される
+ACCOUNTS_PATH = 'accounts.json'
+
+# 保存先のバケット名を指定
+BUCKET_NAME = 'ストレージのバケット名を指定'
+
+# 保存先（アカウントごとに STORAGE_URL/<アカウント名>/ に保存する）
+STORAGE_URL = 'gs://' + BUCKET_NAME
+
+# 作業用のフォルダ（アカウントと収集ごとに /tmp/accounts/<アカウント名>/<収集>/ を使う）
+WORK_DIR = '/tmp/accounts'
+
+# 並行して実行するプロセスの数（認証情報の数以上にすると、すべての認証情報のレート制限を並行して使える）
+MAX_PROCESSES = 4
+
+
+# 認証情報ごとのトークンバケットを置くサーバー（各プロセスからはプロキシで使う）
+class RateBudgetManager(BaseManager):
+    pass
+
+
+RateBudgetManager.register('TokenBucket', LockedTokenBucket,
+                           exposed=('wait_time', 'acquire', 'try_acquire', 'remaining', 'block'))
+
+
+# アカウントの一覧を読み込む
+def read_accounts(path=ACCOUNTS_PATH):
+    with open(path) as f:
+        config = json.load(f)
+    for account in config['accounts']:
+        if account['credential'] not in config['credentials']:
+            raise KeyError('unknown credential: {}'.format(account['credential']))
+    return config
+
+
+# アカウントの設定（全体の settings に、アカウントごとの settings を重ねる）
+def account_settings(config, account):
+    return dict(config.get('settings', {}), **account.get('settings', {}))
+
+
+# レート制限の時間枠（疑似APIで時間枠を縮める場合は、共有するバケットも同じだけ縮める）
+def budget_window(settings):
+    if settings.get('FAKE_API') is not None:
+        return WINDOW_SECONDS * settings.get('FAKE_TIME_SCALE', 1.0)
+    return WINDOW_SECONDS
+
+
+# 認証情報ごとのレート制限の時間枠（その認証情報を使うアカウントの設定から）
+# 同じ認証情報のアカウントで時間枠が違う(FAKE_API, FAKE_TIME_SCALEが違う)場合は、バケットを共有できないのでValueError
+def budget_windows(config):
+    windows = {name: WINDOW_SECONDS for name in config['credentials']}
+    first = {}
+    for account in config['accounts']:
+        name = account['credential']
+        window = budget_window(account_settings(config, account))
+        if name not in first:
+            first[name] = account['screen_name']
+            windows[name] = window
+        elif window != windows[name]:
+            raise ValueError('accounts {} and {} share credential {} but have different rate limit windows '
+                             '({}s, {}s); set the same FAKE_API and FAKE_TIME_SCALE'.format(
+                                 first[name], account['screen_name'], name, windows[name], window))
+    return windows
+
+
+# 認証情報ごとに、エンドポイントごとの共有のトークンバケットを作る
+def shared_budgets(manager, windows, limits=RATE_LIMITS):
+    return {name: {endpoint: manager.TokenBucket(limit, window) for endpoint, limit in limits.items()}
+            for name, window in windows.items()}
+
+
+# アカウントの保存先
+def account_storage_url(storage_url, screen_name):
+    return storage_url.rstrip('/') + '/' + screen_name
+
+
+# 収集スクリプトの作業用のパス（置き換える前の値）
+ORIGINAL_PATHS = {}
+
+
+# 収集スクリプトの作業用のパス(/tmp/...)を work_dir の下に置き換える
+def redirect_paths(module, work_dir):
+    if module.__name__ not in ORIGINAL_PATHS:
+        ORIGINAL_PATHS[module.__name__] = {name: value for name, value in vars(module).items()
+                                           if name.isupper() and isinstance(value, str) and value.startswith('/tmp/')}
+    for name, value in ORIGINAL_PATHS[module.__name__].items():
+        setattr(module, name, os.path.join(work_dir, value[len('/tmp/'):]))
+
+
+# 収集スクリプトのmainを1回実行して、時間とトレーサーの記録(スパン)を返す
+def run_collector(module):
+    records = []
+    original = module.Tracer
+
+    # mainの中で作るトレーサーの記録を受け取る
+    class RecordingTracer(original):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            records.append(self)
+
+    module.Tracer = RecordingTracer
+    try:
+        start = time.perf_counter()
+        module.main(None, None)
+        seconds = time.perf_counter() - start
+    finally:
+        module.Tracer = original
+    return {'seconds': seconds, 'spans': [dict(record) for record in records[0].records]}
+
+
+# 取得の段階のスパン（tweetsはfetch_save、followersはfetch）
+def fetch_span(spans):
+    return [span for span in spans if span['span'].split('/')[-1] in ('fetch', 'fetch_save')][0]
+
+
+# 1つのアカウントの1つの収集を実行（プロセスプールの中で実行する）
+def run_account(task):
+    result = {'screen_name': task['screen_name'], 'collector': task['job'], 'credential': task['credential_name']}
+    try:
+        module = importlib.import_module(JOBS[task['job']])
+        redirect_paths(module, os.path.join(task['work_dir'], task['screen_name'], task['job']))
+        module.ACCOUNT = dict(task['credential'], screen_name=task['screen_name'])
+        module.RATE_BUCKETS = task['buckets']
+        module.STORAGE_URL = account_storage_url(task['storage_url'], task['screen_name'])
+        for name, value in task['settings'].items():
+            setattr(module, name, value)
+        run = run_collector(module)
+    except Exception as e:
+        traceback.print_exc()
+        result.update(error='{}: {}'.format(type(e).__name__, e))
+        return result
+    main_span = run['spans'][-1]
+    fetch = fetch_span(run['spans'])
+    result.update(seconds=run['seconds'], fetched=fetch['rows'], fetch_seconds=fetch['seconds'],
+                  rows_per_second=fetch['rows'] / fetch['seconds'] if fetch['seconds'] else None,
+                  api_calls=main_span['api_calls'], rate_limited=main_span['rate_limited'],
+                  rate_limit_wait_seconds=main_span['rate_limit_wait_seconds'], error=None)
+    return result
+
+
+# アカウントと収集の組み合わせ（認証情報が交互になるように並べて、最初から全部の認証情報の回数を使う）
+def make_tasks(config, storage_url, work_dir, buckets):
+    by_credential = {}
+    for account in config['accounts']:
+        settings = account_settings(config, account)
+        for job in account.get('jobs', list(JOBS)):
+            by_credential.setdefault(account['credential'], []).append({
+                'screen_name': account['screen_name'],
+                'job': job,
+                'credential_name': account['credential'],
+                'credential': config['credentials'][account['credential']],
+                'buckets': buckets[account['credential']],
+                'storage_url': storage_url,
+                'work_dir': work_dir,
+                'settings': settings,
+            })
+    interleaved = itertools.zip_longest(*by_credential.values())
+    return [task for group in interleaved for task in group if task is not None]
+
+
+# すべてのアカウントを収集して、アカウントごとの結果と全体の時間を返す
+# アカウントごとに新しいプロセスで実行する（収集スクリプトはモジュールの変数に状態を持つため）
+def run_all(config, storage_url=STORAGE_URL, work_dir=WORK_DIR, processes=MAX_PROCESSES, tracer=None):
+    tracer = tracer or Tracer('multi_account')
+    windows = budget_windows(config)
+    with RateBudgetManager() as manager:
+        buckets = shared_budgets(manager, windows)
+        tasks = make_tasks(config, storage_url, work_dir, buckets)
+        start = time.perf_counter()
+        results = []
+        with multiprocessing.Pool(processes, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(run_account, tasks):
+                tracer.event('account', **result)
+                results.append(result)
+            pool.close()
+            pool.join()
+        wall_seconds = time.perf_counter() - start
+    fetched = sum(result.get('fetched') or 0 for result in results)
+    summary = {'accounts': len(config['accounts']), 'tasks': len(tasks), 'credentials': len(config['credentials']),
+               'processes': processes, 'wall_seconds': wall_seconds, 'fetched': fetched,
+               'rows_per_second': fetched / wall_seconds if wall_seconds else None,
+               'errors': sum(result['error'] is not None for result in results)}
+    tracer.event('summary', **summary)
+    return results, summary
+
+
+def print_report(results, summary):
+    for result in sorted(results, key=lambda result: (result['screen_name'], result['collector'])):
+        if result['error'] is not None:
+            print('[{} {}] エラー: {}'.format(result['screen_name'], result['collector'], result['error']))
+            continue
+        print('[{} {}] {}件 {:.2f}秒 ({:.0f}件/秒) リクエスト{}回 レート制限の待ち{:.1f}秒'.format(
+            result['screen_name'], result['collector'], result['fetched'], result['fetch_seconds'],
+            result['rows_per_second'] or 0, result['api_calls'], result['rate_limit_wait_seconds']))
+    print('[全体] {}アカウント {}件 {:.2f}秒 ({:.0f}件/秒) エラー{}件'.format(
+        summary['accounts'], summary['fetched'], summary['wall_seconds'], summary['rows_per_second'] or 0,
+        summary['errors']))
+
+
+# main関数を実行(GCPのCloud Functions用にevent,contextが引数に)
+# トリガーをpub/subに設定、アカウントの一覧のすべてのアカウントを収集
+def main(event, context):
+    results, summary = run_all(read_accounts(ACCOUNTS_PATH))
+    print_report(results, summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='複数のアカウントのデータを並行して収集')
+    parser.add_argument('accounts', nargs='?', default=ACCOUNTS_PATH, help='アカウントの一覧のJSONファイル')
+    parser.add_argument('--storage', default=STORAGE_URL, help='保存先 (gs://バケット名 またはフォルダ)')
+    parser.add_argument('--work-dir', default=WORK_DIR, help='作業用のフォルダ')
+    parser.add_argument('--processes', type=int, default=MAX_PROCESSES, help='並行して実行するプロセスの数')
+    parser.add_argument('--output', default=None, help='アカウントごとの結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    results, summary = run_all(read_accounts(args.accounts), args.storage, args.work_dir, args.processes)
+    print_report(results, summary)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'summary': summary, 'results': results}, f, ensure_ascii=False, indent=1, default=str)
+        print('[結果を{}に保存しました]'.format(args.output))
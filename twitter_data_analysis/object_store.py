@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+"""
+Storage(GCS)・ローカルのフォルダ・https:// のファイルを同じ方法で読み書きします。
+・GCSのクライアントとhttpのセッションは1つを使い回します
+・ダウンロードしたファイルの世代(generation / ETag)とmd5を記録しておき、
+  Storageのファイルが変わっていなければダウンロードせず、ローカルのファイルが変わっていなければアップロードしません
+・if_unchanged=True のアップロードは、Storageのファイルがダウンロードした世代のままの時だけ書き込みます
+  （マニフェストのように、収集とcompact_segments.pyの両方が書き換えるファイル用）
+収集スクリプトの保存先(STORAGE_URL)をローカルのフォルダにすると、Storageを使わずに動かせます。
+"""
+
+# 必要なモジュールのインポート
+import base64
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+# ダウンロードしたファイルの世代とmd5を記録するファイル（ダウンロード先のファイル名 + .etag）
+ETAG_SUFFIX = '.etag'
+
+
+# Storageに無いファイルを指定した時の例外
+class ObjectNotFound(FileNotFoundError):
+    pass
+
+
+# 条件付きのアップロードで、Storageのファイルがダウンロードした時から変わっていた時の例外
+class PreconditionFailed(Exception):
+    pass
+
+
+# 条件付きのアップロードで「まだ無いこと」を条件にする世代（GCSのif_generation_match=0と同じ）
+NO_OBJECT = '0'
+
+
+# ファイルのmd5（GCSのmd5_hashと同じbase64の形式）
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(block)
+    return base64.b64encode(md5.digest()).decode('ascii')
+
+
+# 記録した世代とmd5を読み込み（無い場合はNone）
+def read_etag(path):
+    try:
+        with open(path + ETAG_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_etag(path, generation, md5):
+    with open(path + ETAG_SUFFIX, 'w') as f:
+        json.dump({'generation': generation, 'md5': md5}, f)
+
+
+# ローカルのファイルが、記録した時から変わっていなければ記録を返す
+def unchanged_etag(path):
+    etag = read_etag(path)
+    if etag is None or not os.path.isfile(path) or file_md5(path) != etag['md5']:
+        return None
+    return etag
+
+
+# 保存先の共通部分（名前はバケット・フォルダからの相対パス）
+# 各保存先は _stat(名前) -> 世代またはNone, _download(名前, 一時ファイル, 世代) -> 世代,
+# _upload(ファイル, 名前, 条件の世代) -> 世代, _delete(名前) を持つ
+# _upload は条件の世代がNoneでなければ、Storageのファイルがその世代の時だけ書き込み、違う時は PreconditionFailed
+class ObjectStore:
+
+    # ファイルの世代（無い場合はNone）
+    def generation(self, name):
+        return self._stat(name)
+
+    # ダウンロード（変わっていない場合はダウンロードせずFalse、ダウンロードした場合はTrue）
+    def download(self, name, destination_file_name):
+        etag = unchanged_etag(destination_file_name)
+        generation = self._download(name, destination_file_name + '.tmp',
+                                    etag['generation'] if etag is not None else None)
+        if generation is None:
+            return False
+        os.replace(destination_file_name + '.tmp', destination_file_name)
+        write_etag(destination_file_name, generation, file_md5(destination_file_name))
+        return True
+
+    # Storageに無い場合もあるファイルのダウンロード
+    def download_if_exists(self, name, destination_file_name):
+        try:
+            return self.download(name, destination_file_name)
+        except ObjectNotFound:
+            print('[{}はまだありません]'.format(name))
+            return False
+
+    # アップロード（ダウンロード・アップロードした時から変わっていない場合はアップロードせずFalse）
+    # if_unchanged=True なら、記録した世代(記録が無い場合はまだ無いこと)を条件にして書き込む
+    def upload(self, source_file_name, name, if_unchanged=False):
+        etag = read_etag(source_file_name)
+        md5 = file_md5(source_file_name)
+        if etag is not None and etag['md5'] == md5 and self._stat(name) == etag['generation']:
+            return False
+        if_generation_match = None
+        if if_unchanged:
+            if_generation_match = etag['generation'] if etag is not None else NO_OBJECT
+        generation = self._upload(source_file_name, name, if_generation_match)
+        write_etag(source_file_name, generation, md5)
+        return True
+
+    # 削除（無い場合は何もしない）
+    def delete(self, name):
+        self._delete(name)
+
+
+# ローカルのフォルダ（世代はファイルの更新時刻）
+class LocalStore(ObjectStore):
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def _stat(self, name):
+        path = self.path(name)
+        return str(os.stat(path).st_mtime_ns) if os.path.isfile(path) else None
+
+    def _download(self, name, tmp_file_name, generation):
+        current = self._stat(name)
+        if current is None:
+            raise ObjectNotFound(name)
+        if current == generation:
+            return None
+        shutil.copyfile(self.path(name), tmp_file_name)
+        return current
+
+    # 条件付きの書き込みは、同じファイルの .lock をロックしてから世代を確かめて置き換える
+    def _upload(self, source_file_name, name, if_generation_match=None):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        shutil.copyfile(source_file_name, path + '.tmp')
+        if if_generation_match is None:
+            os.replace(path + '.tmp', path)
+            return self._stat(name)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if (self._stat(name) or NO_OBJECT) != if_generation_match:
+                os.remove(path + '.tmp')
+                raise PreconditionFailed(name)
+            os.replace(path + '.tmp', path)
+            return self._stat(name)
+
+    def _delete(self, name):
+        if os.path.isfile(self.path(name)):
+            os.remove(self.path(name))
+
+
+# GCSのクライアント（プロセスで1つを使い回す、内部のhttpセッションも使い回される）
+@functools.lru_cache(maxsize=None)
+def gcs_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+# Storage(GCS)のバケット（世代はオブジェクトのgeneration）
+class GCSStore(ObjectStore):
+    def __init__(self, bucket_name, prefix=''):
+        self.bucket = gcs_client().bucket(bucket_name)
+        self.prefix = prefix
+
+    def _stat(self, name):
+        blob = self.bucket.get_blob(self.prefix + name)
+        return str(blob.generation) if blob is not None else None
+
+    def _download(self, name, tmp_file_name, generation):
+        # 世代だけを確認し、変わっていた時はその世代を指定してダウンロード
+        blob = self.bucket.get_blob(self.prefix + name)
+        if blob is None:
+            raise ObjectNotFound(name)
+        if str(blob.generation) == generation:
+            return None
+        blob.download_to_filename(tmp_file_name)
+        return str(blob.generation)
+
+    def _upload(self, source_file_name, name, if_generation_match=None):
+        from google.api_core import exceptions
+        blob = self.bucket.blob(self.prefix + name)
+        try:
+            if if_generation_match is None:
+                blob.upload_from_filename(source_file_name)
+            else:
+                blob.upload_from_filename(source_file_name, if_generation_match=int(if_generation_match))
+        except exceptions.PreconditionFailed:
+            raise PreconditionFailed(name)
+        return str(blob.generation)
+
+    def _delete(self, name):
+        from google.cloud.exceptions import NotFound
+        try:
+            self.bucket.blob(self.prefix + name).delete()
+        except NotFound:
+            pass
+
+
+# httpのセッション（スレッドごとに1つを使い回す）
+_http = threading.local()
+
+def http_session():
+    if not hasattr(_http, 'session'):
+        import requests
+        _http.session = requests.Session()
+    return _http.session
+
+
+# https:// の公開ファイル（読み込み専用、世代はETag）
+class HTTPStore(ObjectStore):
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/') + '/'
+
+    def _stat(self, name):
+        response = http_session().head(self.base_url + name)
+        return response.headers.get('ETag') if response.ok else None
+
+    def _download(self, name, tmp_file_name, generation):
+        headers = {'If-None-Match': generation} if generation else {}
+        with http_session().get(self.base_url + name, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                return None
+            if response.status_code == 404:
+                raise ObjectNotFound(name)
+            response.raise_for_status()
+            with open(tmp_file_name, 'wb') as f:
+                for block in response.iter_content(1024 * 1024):
+                    f.write(block)
+            return response.headers.get('ETag')
+
+    def _upload(self, source_file_name, name, if_generation_match=None):
+        raise PermissionError('https:// の保存先は読み込み専用です')
+
+    def _delete(self, name):
+        raise PermissionError('https:// の保存先は読み込み専用です')
+
+
+# 保存先のURLから保存先を作成
+# gs://バケット名/フォルダ、https://.../フォルダ、ローカルのフォルダのどれでも可
+# 書き込む保存先(writable=True、収集スクリプトなど)には https:// は使えないので、開く時にエラーにする
+def open_store(url, writable=False):
+    if url.startswith('gs://'):
+        bucket_name, _, prefix = url[len('gs://'):].partition('/')
+        return GCSStore(bucket_name, prefix.strip('/') + '/' if prefix.strip('/') else '')
+    if url.startswith(('https://', 'http://')):
+        if writable:
+            raise PermissionError('https:// の保存先は読み込み専用です: {}'.format(url))
+        return HTTPStore(url)
+    return LocalStore(url)
+
+
+# ファイルのURLを保存先とファイル名に分ける (例: gs://bucket/a/b.csv -> (gs://bucket/aの保存先, 'b.csv'))
+def open_file(url):
+    parent, _, name = url.rstrip('/').rpartition('/')
+    return open_store(parent), name
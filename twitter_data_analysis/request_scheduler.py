@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+"""
+Twitter APIへのリクエストを、エンドポイントごとのレート制限(トークンバケット)に合わせて実行するスケジューラーです。
+tweet_data_save.py, followers_data_save.py で共通に使います。
+レート制限に達したエンドポイントのリクエストは待たせて、その間に残り回数のある他のエンドポイントのリクエストを並行して実行します。
+"""
+
+# 必要なモジュールのインポート
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# レート制限の時間枠(秒) Twitter API v1.1は15分ごと
+WINDOW_SECONDS = 15 * 60
+
+# エンドポイントごとの時間枠あたりのリクエスト回数（ユーザー認証の場合）
+RATE_LIMITS = {
+    'followers/ids': 15,
+    'users/lookup': 900,
+    'users/show': 900,
+    'statuses/user_timeline': 900,
+    'statuses/lookup': 900,
+}
+
+# 並行して実行するリクエストの数
+MAX_WORKERS = 4
+
+# レート制限エラーになったリクエストを再実行する回数
+MAX_RETRIES = 3
+
+
+# エンドポイントごとのトークンバケット
+# 時間枠の回数を上限として、時間の経過に合わせて少しずつ補充する
+class TokenBucket:
+    def __init__(self, capacity, window=WINDOW_SECONDS, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    # リクエストできるまでの待ち時間(秒)。0ならすぐにリクエストできる
+    def wait_time(self):
+        now = self._refill()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    # トークンを1つ使う
+    def acquire(self):
+        self._refill()
+        self.tokens -= 1
+
+    # すぐにリクエストできればトークンを1つ使って0を、できなければ待ち時間(秒)を返す
+    # （複数のプロセスで共有するバケットでも、確認と使用の間に他のプロセスが割り込まない）
+    def try_acquire(self):
+        wait = self.wait_time()
+        if wait == 0:
+            self.acquire()
+        return wait
+
+    # 残りのトークン数
+    def remaining(self):
+        self._refill()
+        return self.tokens
+
+    # レート制限エラーの時は、リセットまでトークンを空にする
+    def block(self, seconds):
+        now = self._refill()
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+# 複数のスレッド・プロセスから使うトークンバケット（multi_account.pyで認証情報ごとに共有する）
+class LockedTokenBucket(TokenBucket):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # try_acquire の中で wait_time と acquire を呼ぶので、同じスレッドからは何度でもロックできるようにする
+        self._lock = threading.RLock()
+
+    def wait_time(self):
+        with self._lock:
+            return super().wait_time()
+
+    def acquire(self):
+        with self._lock:
+            super().acquire()
+
+    def try_acquire(self):
+        with self._lock:
+            return super().try_acquire()
+
+    def remaining(self):
+        with self._lock:
+            return super().remaining()
+
+    def block(self, seconds):
+        with self._lock:
+            super().block(seconds)
+
+
+# スケジューラーに渡すリクエスト
+class _Request:
+    __slots__ = ('endpoint', 'func', 'args', 'kwargs', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, endpoint, func, args, kwargs, enqueued_at):
+        self.endpoint = endpoint
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+
+
+# 例外がレート制限エラー(HTTP 429 / エラーコード88)かどうか
+def is_rate_limit_error(e):
+    if getattr(e, 'api_code', None) == 88:
+        return True
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None) == 429
+
+
+# レート制限エラーのレスポンスから、リセットまでの秒数を取り出す（無い場合は時間枠いっぱい）
+def reset_seconds(e, window=WINDOW_SECONDS):
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    reset = headers.get('x-rate-limit-reset')
+    if reset is None:
+        return window
+    return max(1.0, float(reset) - time.time())
+
+
+# エンドポイントごとのレート制限に合わせてリクエストを実行するスケジューラー
+# buckets (エンドポイント -> トークンバケット) を渡すと、他のプロセスと共有するバケットを使う（同じ認証情報の複数アカウント）
+class RequestScheduler:
+    def __init__(self, limits=RATE_LIMITS, max_workers=MAX_WORKERS, window=WINDOW_SECONDS,
+                 max_retries=MAX_RETRIES, clock=time.monotonic, buckets=None):
+        self.window = window
+        self.max_retries = max_retries
+        self.clock = clock
+        self._buckets = {name: TokenBucket(limit, window, clock) for name, limit in limits.items()}
+        self._buckets.update(buckets or {})
+        self._queues = collections.defaultdict(collections.deque)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._running = 0
+        self._stats = collections.defaultdict(lambda: {'calls': 0, 'errors': 0, 'rate_limited': 0,
+                                                       'wait_seconds': 0.0, 'max_wait_seconds': 0.0})
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+
+    # リクエストを登録してFutureを返す（並行して実行したい時に使う）
+    def submit(self, endpoint, func, *args, **kwargs):
+        request = _Request(endpoint, func, args, kwargs, self.clock())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('scheduler is closed')
+            if endpoint not in self._buckets:
+                raise KeyError('unknown endpoint: {}'.format(endpoint))
+            self._queues[endpoint].append(request)
+            self._cond.notify()
+        return request.future
+
+    # リクエストを登録して結果を待つ
+    def call(self, endpoint, func, *args, **kwargs):
+        return self.submit(endpoint, func, *args, **kwargs).result()
+
+    # エンドポイントにリクエストできるまでの待ち時間(秒)。制限時間内に終わるかの確認用
+    def wait_time(self, endpoint):
+        with self._cond:
+            return self._buckets[endpoint].wait_time()
+
+    # 待ち行列の長さと、エンドポイントごとの実行回数・待ち時間
+    def metrics(self):
+        with self._cond:
+            return {
+                'queue_depth': sum(len(q) for q in self._queues.values()),
+                'running': self._running,
+                'endpoints': {
+                    name: dict(self._stats[name], queued=len(self._queues[name]),
+                               tokens=round(bucket.remaining(), 2))
+                    for name, bucket in self._buckets.items()
+                },
+            }
+
+    # 登録済みのリクエストがすべて終わるのを待って停止
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+
+    # 次に実行するリクエストを選ぶ
+    # 残り回数のあるエンドポイントの中で、いちばん長く待っているリクエストを優先する
+    # 実行できるものが無ければ (None, 次に実行できるまでの秒数) を返す
+    def _pick(self):
+        ready = None
+        next_wait = None
+        for name, queue in self._queues.items():
+            if not queue:
+                continue
+            wait = self._buckets[name].wait_time()
+            if wait == 0:
+                if ready is None or queue[0].enqueued_at < self._queues[ready][0].enqueued_at:
+                    ready = name
+            elif next_wait is None or wait < next_wait:
+                next_wait = wait
+        if ready is None:
+            return None, next_wait
+        # 共有のバケットは、確認した後に他のプロセスが使っている場合がある
+        wait = self._buckets[ready].try_acquire()
+        if wait > 0:
+            return None, wait
+        return self._queues[ready].popleft(), 0
+
+    def _pending(self):
+        return self._running + sum(len(q) for q in self._queues.values())
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and self._pending() == 0:
+                        return
+                    request, wait = self._pick()
+                    if request is not None:
+                        break
+                    self._cond.wait(timeout=wait)
+                waited = self.clock() - request.enqueued_at
+                stats = self._stats[request.endpoint]
+                stats['calls'] += 1
+                stats['wait_seconds'] += waited
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+                self._running += 1
+            self._executor.submit(self._run, request)
+
+    def _run(self, request):
+        request.attempts += 1
+        try:
+            result = request.func(*request.args, **request.kwargs)
+        except Exception as e:
+            with self._cond:
+                self._running -= 1
+                if is_rate_limit_error(e) and request.attempts <= self.max_retries:
+                    # リセットまで止めて、同じリクエストを先頭に戻す
+                    self._stats[request.endpoint]['rate_limited'] += 1
+                    self._buckets[request.endpoint].block(reset_seconds(e, self.window))
+                    self._queues[request.endpoint].appendleft(request)
+                    self._cond.notify()
+                    return
+                self._stats[request.endpoint]['errors'] += 1
+                self._cond.notify()
+            request.future.set_exception(e)
+            return
+        with self._cond:
+            self._running -= 1
+            self._cond.notify()
+        request.future.set_result(result)
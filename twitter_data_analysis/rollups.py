@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+ダッシュボードで使う集計結果(ロールアップ)を、収集のたびに新しいデータの分だけ更新します。
+twitter_analysis_streamlit.py は全履歴を集計せずに、このロールアップを読み込みます。
+・follower_counts: 保存時刻ごとのフォロワー数
+・tweet_metrics: ツイートごとの「いいね数」「リツイート数」（直近のツイートは収集のたびに取得し直した値、それより古いツイートは最後に取得した時の値）
+・hourly_engagement: ツイート時刻(時)ごとの件数と「いいね数」「リツイート数」の合計（平均は合計÷件数）
+・follower_metrics: フォロワーごとの最新の「フォロワー数」「フォロー数」
+・keyword_counts: フォロワーのプロフィール欄のワードごとの人数（keyword_rank.py）
+"""
+
+# 必要なモジュールのインポート
+import os
+import pandas as pd
+import pyarrow as pa
+
+from data_format import TWEETS_SCHEMA, FOLLOWERS_SCHEMA, PARQUET, with_format, coerce, read_table, write_table
+
+
+# ロールアップの名前とスキーマ
+FOLLOWER_COUNTS = 'follower_counts'
+FOLLOWER_COUNTS_SCHEMA = pa.schema([
+    ('save_time', pa.timestamp('us')),
+    ('followers', pa.int64()),
+])
+
+TWEET_METRICS = 'tweet_metrics'
+TWEET_METRICS_SCHEMA = pa.schema([
+    ('tweet_id', pa.int64()),
+    ('created_at', pa.timestamp('us')),
+    ('favorited', pa.int64()),
+    ('retweeted', pa.int64()),
+    ('save_time', pa.timestamp('us')),
+])
+
+HOURLY_ENGAGEMENT = 'hourly_engagement'
+HOURLY_ENGAGEMENT_SCHEMA = pa.schema([
+    ('hour', pa.int64()),
+    ('tweets', pa.int64()),
+    ('favorited_sum', pa.int64()),
+    ('retweeted_sum', pa.int64()),
+])
+
+FOLLOWER_METRICS = 'follower_metrics'
+FOLLOWER_METRICS_SCHEMA = pa.schema([
+    ('user_id', pa.int64()),
+    ('folowers_count', pa.int64()),
+    ('friends_count', pa.int64()),
+    ('save_time', pa.timestamp('us')),
+])
+
+KEYWORD_COUNTS = 'keyword_counts'
+KEYWORD_COUNTS_SCHEMA = pa.schema([
+    ('word', pa.string()),
+    ('count', pa.int64()),
+])
+
+SCHEMAS = {
+    FOLLOWER_COUNTS: FOLLOWER_COUNTS_SCHEMA,
+    TWEET_METRICS: TWEET_METRICS_SCHEMA,
+    HOURLY_ENGAGEMENT: HOURLY_ENGAGEMENT_SCHEMA,
+    FOLLOWER_METRICS: FOLLOWER_METRICS_SCHEMA,
+    KEYWORD_COUNTS: KEYWORD_COUNTS_SCHEMA,
+}
+
+
+# ロールアップのファイル名 (例: tweet_metrics.parquet)
+def rollup_file_name(name):
+    return os.path.basename(with_format(name, PARQUET))
+
+
+# ロールアップのパス（ローカルのフォルダ、gs://、https:// のどれでも可）
+def rollup_path(rollup_dir, name):
+    return '{}/{}'.format(rollup_dir.rstrip('/'), rollup_file_name(name))
+
+
+# スキーマの列だけを持つ空のDataFrame
+def empty_rollup(name):
+    schema = SCHEMAS[name]
+    df = pd.DataFrame({field.name: pd.Series(dtype=field.type.to_pandas_dtype()) for field in schema})
+    if name == HOURLY_ENGAGEMENT:
+        df = pd.DataFrame({'hour': range(24), 'tweets': 0, 'favorited_sum': 0, 'retweeted_sum': 0})
+    return df
+
+
+# ロールアップを読み込み（ローカルに無い場合は空のロールアップ）
+def read_rollup(rollup_dir, name):
+    path = rollup_path(rollup_dir, name)
+    if '://' not in path and not os.path.isfile(path):
+        return empty_rollup(name)
+    return read_table(path, SCHEMAS[name])
+
+
+# ロールアップを保存
+def write_rollup(rollup_dir, name, df):
+    os.makedirs(rollup_dir, exist_ok=True)
+    write_table(df, rollup_path(rollup_dir, name), SCHEMAS[name])
+
+
+# 保存時刻ごとのフォロワー数を1行追加（同じ保存時刻があれば置き換え）
+def update_follower_counts(follower_counts, save_time, followers):
+    follower_counts = follower_counts[follower_counts['save_time'] != pd.Timestamp(save_time)]
+    row = pd.DataFrame({'save_time': [pd.Timestamp(save_time)], 'followers': [int(followers)]})
+    return pd.concat([follower_counts, row], ignore_index=True).sort_values('save_time', ignore_index=True)
+
+
+# 時刻(時)ごとの件数と合計
+def _hourly_totals(tweets):
+    totals = pd.DataFrame({
+        'hour': tweets['created_at'].dt.hour,
+        'tweets': 1,
+        'favorited_sum': tweets['favorited'],
+        'retweeted_sum': tweets['retweeted'],
+    })
+    return totals.groupby('hour').sum().reindex(range(24), fill_value=0)
+
+
+# ツイートごとの最新の値(tweet_metricsのスキーマ)で、ツイートごとの値と時刻ごとの合計を置き換える
+# すでにあるツイートは、古い値を時刻ごとの合計から引いてから新しい値を足す
+def _upsert_tweet_metrics(tweet_metrics, hourly_engagement, latest):
+    replaced = tweet_metrics['tweet_id'].isin(latest['tweet_id'])
+    hourly = hourly_engagement.set_index('hour').reindex(range(24), fill_value=0)
+    hourly = hourly - _hourly_totals(tweet_metrics[replaced]) + _hourly_totals(latest)
+    hourly_engagement = hourly.rename_axis('hour').reset_index()
+    tweet_metrics = (pd.concat([tweet_metrics[~replaced], latest], ignore_index=True)
+                     .sort_values('created_at', ignore_index=True))
+    return tweet_metrics, hourly_engagement
+
+
+# 新しいツイートのデータ(tweetsのスキーマ)で、ツイートごとの最新の値と時刻ごとの合計を更新
+def update_tweet_metrics(tweet_metrics, hourly_engagement, batch):
+    if len(batch) == 0:
+        return tweet_metrics, hourly_engagement
+    latest = (coerce(batch, TWEETS_SCHEMA)[TWEET_METRICS_SCHEMA.names]
+              .sort_values('save_time')
+              .drop_duplicates('tweet_id', keep='last'))
+    return _upsert_tweet_metrics(tweet_metrics, hourly_engagement, latest)
+
+
+# 取得し直した「いいね数」「リツイート数」(tweet_id, favorited, retweeted)で、保存済みのツイートの値を更新
+# （日時は保存済みの値のまま、保存時刻は取得し直した時刻）
+def refresh_tweet_metrics(tweet_metrics, hourly_engagement, refreshed, save_time):
+    latest = (tweet_metrics[['tweet_id', 'created_at']]
+              .merge(refreshed[['tweet_id', 'favorited', 'retweeted']].drop_duplicates('tweet_id'), on='tweet_id')
+              .assign(save_time=pd.Timestamp(save_time)))
+    if len(latest) == 0:
+        return tweet_metrics, hourly_engagement
+    return _upsert_tweet_metrics(tweet_metrics, hourly_engagement, coerce(latest, TWEET_METRICS_SCHEMA))
+
+
+# 新しいフォロワーのデータ(followersのスキーマ)で、フォロワーごとの最新の値を更新
+def update_follower_metrics(follower_metrics, batch):
+    if len(batch) == 0:
+        return follower_metrics
+    latest = (coerce(batch, FOLLOWERS_SCHEMA)[FOLLOWER_METRICS_SCHEMA.names]
+              .sort_values('save_time')
+              .drop_duplicates('user_id', keep='last'))
+    follower_metrics = follower_metrics[~follower_metrics['user_id'].isin(latest['user_id'])]
+    return pd.concat([follower_metrics, latest], ignore_index=True)
+
+
+# 全履歴からロールアップを作り直す（ロールアップがまだ無い時だけ使う）
+def build_tweet_rollups(tweets):
+    follower_counts = (tweets.groupby('save_time')['followers'].mean().round().astype('int64')
+                       .reset_index())
+    tweet_metrics, hourly_engagement = update_tweet_metrics(
+        empty_rollup(TWEET_METRICS), empty_rollup(HOURLY_ENGAGEMENT), tweets)
+    return follower_counts, tweet_metrics, hourly_engagement
+
+
+# 時刻(時)ごとの平均「いいね数」「リツイート数」（ダッシュボード用）
+def hourly_means(hourly_engagement):
+    hourly = hourly_engagement.set_index('hour')
+    hourly = hourly[hourly['tweets'] > 0]
+    return pd.DataFrame({
+        'favorited': hourly['favorited_sum'] / hourly['tweets'],
+        'retweeted': hourly['retweeted_sum'] / hourly['tweets'],
+    })
+
+
+# ワードごとの人数の上位k件（ダッシュボード用）
+def top_keywords(keyword_counts, k):
+    return keyword_counts.sort_values('count', ascending=False, kind='stable').head(k).reset_index(drop=True)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+"""
+データを追記専用のセグメント(小さなParquet/Arrowファイル)とマニフェスト(manifest.json)で保存します。
+収集スクリプトは毎回、新しいデータだけのセグメントを1つ書き込み、そのセグメントとマニフェストだけをアップロードします。
+小さなセグメントは compact_segments.py で、サイズ・経過時間の条件に合わせて大きなセグメントにまとめます。
+マニフェストにはセグメントごとの日時(スキーマのpartition_column)の最小・最大を記録し、
+まとめる時は月ごとのセグメント(パーティション)に分けるので、期間を指定した読み込みでは必要なセグメントだけを読みます。
+ダッシュボードは LogTail で、前回読み込んだ後に追加されたセグメントだけを読んで表に追加します。
+"""
+
+# 必要なモジュールのインポート
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from data_format import PARQUET, file_format, partition_column, read_table, write_table, to_table, open_writer
+from object_store import PreconditionFailed
+
+
+# マニフェストのファイル名
+MANIFEST_NAME = 'manifest.json'
+
+# セグメントをまとめる目安のサイズ(バイト)
+TARGET_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# この数以上の小さなセグメントが連続していたらまとめる
+MIN_COMPACT_SEGMENTS = 8
+
+# この時間より古い小さなセグメントは、数が少なくてもまとめる
+MAX_SEGMENT_AGE = timedelta(days=7)
+
+# パーティションの単位（月ごと、strftimeの書式）
+PARTITION_FORMAT = '%Y%m'
+
+# マニフェストの条件付きの書き込みが、別の書き込みと重なった時にやり直す回数
+MANIFEST_RETRIES = 5
+
+
+# 空のマニフェスト
+def empty_manifest():
+    return {'version': 0, 'next_seq': 0, 'segments': []}
+
+
+# マニフェストのパス（ローカルのフォルダ、gs://、https:// のどれでも可）
+def manifest_path(log_dir):
+    return '{}/{}'.format(log_dir.rstrip('/'), MANIFEST_NAME)
+
+
+# セグメントのパス
+def segment_path(log_dir, name):
+    return '{}/{}'.format(log_dir.rstrip('/'), name)
+
+
+# マニフェストを読み込み（無い場合は空のマニフェスト）
+def read_manifest(log_dir):
+    path = manifest_path(log_dir)
+    if '://' in path:
+        import fsspec  # gs:// や https:// の読み込み用(pandasのリモート読み込みと同じ)
+        with fsspec.open(path, 'r') as f:
+            return json.load(f)
+    if not os.path.isfile(path):
+        return empty_manifest()
+    with open(path) as f:
+        return json.load(f)
+
+
+# マニフェストを書き込み（一時ファイルに書いてから置き換える）
+def write_manifest(log_dir, manifest):
+    manifest['version'] += 1
+    path = manifest_path(log_dir)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+# セグメントのファイル名（通し番号の範囲を含める、まとめたセグメントはパーティションも含める）
+def segment_name(first_seq, last_seq, fmt=PARQUET, partition=None):
+    if partition is not None:
+        return 'segment-{:010d}-{:010d}-{}.{}'.format(first_seq, last_seq, partition, fmt)
+    return 'segment-{:010d}-{:010d}.{}'.format(first_seq, last_seq, fmt)
+
+
+# マニフェストに登録するセグメントの情報（time_rangeはpartition_columnの(最小, 最大)）
+def segment_entry(log_dir, name, first_seq, last_seq, rows, created_at=None, time_range=None):
+    entry = {
+        'name': name,
+        'first_seq': first_seq,
+        'last_seq': last_seq,
+        'rows': rows,
+        'bytes': os.path.getsize(segment_path(log_dir, name)),
+        'created_at': created_at or datetime.now().isoformat(timespec='seconds'),
+    }
+    if time_range is not None:
+        entry['min_time'] = pd.Timestamp(time_range[0]).isoformat()
+        entry['max_time'] = pd.Timestamp(time_range[1]).isoformat()
+    return entry
+
+
+# DataFrameのpartition_columnの(最小, 最大)（列が無い・空の場合はNone）
+def time_range_of(df, column):
+    if column is None or len(df) == 0 or df[column].isna().all():
+        return None
+    return df[column].min(), df[column].max()
+
+
+# 2つの(最小, 最大)をあわせた範囲
+def merge_time_range(a, b):
+    if a is None or b is None:
+        return a if b is None else b
+    return min(a[0], b[0]), max(a[1], b[1])
+
+
+# 日時が無いセグメントのパーティション
+NO_PARTITION = 'none'
+
+
+# セグメントのパーティション（最小・最大が同じ月ならその月、記録が無いか複数の月にまたがる場合はNone）
+def segment_partition(seg):
+    if 'partition' in seg:
+        return seg['partition']
+    if 'min_time' not in seg:
+        return None
+    first = datetime.fromisoformat(seg['min_time']).strftime(PARTITION_FORMAT)
+    last = datetime.fromisoformat(seg['max_time']).strftime(PARTITION_FORMAT)
+    return first if first == last else None
+
+
+# 期間(開始, 終了)と重なるセグメントだけを選ぶ（最小・最大の記録が無いセグメントは必ず読む）
+def select_segments(manifest, time_range=None):
+    if time_range is None:
+        return list(manifest['segments'])
+    start, end = pd.Timestamp(time_range[0]), pd.Timestamp(time_range[1])
+    return [seg for seg in manifest['segments']
+            if 'min_time' not in seg
+            or (pd.Timestamp(seg['min_time']) <= end and pd.Timestamp(seg['max_time']) >= start)]
+
+
+# 新しいセグメントを少しずつ書き込む（チャンクごとに書き出すので、メモリはチャンクの大きさだけ使う）
+# closeした時にマニフェストへ登録する。withの中で例外が起きた場合は書きかけのファイルを削除する
+class SegmentWriter:
+    def __init__(self, log_dir, schema, fmt=PARQUET, manifest=None):
+        self.log_dir = log_dir
+        self.schema = schema
+        self.fmt = fmt
+        self.manifest = manifest if manifest is not None else read_manifest(log_dir)
+        self.seq = self.manifest['next_seq']
+        self.name = segment_name(self.seq, self.seq, fmt)
+        self.path = segment_path(log_dir, self.name)
+        self.rows = 0
+        self.time_range = None
+        self.segment = None
+        self._writer = None
+
+    # DataFrameを1チャンクとして書き込む
+    def write(self, df):
+        if len(df) == 0:
+            return
+        if self._writer is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            self._writer = open_writer(self.path, self.schema)
+        table = to_table(df, self.schema)
+        self._writer.write_table(table)
+        self.rows += len(df)
+        column = partition_column(self.schema)
+        if column is not None:
+            self.time_range = merge_time_range(self.time_range, time_range_of(table.select([column]).to_pandas(), column))
+
+    # 書き込みを終えてマニフェストを更新し、セグメント名を返す（データが無い場合はNone）
+    def close(self):
+        if self._writer is None:
+            return self.segment
+        self._writer.close()
+        self._writer = None
+        self.manifest['segments'].append(segment_entry(self.log_dir, self.name, self.seq, self.seq, self.rows,
+                                                       time_range=self.time_range))
+        self.manifest['next_seq'] = self.seq + 1
+        write_manifest(self.log_dir, self.manifest)
+        self.segment = self.name
+        return self.segment
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.remove(self.path)
+        return False
+
+
+# 新しいデータを1つのセグメントとして追記し、マニフェストを更新
+# 追加したセグメント名を返す（データが無い場合はNone）
+def append_segment(log_dir, df, schema, fmt=PARQUET, manifest=None):
+    writer = SegmentWriter(log_dir, schema, fmt, manifest)
+    writer.write(df)
+    return writer.close()
+
+
+# 追加したセグメント(names)を、Storageの今のマニフェストに付け直す
+# （収集のアップロードが、compact_segments.pyのまとめた後のマニフェストの書き込みと重なった場合）
+def rebase_manifest(manifest, local, names):
+    known = {seg['name'] for seg in manifest['segments']}
+    manifest['segments'].extend(seg for seg in local['segments'] if seg['name'] in names and seg['name'] not in known)
+    manifest['next_seq'] = max(manifest['next_seq'], local['next_seq'])
+    return manifest
+
+
+# 追加したセグメントとマニフェストをアップロード（セグメントを先に、マニフェストはダウンロードした世代を条件に後から）
+# マニフェストがダウンロードした後に書き換えられていた場合は、読み直して追加したセグメントを付け直してから書き込む
+def upload_segments(store, log_dir, prefix, names, retries=MANIFEST_RETRIES):
+    for name in names:
+        store.upload(segment_path(log_dir, name), prefix + name)
+    for _ in range(retries):
+        try:
+            return store.upload(manifest_path(log_dir), prefix + MANIFEST_NAME, if_unchanged=True)
+        except PreconditionFailed:
+            print('[{}のマニフェストが書き換えられていたので、読み直して追加します]'.format(prefix))
+            local = read_manifest(log_dir)
+            store.download(prefix + MANIFEST_NAME, manifest_path(log_dir))
+            write_manifest(log_dir, rebase_manifest(read_manifest(log_dir), local, set(names)))
+    raise PreconditionFailed(prefix + MANIFEST_NAME)
+
+
+# セグメントを読み込んで1つのDataFrameにする
+# time_range=(開始, 終了) を指定すると、その期間と重なるセグメントだけを読み、期間内の行だけを返す
+# text_dtype は read_table と同じ（文字列の列の型）
+def read_log(log_dir, schema, columns=None, manifest=None, time_range=None, text_dtype=None):
+    if manifest is None:
+        manifest = read_manifest(log_dir)
+    frames = [read_table(segment_path(log_dir, seg['name']), schema, columns=columns, time_range=time_range,
+                         text_dtype=text_dtype)
+              for seg in select_segments(manifest, time_range)]
+    if not frames:
+        return pd.DataFrame({name: pd.Series(dtype=schema.field(name).type.to_pandas_dtype())
+                             for name in (columns or schema.names)})
+    return pd.concat(frames, ignore_index=True)
+
+
+# マニフェストの最後のセグメントの通し番号（セグメントが無い場合は-1）
+def last_seq(manifest):
+    return max((seg['last_seq'] for seg in manifest['segments']), default=-1)
+
+
+# 読み込み済みの表に新しい行を追加（LogTailの初期値）
+def _append(frame, rows):
+    return rows if frame is None else pd.concat([frame, rows], ignore_index=True)
+
+
+# 読み込み済みのセグメントの続きだけを読み込んで、読み込み済みの表に追加する（ダッシュボードの差分更新用）
+# 読み込んだセグメントの通し番号の最大(watermark)を覚えておき、それより後のセグメントだけを読む
+# まとめたセグメント(compact_segments.py)は通し番号の範囲が読み込み済みの範囲に含まれるので、読み直さない
+# 読み込み済みと未読のセグメントをまとめたもの(watermarkをまたぐ)がある場合や、ログが作り直された場合は最初から読み直す
+# fetch(seg) は読む前にセグメントのファイルを用意する関数、append(表, 新しい行) は追加する関数（表はNoneの場合がある）
+class LogTail:
+    def __init__(self, log_dir, schema, time_range=None, text_dtype=None, fetch=None, append=None):
+        self.log_dir = log_dir
+        self.schema = schema
+        self.time_range = time_range
+        self.text_dtype = text_dtype
+        self.fetch = fetch
+        self.append = append or _append
+        self.frame = None
+        self.watermark = -1
+        self.full_reads = 0
+        self.tail_reads = 0
+        self._lock = threading.Lock()
+
+    # 最初から読み直す必要があるか
+    def _needs_full_read(self, manifest):
+        if self.frame is None or last_seq(manifest) < self.watermark:
+            return True
+        return any(seg['first_seq'] <= self.watermark < seg['last_seq'] for seg in manifest['segments'])
+
+    def _read(self, segments):
+        frames = []
+        for seg in segments:
+            if self.fetch is not None:
+                self.fetch(seg)
+            frames.append(read_table(segment_path(self.log_dir, seg['name']), self.schema, time_range=self.time_range,
+                                     text_dtype=self.text_dtype))
+        if not frames:
+            return read_log(self.log_dir, self.schema, manifest=empty_manifest())
+        return pd.concat(frames, ignore_index=True)
+
+    # マニフェストに合わせて更新し、追加した行数を返す（最初から読み直した場合は全体の行数）
+    def update(self, manifest):
+        with self._lock:
+            if self._needs_full_read(manifest):
+                rows = self._read(select_segments(manifest, self.time_range))
+                self.frame = self.append(None, rows)
+                self.full_reads += 1
+            else:
+                new = [seg for seg in manifest['segments'] if seg['first_seq'] > self.watermark]
+                rows = self._read(select_segments({'segments': new}, self.time_range))
+                if len(rows):
+                    self.frame = self.append(self.frame, rows)
+                self.tail_reads += 1
+            self.watermark = last_seq(manifest)
+            return len(rows)
+
+
+# まとめるセグメントのグループを決める
+# 同じパーティション(月)の連続した小さなセグメントを TARGET_SEGMENT_BYTES 以下になるように集め、
+# MIN_COMPACT_SEGMENTS 個以上あるか、いちばん古いものが MAX_SEGMENT_AGE を過ぎていればまとめる
+# 複数の月にまたがるセグメント(以前のデータの移行分など)は、それだけで1グループにして月ごとに分ける
+def plan_compaction(manifest, target_bytes=TARGET_SEGMENT_BYTES,
+                    min_segments=MIN_COMPACT_SEGMENTS, max_age=MAX_SEGMENT_AGE, now=None):
+    now = now or datetime.now()
+    groups = []
+    group = []
+    group_bytes = 0
+    group_partition = None
+
+    def close_group():
+        if len(group) >= 2:
+            oldest = min(datetime.fromisoformat(seg['created_at']) for seg in group)
+            if len(group) >= min_segments or now - oldest >= max_age:
+                groups.append(list(group))
+        group.clear()
+
+    for seg in manifest['segments']:
+        partition = segment_partition(seg)
+        if partition is None:
+            close_group()
+            group_bytes = 0
+            groups.append([seg])
+            continue
+        if seg['bytes'] >= target_bytes:
+            close_group()
+            group_bytes = 0
+            continue
+        if group_bytes + seg['bytes'] > target_bytes or partition != group_partition:
+            close_group()
+            group_bytes = 0
+        group.append(seg)
+        group_bytes += seg['bytes']
+        group_partition = partition
+    close_group()
+    return groups
+
+
+# DataFrameをパーティション(月)ごとに分ける [(パーティション, DataFrame), ...]
+# 日時が無い行は NO_PARTITION にまとめる
+def split_partitions(df, column):
+    if column is None:
+        return [(NO_PARTITION, df)]
+    keys = df[column].dt.strftime(PARTITION_FORMAT).fillna(NO_PARTITION)
+    return [(key, part.reset_index(drop=True)) for key, part in df.groupby(keys, sort=True)]
+
+
+# グループごとにセグメントを(パーティションごとに)まとめて、マニフェストを更新
+# (追加したセグメント名のリスト, 削除したセグメント名のリスト) を返す
+def compact(log_dir, schema, groups, manifest=None):
+    if manifest is None:
+        manifest = read_manifest(log_dir)
+    added = []
+    removed = []
+    for group in groups:
+        fmt = file_format(group[0]['name'])
+        df = pd.concat([read_table(segment_path(log_dir, seg['name']), schema) for seg in group],
+                       ignore_index=True)
+        first_seq = group[0]['first_seq']
+        last_seq = group[-1]['last_seq']
+        created_at = max(seg['created_at'] for seg in group)
+        # パーティション(月)ごとに1つのセグメントにする
+        merged = []
+        for partition, part in split_partitions(df, partition_column(schema)):
+            name = segment_name(first_seq, last_seq, fmt, partition)
+            write_table(part, segment_path(log_dir, name), schema)
+            entry = segment_entry(log_dir, name, first_seq, last_seq, len(part), created_at,
+                                  time_range_of(part, partition_column(schema)))
+            entry['partition'] = partition
+            merged.append(entry)
+            added.append(name)
+        names = {seg['name'] for seg in group}
+        # まとめたセグメントを、元のセグメントがあった位置に置き換える
+        index = next(i for i, seg in enumerate(manifest['segments']) if seg['name'] in names)
+        manifest['segments'] = [seg for seg in manifest['segments'] if seg['name'] not in names]
+        manifest['segments'][index:index] = merged
+        removed.extend(sorted(names))
+    if groups:
+        write_manifest(log_dir, manifest)
+        for name in removed:
+            path = segment_path(log_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+    return added, removed
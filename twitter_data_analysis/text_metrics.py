@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+tweet_data_save.py で保存するツイートの「文字数」と「日時」を、チャンク(CHUNK_SIZE件のDataFrame)ごとにまとめて計算します。
+1件ずつ処理せず、チャンクの本文を区切り文字でつないだ1つの文字列に正規表現をまとめて適用します
+（pandasの .str は1件ずつPythonで処理するので、件数が多いと遅い）。
+・文字数: URL(画像・動画のリンクも含む t.co のURL)と@メンションをすべて除き、Twitterの数え方で重み付けした文字数
+  （半角英数字などは1、日本語・絵文字などは2。280が上限）
+・日時: APIの日時(UTC)を日本時間に変換
+"""
+
+# 必要なモジュールのインポート
+import re
+import unicodedata
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+
+# 日本時間との時差
+JST_OFFSET = timedelta(hours=9)
+
+# チャンクの本文をつなぐ区切り文字（ツイート本文には含まれない）
+SEPARATOR = '\x00'
+
+# 文字数に含めない部分
+# ツイート本文のURL・画像・動画はすべて t.co に短縮される
+URL_PATTERN = r'https?://t\.co/[A-Za-z0-9]+'
+# @メンション（英数字の直後の@はメールアドレスなどなので除かない）
+MENTION_PATTERN = r'[@＠](?<![A-Za-z0-9_!@#$%&*][@＠])[A-Za-z0-9_]{1,15}'
+SPAN_RE = re.compile('{}|{}'.format(URL_PATTERN, MENTION_PATTERN))
+
+# 本文はHTMLの文字参照になっているので、元の1文字に戻してから数える
+HTML_ENTITIES = {'&lt;': '<', '&gt;': '>', '&amp;': '&'}
+
+# 重みが1の文字の範囲（Twitterの数え方、それ以外の文字は2）
+LIGHT_RANGES = [(0x0000, 0x10FF), (0x2000, 0x200D), (0x2010, 0x201F), (0x2032, 0x2037)]
+
+# 絵文字は組み合わせ(ZWJでつないだ絵文字、異体字セレクタ、肌の色)も含めて1つの絵文字として数える
+EMOJI_JOINER_RE = re.compile('(?:\\u200d[^\\s\\x00])+|[\\ufe0e\\ufe0f\\U0001F3FB-\\U0001F3FF]')
+EMOJI_JOINER_CHARS = '\u200d\ufe0e\ufe0f' + ''.join(chr(code) for code in range(0x1F3FB, 0x1F400))
+
+
+# 列の文字列を区切り文字でつなぐ（欠損値は空文字）
+def _join(text):
+    return SEPARATOR.join(text.fillna('').astype(str).tolist())
+
+
+# 本文の列から、URLと@メンションを除いた文字列の列を返す
+def strip_spans(text):
+    joined = SPAN_RE.sub('', _join(text))
+    for entity, char in HTML_ENTITIES.items():
+        joined = joined.replace(entity, char)
+    return pd.Series([part.strip() for part in joined.split(SEPARATOR)], index=text.index, dtype=object)
+
+
+# 重み付けした文字数（Unicodeの正規化をしてから、文字コードの配列で重みを付けて1件ごとに合計する）
+def weighted_length(text):
+    joined = unicodedata.normalize('NFC', _join(text))
+    if any(char in joined for char in EMOJI_JOINER_CHARS):
+        joined = EMOJI_JOINER_RE.sub('', joined)
+    codes = np.frombuffer(joined.encode('utf-32-le'), dtype='<u4')
+    separators = codes == ord(SEPARATOR)
+    light = np.zeros(len(codes), dtype=bool)
+    for start, end in LIGHT_RANGES:
+        light |= (codes >= start) & (codes <= end)
+    weights = np.where(light, 1, 2)
+    weights[separators] = 0
+    # 区切り文字の数で何件目の文字かが分かる
+    lengths = np.bincount(np.cumsum(separators), weights=weights, minlength=len(text))
+    return pd.Series(lengths[:len(text)].astype('int64'), index=text.index)
+
+
+# APIの日時(UTC)の列を日本時間に変換
+def to_jst(created_at):
+    return pd.to_datetime(created_at) + JST_OFFSET
+
+
+# チャンクの「文字数」(characters)と「日時」(created_at)をまとめて計算
+def add_text_metrics(chunk):
+    chunk = chunk.copy()
+    chunk['characters'] = weighted_length(strip_spans(chunk['tweet_text'])).astype('int32')
+    chunk['created_at'] = to_jst(chunk['created_at'])
+    return chunk
@@ -1,18 +1,29 @@
 #!/usr/bin/env python3
 
 """
-Twitter APIからツイートに関するデータを分析用に取得して、定期的にcsvファイルに保存します。
+Twitter APIからツイートに関するデータを分析用に取得して、定期的にParquetファイル(追記専用のセグメント)に保存します。
 （「日時」「テキスト」「文字数」「いいね数」「リツイート数」）
 [Google Cloud Platform]の[Cloud Functions]にデプロイして、[Cloud Scheduler]で定期実行します。
-[Storge]にcsvを更新して保存します。
+[Storge]には毎回、新しいツイートだけのセグメントとマニフェストをアップロードします。
+直近 METRICS_REFRESH_DAYS 日のツイートは、毎回「いいね数」「リツイート数」を取得し直してロールアップ(tweet_metrics)を更新します。
 """
 
 # 必要なモジュールのインストール
 import tweepy
 from datetime import datetime, timedelta
-import csv
 import os
-from google.cloud import storage
+import json
+import pandas as pd
+
+from request_scheduler import RequestScheduler
+from data_format import TWEETS_SCHEMA, PARQUET, with_format, read_table
+from segment_log import MANIFEST_NAME, manifest_path, segment_path, read_manifest, append_segment, read_log, SegmentWriter, \
+    upload_segments
+from object_store import open_store
+from instrumentation import Tracer
+import fake_twitter
+import rollups
+import text_metrics
 
 # Twitterアカウント名(@含まず、＠以降)、各種ツイッターのキーを入力
 def input_twitter_info():
@@ -21,6 +32,17 @@ def input_twitter_info():
     global CONSUMER_SECRET
     global ACCESS_KEY
     global ACCESS_SECRET
+    # 複数アカウントの実行(multi_account.py)では、指定されたアカウントと認証情報を使う
+    if ACCOUNT is not None:
+        screen_name = ACCOUNT['screen_name']
+        CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET = (
+            ACCOUNT.get(key) for key in ('consumer_key', 'consumer_secret', 'access_key', 'access_secret'))
+        return screen_name, CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET
+    # 疑似APIを使う場合は入力しない
+    if FAKE_API is not None:
+        screen_name = FAKE_SCREEN_NAME
+        CONSUMER_KEY = CONSUMER_SECRET = ACCESS_KEY = ACCESS_SECRET = None
+        return screen_name, CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET
     while True:
         screen_name = input('Twitterアカウント名(@含まず、@以降)を入力して下さい: ') # Twitterアカウント名を入力
         CONSUMER_KEY = input('TwitterAPIのCONSUMER_KEYを入力して下さい: ') # TwitterAPIのキーが必要
@@ -33,6 +55,24 @@ def input_twitter_info():
     return screen_name, CONSUMER_KEY, CONSUMER_SECRET, ACCESS_KEY, ACCESS_SECRET
 
 
+# Twitter APIの代わりにローカルの疑似API(fake_twitter.py)を使う場合に指定（Noneなら本物のAPI）
+# 'synthetic' または 'synthetic:followers=20000,tweets=3200' で疑似アカウント、ファイルのパスで記録したレスポンスを再生
+FAKE_API = None
+FAKE_SCREEN_NAME = 'fake_account'  # 記録したレスポンスを再生する場合は、記録したアカウント名
+
+# 疑似APIの遅延とレート制限の時間枠を縮める倍率（0.01なら15分の時間枠が9秒）
+FAKE_TIME_SCALE = 1.0
+
+# 複数アカウントの実行(multi_account.py)で指定する、アカウント名と認証情報の辞書（Noneなら入力する）
+ACCOUNT = None
+
+# 同じ認証情報を使う他のアカウントと共有する、エンドポイントごとのトークンバケット（multi_account.pyで指定）
+# Noneならこの実行だけでレート制限を数える
+RATE_BUCKETS = None
+
+# 本物のAPIのレスポンスを記録するファイル（Noneなら記録しない、記録したファイルはFAKE_APIで再生できる）
+RECORD_FIXTURE = None
+
 # 現在時刻
 now_time = datetime.now() + timedelta(hours=9)
 
@@ -41,92 +81,308 @@ now_time = datetime.now() + timedelta(hours=9)
 # OAuth認証
 def authTwitter():
     global api
+    global scheduler
+    # 疑似APIの場合は、時間枠を縮めた分だけスケジューラーの時間枠も縮める
+    if FAKE_API is not None:
+        api = fake_twitter.open_api(FAKE_API, FAKE_TIME_SCALE)
+        scheduler = RequestScheduler(window=api.window, buckets=RATE_BUCKETS)
+        return api
     auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
     auth.set_access_token(ACCESS_KEY, ACCESS_SECRET)
-    #APIインスタンスを作成、レート制限が補充されるまで待機、残り時間を知らせる
-    api = tweepy.API(auth, wait_on_rate_limit = True, wait_on_rate_limit_notify=True)
+    #APIインスタンスを作成、レート制限の待機はスケジューラーで行う
+    api = tweepy.API(auth)
+    if RECORD_FIXTURE is not None:
+        api = fake_twitter.Recorder(api, RECORD_FIXTURE)
+    scheduler = RequestScheduler(buckets=RATE_BUCKETS)
     return api
 
-# データ保存用のファイルパス
-FILE_PATH = '/tmp/tweets.csv'
+# 保存フォーマット(parquet または arrow)
+DATA_FORMAT = PARQUET
+
+# データ保存用のフォルダ（セグメントとマニフェストを置く）
+LOG_DIR = '/tmp/tweets'
+
+# Storageでのセグメントとマニフェストの保存先
+LOG_PREFIX = 'tweets/'
+
+# 以前の1ファイル形式のパス（初回にセグメントへ移行するためだけに読み込む）
+LEGACY_FILE_PATH = with_format('/tmp/tweets', PARQUET)
+CSV_PATH = '/tmp/tweets.csv'
+
+# チェックポイント（保存済みの最大tweet_idと前回実行の情報）のファイルパス
+CHECKPOINT_PATH = '/tmp/tweets_checkpoint.json'
+
+# user_timelineの1リクエストあたりの最大取得件数
+TIMELINE_PAGE_SIZE = 200
+
+# 「いいね数」「リツイート数」を毎回取得し直すツイートの期間（ツイートの日時からの日数、0なら取得し直さない）
+# それより古いツイートは、最後に取得した時の値のまま
+METRICS_REFRESH_DAYS = 7
+
+# statuses/lookupの1リクエストあたりの最大件数
+LOOKUP_BATCH_SIZE = 100
+
+# この行数ごとにセグメントへ書き出す（メモリに持つのは1チャンク分だけ）
+CHUNK_SIZE = 1000
 
-# ファイルが存在するかどうか確認
+# ダッシュボード用の集計結果(ロールアップ)を置くフォルダとStorageでの保存先
+ROLLUP_DIR = '/tmp/rollups'
+ROLLUP_PREFIX = 'rollups/'
+
+# このスクリプトで更新するロールアップ
+TWEET_ROLLUPS = (rollups.FOLLOWER_COUNTS, rollups.TWEET_METRICS, rollups.HOURLY_ENGAGEMENT)
+
+# Storageのバケット名
+BUCKET_NAME = 'ストレージのバケット名を指定'
+
+# 保存先（ローカルのフォルダを指定すると、Storageを使わずに動かせます）
+STORAGE_URL = 'gs://' + BUCKET_NAME
+
+# 段階ごとの計測結果をPrometheusのテキスト形式で保存するファイル（Noneなら保存せず、JSONのログだけ出力）
+METRICS_FILE = None
+
+# 保存先を開く（クライアントは使い回し、変わっていないファイルはダウンロード・アップロードしない）
+def open_storage():
+    global store
+    store = open_store(STORAGE_URL, writable=True)
+    return store
+
+# セグメントが存在するかどうか確認
 def is_file():
     global file_check
-    file_check = os.path.isfile(FILE_PATH)
+    global manifest
+    manifest = read_manifest(LOG_DIR)
+    file_check = len(manifest['segments']) > 0
     return file_check
 
-# 全ツイートを入れる空のリストを用意
-all_tweets = []
+# 以前の1ファイル形式(parquet/csv)のデータがあれば、最初のセグメントとして取り込む
+def migrate_legacy_file():
+    global file_check
+    if file_check:
+        return
+    store.download_if_exists(os.path.basename(LEGACY_FILE_PATH), LEGACY_FILE_PATH)
+    if not os.path.isfile(LEGACY_FILE_PATH):
+        store.download_if_exists(os.path.basename(CSV_PATH), CSV_PATH)
+    for path in (LEGACY_FILE_PATH, CSV_PATH):
+        if os.path.isfile(path):
+            name = append_segment(LOG_DIR, read_table(path, TWEETS_SCHEMA), TWEETS_SCHEMA,
+                                  DATA_FORMAT, manifest)
+            if name is not None:
+                upload_segments(store, LOG_DIR, LOG_PREFIX, [name])
+                file_check = True
+                print('[{}をセグメントに移行しました]'.format(path))
+            break
 
-# ファイルが存在しない場合、すべてのツイートをリストに入れる
-def get_data():
-    global all_tweets
-    if not file_check:
-        for status in tweepy.Cursor(api.user_timeline, screen_name=screen_name).items():
-            all_tweets.append(status)
-    # ファイルが存在する場合、最新ツイート100件をリストに入れる
+# 保存済みのセグメントをすべてダウンロード（チェックポイントやロールアップが無い時だけ使う）
+def download_segments():
+    for seg in manifest['segments']:
+        path = segment_path(LOG_DIR, seg['name'])
+        if not os.path.isfile(path):
+            store.download(LOG_PREFIX + seg['name'], path)
+
+# 保存済みの最大tweet_idを読み込み（チェックポイントが無い時だけ使う）
+def read_max_tweet_id():
+    download_segments()
+    tweet_ids = read_log(LOG_DIR, TWEETS_SCHEMA, columns=['tweet_id'], manifest=manifest)['tweet_id']
+    return int(tweet_ids.max()) if len(tweet_ids) > 0 else None
+
+# チェックポイントを読み込み
+# チェックポイントが無く、セグメントだけある場合は保存済みの最大tweet_idから作成する
+def read_checkpoint():
+    global checkpoint
+    if os.path.isfile(CHECKPOINT_PATH):
+        with open(CHECKPOINT_PATH) as f:
+            checkpoint = json.load(f)
+    elif file_check:
+        checkpoint = {'max_tweet_id': read_max_tweet_id()}
     else:
-        for status in tweepy.Cursor(api.user_timeline, screen_name=screen_name).items(100):
-            all_tweets.append(status)
-    return all_tweets
+        checkpoint = {'max_tweet_id': None}
+    return checkpoint
 
-# csvファイルに「日時」「テキスト」「文字数」「いいね数」「リツイート数」を保存
-def data_save():
-    # ファイルが存在しない場合、新規ファイル作成
-    if not file_check:
-        with open(FILE_PATH, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['save_time','followers', 'tweet_id', 'created_at', 'tweet_text', 'characters', 'favorited', 'retweeted'])
-            for tweet in all_tweets:
-                tweet.created_at = tweet.created_at + timedelta(hours=9) # 日本時間に修正
-                if (tweet.text.startswith('RT')) or (tweet.text.startswith('@')):
-                    continue # RTとリプライはスキップ
-                else:
-                    tweet_characters = tweet.text # ツイートの文字列
-                    # urlは、文字数としてカウントしない
-                    if len(tweet.entities['urls']) > 0:
-                        tweet_characters = tweet_characters.strip(tweet.entities['urls'][0]['url']).strip()
-                    writer.writerow([now_time, tweet.user.followers_count, tweet.id, tweet.created_at, tweet.text, len(tweet_characters), tweet.favorite_count, tweet.retweet_count])
-    
-    # ファイルが存在する場合、データを追加(最新ツイート100件からRTとリプライを除く)
+
+# ロールアップを読み込み
+# ロールアップがまだ無く、セグメントだけある場合は全履歴から作り直す
+def read_rollups():
+    global follower_counts
+    global tweet_metrics
+    global hourly_engagement
+    if file_check and not os.path.isfile(rollups.rollup_path(ROLLUP_DIR, rollups.TWEET_METRICS)):
+        download_segments()
+        follower_counts, tweet_metrics, hourly_engagement = rollups.build_tweet_rollups(
+            read_log(LOG_DIR, TWEETS_SCHEMA, manifest=manifest))
+        print('[ロールアップを全履歴から作成しました]')
     else:
-        with open(FILE_PATH, 'a', newline='') as f:
-            writer = csv.writer(f)
-            for tweet in all_tweets:
-                tweet.created_at = tweet.created_at + timedelta(hours=9) # 日本時間に修正
-                if (tweet.text.startswith('RT')) or (tweet.text.startswith('@')):
-                    continue # RTとリプライはスキップ
-                else:
-                    tweet_characters = tweet.text # ツイートの文字列
-                    # urlは、文字数としてカウントしない
-                    if len(tweet.entities['urls']) > 0:
-                        tweet_characters = tweet_characters.strip(tweet.entities['urls'][0]['url']).strip()
-                    writer.writerow([now_time, tweet.user.followers_count, tweet.id, tweet.created_at, tweet.text, len(tweet_characters), tweet.favorite_count, tweet.retweet_count])
-
-# Storageへのアップロード処理
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)  
-
-# Storageからのダウンロード処理
-def download_blob(bucket_name, source_blob_name, destination_file_name):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+        follower_counts = rollups.read_rollup(ROLLUP_DIR, rollups.FOLLOWER_COUNTS)
+        tweet_metrics = rollups.read_rollup(ROLLUP_DIR, rollups.TWEET_METRICS)
+        hourly_engagement = rollups.read_rollup(ROLLUP_DIR, rollups.HOURLY_ENGAGEMENT)
+
+
+# since_idより新しいツイートを、max_idをさかのぼりながらページごとに取得（追いつくまで）
+def iter_timeline(since_id=None):
+    max_id = None
+    while True:
+        page = scheduler.call('statuses/user_timeline', api.user_timeline, screen_name=screen_name,
+                              count=TIMELINE_PAGE_SIZE, since_id=since_id, max_id=max_id)
+        if not page:
+            break
+        for status in page:
+            yield status
+        max_id = page[-1].id - 1
+
+
+# 取得したツイートの件数と最大tweet_idを数えながら、そのまま次に渡す（チェックポイント用）
+def count_fetched(statuses):
+    global fetched_count
+    global max_fetched_id
+    for status in statuses:
+        fetched_count += 1
+        if max_fetched_id is None or status.id > max_fetched_id:
+            max_fetched_id = status.id
+        yield status
+
+
+# RTとリプライはスキップ
+def skip_retweets_and_replies(statuses):
+    for status in statuses:
+        if (status.text.startswith('RT')) or (status.text.startswith('@')):
+            continue
+        yield status
+
+
+# ツイートを保存する1行だけに変換（tweepyのStatusはここで手放す）
+# 「日時」「テキスト」「文字数」「いいね数」「リツイート数」
+# 文字数と日本時間への変換は、チャンクごとにまとめて計算する（text_metrics.py）
+def to_record(tweet):
+    return [now_time, tweet.user.followers_count, tweet.id, tweet.created_at, tweet.text, None, tweet.favorite_count, tweet.retweet_count]
+
+
+# CHUNK_SIZE行ずつDataFrameにまとめて、文字数と日時を計算
+def iter_chunks(records, size=CHUNK_SIZE):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield text_metrics.add_text_metrics(pd.DataFrame(chunk, columns=TWEETS_SCHEMA.names))
+            chunk = []
+    if chunk:
+        yield text_metrics.add_text_metrics(pd.DataFrame(chunk, columns=TWEETS_SCHEMA.names))
+
+
+# 前回保存した最新ツイートより新しいツイートを取得するパイプラインを作成（ファイルが存在しない場合はすべて）
+# 取得 → RT・リプライのスキップ → 保存する列だけに変換、を1件ずつ流すので、ツイートをリストに溜めない
+def get_data():
+    global records
+    global fetched_count
+    global max_fetched_id
+    fetched_count = 0
+    max_fetched_id = None
+    statuses = count_fetched(iter_timeline(since_id=checkpoint['max_tweet_id']))
+    records = (to_record(status) for status in skip_retweets_and_replies(statuses))
+    return records
+
+# パイプラインを流して、チャンクごとに新しいセグメントへ書き込む（ロールアップもチャンクごとに更新）
+def data_save():
+    global new_segment
+    global tweet_metrics
+    global hourly_engagement
+    with SegmentWriter(LOG_DIR, TWEETS_SCHEMA, DATA_FORMAT, manifest) as writer:
+        for chunk in iter_chunks(records):
+            writer.write(chunk)
+            tweet_metrics, hourly_engagement = rollups.update_tweet_metrics(tweet_metrics, hourly_engagement, chunk)
+    new_segment = writer.close()
+    print('[新しいツイート: {}件 保存: {}件]'.format(fetched_count, writer.rows))
+    if new_segment is not None:
+        print('[セグメント{}を保存しました]'.format(new_segment))
+
+
+# 直近 METRICS_REFRESH_DAYS 日のツイートの「いいね数」「リツイート数」をstatuses/lookupで取得し直して、ロールアップを更新
+# （今回取得したツイートは除く。削除されたツイートは返ってこないので、前の値のまま）
+def refresh_metrics():
+    global tweet_metrics
+    global hourly_engagement
+    global refreshed_count
+    refreshed_count = 0
+    if not METRICS_REFRESH_DAYS:
+        return
+    since = now_time - timedelta(days=METRICS_REFRESH_DAYS)
+    recent = tweet_metrics[(tweet_metrics['created_at'] >= since) & (tweet_metrics['save_time'] < now_time)]
+    tweet_ids = [int(tweet_id) for tweet_id in recent['tweet_id']]
+    futures = [scheduler.submit('statuses/lookup', api.statuses_lookup, id_=tweet_ids[i:i + LOOKUP_BATCH_SIZE], trim_user=True)
+               for i in range(0, len(tweet_ids), LOOKUP_BATCH_SIZE)]
+    refreshed = pd.DataFrame([(status.id, status.favorite_count, status.retweet_count)
+                              for future in futures for status in future.result()],
+                             columns=['tweet_id', 'favorited', 'retweeted'])
+    tweet_metrics, hourly_engagement = rollups.refresh_tweet_metrics(tweet_metrics, hourly_engagement, refreshed, now_time)
+    refreshed_count = len(refreshed)
+    print('[直近{}日のツイート: {}件のいいね数・リツイート数を取得し直しました]'.format(METRICS_REFRESH_DAYS, refreshed_count))
+
+
+# 今回のフォロワー数を追加してロールアップを保存（新しいツイートが無い回もフォロワー数は記録する）
+def rollup_save():
+    global follower_counts
+    user = scheduler.call('users/show', api.get_user, screen_name=screen_name)
+    follower_counts = rollups.update_follower_counts(follower_counts, now_time, user.followers_count)
+    rollups.write_rollup(ROLLUP_DIR, rollups.FOLLOWER_COUNTS, follower_counts)
+    rollups.write_rollup(ROLLUP_DIR, rollups.TWEET_METRICS, tweet_metrics)
+    rollups.write_rollup(ROLLUP_DIR, rollups.HOURLY_ENGAGEMENT, hourly_engagement)
+    print('[ロールアップを保存しました]')
+
+
+# チェックポイントを更新して保存（RTとリプライも含めた、取得済みの最大tweet_id）
+def checkpoint_save():
+    if max_fetched_id is not None:
+        if checkpoint['max_tweet_id'] is None or max_fetched_id > checkpoint['max_tweet_id']:
+            checkpoint['max_tweet_id'] = max_fetched_id
+    checkpoint['last_run'] = now_time.isoformat(timespec='seconds')
+    checkpoint['last_fetched'] = fetched_count
+    with open(CHECKPOINT_PATH, 'w') as f:
+        json.dump(checkpoint, f)
+    print('[チェックポイントを保存しました max_tweet_id: {}]'.format(checkpoint['max_tweet_id']))
+
 
 # main関数を実行(GCPのCloud Functions用にevent,contextが引数に)
 # トリガーをpub/subに設定、ファイルダウンロードしてデータ追加してアップロード
+# 段階(ダウンロード → 認証 → 読み込み → 取得・変換・保存 → 取得し直し → アップロード)ごとに計測してログに出力
 def main(event, context):
     input_twitter_info()
-    download_blob('ストレージのバケット名を指定', 'ストレージに保存されているファイル名を指定', FILE_PATH)
-    authTwitter()
-    is_file()
-    get_data()
-    data_save()
-    upload_blob('ストレージのバケット名を指定', FILE_PATH, 'ストレージに保存するファイル名を指定')
-
-
+    tracer = Tracer('tweets')
+    with tracer.span('main'):
+        with tracer.span('download'):
+            open_storage()
+            os.makedirs(LOG_DIR, exist_ok=True)
+            store.download_if_exists(LOG_PREFIX + MANIFEST_NAME, manifest_path(LOG_DIR))
+            os.makedirs(ROLLUP_DIR, exist_ok=True)
+            for name in TWEET_ROLLUPS:
+                store.download_if_exists(ROLLUP_PREFIX + rollups.rollup_file_name(name), rollups.rollup_path(ROLLUP_DIR, name))
+            store.download_if_exists(os.path.basename(CHECKPOINT_PATH), CHECKPOINT_PATH)
+        with tracer.span('auth'):
+            authTwitter()
+            tracer.attach(scheduler)
+        with tracer.span('read'):
+            is_file()
+            migrate_legacy_file()
+            read_checkpoint()
+            read_rollups()
+        # 取得・変換・保存は1件ずつ流れるので1つの段階として計測（行数は取得したツイート数）
+        with tracer.span('fetch_save') as span:
+            get_data()
+            data_save()
+            span.add_rows(fetched_count)
+        with tracer.span('refresh') as span:
+            refresh_metrics()
+            span.add_rows(refreshed_count)
+        with tracer.span('rollup'):
+            rollup_save()
+            checkpoint_save()
+        # 新しいセグメントとマニフェストだけをアップロード
+        with tracer.span('upload'):
+            if new_segment is not None:
+                upload_segments(store, LOG_DIR, LOG_PREFIX, [new_segment])
+            for name in TWEET_ROLLUPS:
+                store.upload(rollups.rollup_path(ROLLUP_DIR, name), ROLLUP_PREFIX + rollups.rollup_file_name(name))
+            # データのアップロード後にチェックポイントをアップロード（途中で失敗しても取りこぼさない）
+            store.upload(CHECKPOINT_PATH, os.path.basename(CHECKPOINT_PATH))
+    print(scheduler.metrics())
+    scheduler.shutdown()
+    if METRICS_FILE is not None:
+        tracer.write_prometheus(METRICS_FILE)
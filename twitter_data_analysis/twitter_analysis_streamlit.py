@@ -8,22 +8,31 @@ streamlitを使ったwebアプリです。
 
 # 必要なモジュールのインストール
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit import caching
+from streamlit.report_thread import get_report_ctx, add_report_ctx
 from matplotlib import pyplot as plt
 import matplotlib.dates as mdates
 
 import pandas as pd
-from bokeh.io import show, save
-from bokeh.plotting import figure, ColumnDataSource, output_file, show, reset_output
-from bokeh.layouts import column, gridplot
-from bokeh.models import DataSource, RangeTool, HoverTool, DatetimeTickFormatter, Range1d
-import bokeh.palettes as bp
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from jinja2.utils import markupsafe
 
+from data_format import TWEETS_SCHEMA, FOLLOWERS_SCHEMA, TEXT_DTYPE, MONTH_CSV, ANALYTICS_CSV, csv_file, \
+    compact_frame, append_compact, read_csv_typed
+from segment_log import MANIFEST_NAME, manifest_path, segment_path, read_manifest, LogTail
+from object_store import open_store, open_file, read_etag
+import rollups
+import follower_snapshots
+from instrumentation import Tracer
+from dashboard_views import VIEWS, LRUCache, render_html, figure_height, data_key, snapshot_frames, frames_memory, followers_by_save_time, \
+    wordrank_table, analytics_time_index, analytics_time_df, analytics_hourly, TableIndex, INDEX_COLUMN, PAGE_SIZES, page_count
+
 st.set_page_config(layout="wide")
 
 # パスワードはstreamlitのシークレットに保存
@@ -42,10 +51,16 @@ now_time = datetime.now() + timedelta(hours=9)
 
 # ファイルパスはstreamlitのシークレットに保存
 # ツイートごとAPIデータへのファイルのパス
-FILE_PATH_1 = st.secrets['file_path']  # APIツイートデータからGCPでcsvファイルを定時更新
+FILE_PATH_1 = st.secrets['file_path']  # APIツイートデータからGCPでセグメントを定時追加(manifest.jsonのあるフォルダを指定、gs://・https://・ローカルのフォルダ)
 
 # フォロワー詳細データファイル読み込み
-FILE_PATH_2 = st.secrets['file_path_2']  # APIフォロワーデータからGCPでcsvファイルを定時更新
+FILE_PATH_2 = st.secrets['file_path_2']  # APIフォロワーデータからGCPでセグメントを定時追加(manifest.jsonのあるフォルダを指定)
+
+# 収集時に更新している集計結果(ロールアップ)のフォルダ
+ROLLUP_PATH = st.secrets['rollup_path']  # GCPの収集スクリプトでロールアップを定時更新(rollups/フォルダを指定)
+
+# フォロワーごとのフォロワー数・フォロー数の履歴のフォルダ（keyframes/とdeltas/のあるフォルダ、無い場合は推移を表示しない）
+SNAPSHOT_PATH = st.secrets.get('snapshot_path')  # GCPの収集スクリプトで定時追加(follower_snapshots/フォルダを指定)
 
 # Twitterアナリティクスの月ごとデータ(2017/04-2021/09)
 FILE_PATH_3 = st.secrets['file_path_3']  # TwitterAnalyticsデータをgoogle colabでcsvに保存
@@ -53,65 +68,358 @@ FILE_PATH_3 = st.secrets['file_path_3']  # TwitterAnalyticsデータをgoogle co
 # Twitterアナリティクスのツイートごとデータ(2020/10-2021/09)
 FILE_PATH_4 = st.secrets['file_path_4']  # TwitterAnalyticsデータをgoogle colabでcsv保存
 
-# フォロワー詳細データをmacabで形態素解析したキーワードランキング
-FILE_PATH_5 = st.secrets['file_path_5']  # APIフォロワーデータをgoogle colabでキーワード分析しcsvに保存
-
 st.title('Twitterデータ分析')
 
-# csvファイルをpandasで読み取り
-@st.cache(ttl=3600)
-def load_data():
-    df = pd.read_csv(FILE_PATH_1)
-    df['save_time'] = pd.to_datetime(df['save_time'])
-    df['created_at'] = pd.to_datetime(df['created_at'])
+# Storageから取得したファイルを置くフォルダ（変わっていないファイルは再ダウンロードしない）
+MIRROR_DIR = '/tmp/twitter_dashboard'
+
+# Storageのファイルが変わったかどうかを確認する間隔(秒)
+REVALIDATE_SECONDS = 300
+
+# ツイート・フォロワーのデータを表示する期間の初期値(日)とデータの開始日
+DEFAULT_WINDOW_DAYS = 30
+FIRST_DATE = date(2017, 4, 1)
+
+
+# セグメントのマニフェストを手元にそろえて、その世代を返す（セグメントは読み込む時に必要な分だけダウンロード）
+def mirror_log(location, name):
+    store = open_store(location)
+    log_dir = os.path.join(MIRROR_DIR, name)
+    os.makedirs(log_dir, exist_ok=True)
+    store.download(MANIFEST_NAME, manifest_path(log_dir))
+    names = {seg['name'] for seg in read_manifest(log_dir)['segments']}
+    # まとめられて(compact_segments.py)マニフェストから消えたセグメントは削除
+    for file_name in os.listdir(log_dir):
+        if file_name.startswith('segment-') and file_name.split('.etag')[0] not in names:
+            os.remove(os.path.join(log_dir, file_name))
+    return read_etag(manifest_path(log_dir))['generation']
+
+# 1つのファイルを手元にそろえて、世代を返す（無い場合はNone）
+def mirror_file(url, name):
+    store, file_name = open_file(url)
+    path = os.path.join(MIRROR_DIR, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    store.download_if_exists(file_name, path)
+    etag = read_etag(path)
+    return etag['generation'] if etag is not None else None
+
+# ファイルが変わったかどうかの確認（REVALIDATE_SECONDSごと、結果の世代を読み込みのキャッシュのキーにする）
+@st.cache(ttl=REVALIDATE_SECONDS)
+def revalidate():
+    return {
+        'tweets': mirror_log(FILE_PATH_1, 'tweets'),
+        'followers': mirror_log(FILE_PATH_2, 'followers'),
+        'rollups': tuple(mirror_file(rollups.rollup_path(ROLLUP_PATH, name), os.path.join('rollups', rollups.rollup_file_name(name)))
+                         for name in rollups.SCHEMAS),
+        'month': mirror_file(FILE_PATH_3, 'month.csv'),
+        'analytics': mirror_file(FILE_PATH_4, 'analytics.csv'),
+        'snapshots': tuple(mirror_log(SNAPSHOT_PATH.rstrip('/') + '/' + sub_dir, os.path.join('follower_snapshots', sub_dir))
+                           for sub_dir in (follower_snapshots.KEYFRAMES, follower_snapshots.DELTAS))
+                     if SNAPSHOT_PATH else None,
+    }
+
+# ツイート・フォロワーのセグメントの読み込み状態（期間ごと、全セッション共通）
+# 期間(開始, 終了)と重なるセグメントだけを、読む時にダウンロードする（期間外の行は読み込まない）
+# マニフェストが変わった時は、前回の後に追加されたセグメントだけを読んで表に追加する(LogTail)
+@st.cache(max_entries=4, allow_output_mutation=True)
+def log_tail(location, name, schema, time_range):
+    store = open_store(location)
+    log_dir = os.path.join(MIRROR_DIR, name)
+
+    def fetch(seg):
+        path = segment_path(log_dir, seg['name'])
+        if not os.path.isfile(path):
+            store.download(seg['name'], path)
+
+    return LogTail(log_dir, schema, time_range, TEXT_DTYPE, fetch=fetch, append=append_compact)
+
+# セグメントのマニフェストに合わせて読み込み状態を更新し、表を返す
+def read_log_tail(location, name, schema, time_range):
+    tail = log_tail(location, name, schema, time_range)
+    full_reads = tail.full_reads
+    rows = tail.update(read_manifest(os.path.join(MIRROR_DIR, name)))
+    tracer.event('log_tail', table=name, rows=rows, full_read=tail.full_reads > full_reads, watermark=tail.watermark)
+    return tail.frame
+
+# ファイルをpandasで読み取り（ツイート・フォロワーは型付きのParquet、日時の変換は不要）
+# 引数の世代か期間が変わった時だけ読み込む（ツイート・フォロワーは追加されたセグメントだけ）
+# どの表も読み込み時に型を指定して、メモリの少ない型にする（compact_frame: 整数は小さい型、文字列はpyarrow・category）
+# 読み込みは load_all で並行して実行するので、スピナーは表示しない
+@st.cache(max_entries=4, show_spinner=False, allow_output_mutation=True)
+def load_data(generation, time_range):
+    df = read_log_tail(FILE_PATH_1, 'tweets', TWEETS_SCHEMA, time_range)
     return df
 
-@st.cache(ttl=3600)
-def load_data2():
-    df_followers = pd.read_csv(FILE_PATH_2)
+@st.cache(max_entries=4, show_spinner=False, allow_output_mutation=True)
+def load_data2(generation, time_range):
+    df_followers = read_log_tail(FILE_PATH_2, 'followers', FOLLOWERS_SCHEMA, time_range)
     return df_followers
 
-@st.cache(ttl=3600)
-def load_data3():
-    df_month = pd.read_csv(FILE_PATH_3)
-    df_month['日時'] = pd.to_datetime(df_month['日時'])
+# ロールアップを読み込み（全履歴のgroupbyはしない）
+@st.cache(max_entries=1, show_spinner=False)
+def load_rollups(generations):
+    return {name: compact_frame(rollups.read_rollup(os.path.join(MIRROR_DIR, 'rollups'), name)) for name in rollups.SCHEMAS}
+
+# フォロワーごとの履歴は、期間の読み込みに必要なセグメントだけをダウンロードして、期間の終わりの状態と推移を作る
+@st.cache(max_entries=4, show_spinner=False, allow_output_mutation=True)
+def load_snapshots(generations, time_range):
+    snapshot_dir = os.path.join(MIRROR_DIR, 'follower_snapshots')
+    if generations is not None:
+        store = open_store(SNAPSHOT_PATH)
+        for sub_dir, names in follower_snapshots.history_segments(snapshot_dir, *time_range).items():
+            for name in names:
+                path = segment_path(os.path.join(snapshot_dir, sub_dir), name)
+                if not os.path.isfile(path):
+                    store.download(sub_dir + '/' + name, path)
+    return snapshot_frames(snapshot_dir, time_range)
+
+# Twitterアナリティクスのcsvは、使う列だけを読み込み時に日時へ変換して読む
+@st.cache(max_entries=1, show_spinner=False)
+def load_data3(generation):
+    df_month = read_csv_typed(os.path.join(MIRROR_DIR, 'month.csv'), MONTH_CSV)
     df_month = df_month.set_index('日時')
     return df_month
 
-@st.cache(ttl=3600)
-def load_data4():
-    tweets_df = pd.read_csv(FILE_PATH_4)
-    tweets_df['時間'] = pd.to_datetime(tweets_df['時間'])
+@st.cache(max_entries=1, show_spinner=False)
+def load_data4(generation):
+    tweets_df = read_csv_typed(os.path.join(MIRROR_DIR, 'analytics.csv'), ANALYTICS_CSV)
     return tweets_df
 
-@st.cache(ttl=3600)
-def load_data5():
-    df_wordrank = pd.read_csv(FILE_PATH_5)
-    return df_wordrank
+# 読み込みを並行して実行し、ビューに渡す形(名前 -> 表)で返す
+# 各スレッドにもstreamlitの実行中の情報を渡して、st.cacheのキャッシュを使えるようにする
+def load_all(generations, time_range):
+    ctx = get_report_ctx()
+
+    def run(func, *args):
+        add_report_ctx(threading.current_thread(), ctx)
+        return func(*args)
+
+    calls = {
+        'tweets': (load_data, generations['tweets'], time_range),
+        'followers': (load_data2, generations['followers'], time_range),
+        'month': (load_data3, generations['month']),
+        'analytics': (load_data4, generations['analytics']),
+        'rollups': (load_rollups, generations['rollups']),
+        'snapshots': (load_snapshots, generations['snapshots'], time_range),
+    }
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = {name: executor.submit(run, *call) for name, call in calls.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+# ツイート・フォロワーのデータを表示する期間（選んだ期間のデータだけを読み込む）
+# ツイートはツイート日時、フォロワーは保存日時で絞り込みます
+def select_dates():
+    today = now_time.date()
+    dates = st.sidebar.date_input('ツイート・フォロワーのデータの期間', value=(today - timedelta(days=DEFAULT_WINDOW_DAYS), today),
+                                  min_value=FIRST_DATE, max_value=today)
+    if not isinstance(dates, (tuple, list)):
+        dates = (dates,)
+    if len(dates) < 2:
+        dates = (dates[0], dates[0])
+    return datetime.combine(dates[0], datetime.min.time()), datetime.combine(dates[1], datetime.max.time())
+
+time_range = select_dates()
+
+
+# 読み込み・集計・描画の計測（全セッション共通、スパンの記録は残さずに集計だけを持つ）
+# シークレットの metrics_log にファイルを指定するとJSONのログを保存、metrics_port を指定するとPrometheus形式で公開
+@st.cache(allow_output_mutation=True)
+def dashboard_tracer():
+    tracer = Tracer('dashboard', log_file=st.secrets.get('metrics_log'), reset_peak=False, max_records=0)
+    if st.secrets.get('metrics_port'):
+        tracer.serve_prometheus(int(st.secrets['metrics_port']))
+    return tracer
+
+tracer = dashboard_tracer()
 
 
 # データ読取実行
 data_load_state = st.text('Loading data...')
-df = load_data()
-df_followers = load_data2()
-df_month = load_data3()
-tweets_df = load_data4()
-df_wordrank = load_data5()
+with tracer.span('load') as span:
+    generations = revalidate()
+    frames = load_all(generations, time_range)
+    span.add_rows(sum(len(frame) for frame in frames.values() if not isinstance(frame, dict)))
 data_load_state.text('Loading data...Done!')
 
+df = frames['tweets']
+df_followers = frames['followers']
+df_month = frames['month']
+tweets_df = frames['analytics']
+
+# ビューに渡すデータのキー（保存先のファイルの世代と期間、読み込んだ表の中身からは計算しない）
+generation_key = data_key(generations, time_range)
+
+# 表ごとのメモリ使用量（データが変わった時だけ計算してログに出力、データのキーごとに全セッション共通）
+@st.cache(allow_output_mutation=True)
+def memory_cache():
+    return LRUCache(max_entries=2)
+
+memory = memory_cache().get(generation_key)
+if memory is None:
+    memory = pd.DataFrame(frames_memory(frames), columns=['表', '行数', 'MB']).set_index('表')
+    memory_cache().put(generation_key, memory)
+with st.sidebar.expander('読み込んだデータのメモリ使用量'):
+    st.dataframe(memory.round(2))
+    st.write('合計 {:.1f} MB'.format(memory['MB'].sum()))
+
+@st.cache(max_entries=1)
+def log_memory(generation_key):
+    tracer.event('memory', tables=memory['MB'].round(2).to_dict(), total_mb=round(memory['MB'].sum(), 2))
+
+log_memory(generation_key)
+
+
+# 作成した図のHTMLを保存しておく件数と合計サイズ(バイト)の上限
+FIGURE_CACHE_ENTRIES = 32
+FIGURE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+# ビューごとのグラフ用データと図のHTML（全セッション共通のメモリ上のキャッシュ）
+# キーにデータのキー(保存先のファイルの世代と期間)を含めるので、データが変わると作り直し、古いものは使われないまま捨てられる
+@st.cache(allow_output_mutation=True)
+def view_data_cache():
+    return LRUCache(max_entries=len(VIEWS) * 2)
+
+@st.cache(allow_output_mutation=True)
+def figure_cache():
+    return LRUCache(max_entries=FIGURE_CACHE_ENTRIES, max_bytes=FIGURE_CACHE_BYTES)
+
+def prepare_view(view):
+    cache = view_data_cache()
+    key = (view.label, generation_key)
+    data = cache.get(key)
+    if data is None:
+        with tracer.span('aggregate', view=view.file_name):
+            data = view.prepare(frames)
+        cache.put(key, data)
+    return data
+
+# 図のHTMLと高さを返す（キャッシュに無い時だけ図を作成する、ファイルには書き出さない）
+# 期間を選ぶビューは、選んだ期間もキーに含める
+def render_view(view, x_range=None):
+    cache = figure_cache()
+    key = (view.label, generation_key, x_range)
+    rendered = cache.get(key)
+    if rendered is None:
+        data = prepare_view(view)
+        with tracer.span('render', view=view.file_name):
+            fig = view.build(data, x_range) if view.ranged else view.build(data)
+            rendered = (render_html(view, fig), figure_height(fig))
+        cache.put(key, rendered, len(rendered[0]))
+    return rendered
+
+
+# ダウンロード用に作成したcsvを保存しておく件数と合計サイズ(バイト)の上限（一時ファイルのサイズ）
+EXPORT_CACHE_ENTRIES = 16
+EXPORT_CACHE_BYTES = 128 * 1024 * 1024
+
+# 作成したcsvの一時ファイル（全セッション共通、キーは表の名前・データのキー・圧縮の有無）
+# 値は (ファイル, ロック)。ボタンに渡す時に先頭から読み直すので、同じファイルを同時に読まないようにロックする
+@st.cache(allow_output_mutation=True)
+def export_cache():
+    return LRUCache(max_entries=EXPORT_CACHE_ENTRIES, max_bytes=EXPORT_CACHE_BYTES)
+
+# csvはボタンが押された時だけ一時ファイルに作成（表全体のハッシュは計算せず、データのキーで使い回す）
+# table は表か、表を作る関数（ボタンが押された時だけ呼ぶ）
+def csv_download(name, table, file_name):
+    cache = export_cache()
+    key = (name, generation_key, export_gzip)
+    entry = cache.get(key)
+    if entry is None:
+        if not st.button("Create CSV", key='create_' + name):
+            return
+        f = csv_file(table() if callable(table) else table, compress=export_gzip)
+        entry = (f, threading.Lock())
+        cache.put(key, entry, os.fstat(f.fileno()).st_size)
+    f, lock = entry
+    with lock:
+        if export_gzip:
+            st.download_button("Download CSV", f, file_name + '.gz', "application/gzip", key='download_' + name)
+        else:
+            st.download_button("Download CSV", f, file_name, "text/csv", key='download_' + name)
+
+
+# 表の並び順と絞り込みの結果を保存しておく件数
+TABLE_INDEX_ENTRIES = 16
+
+# 表と並び順（全セッション共通、キーは表の名前とデータのキー）
+@st.cache(allow_output_mutation=True)
+def table_index_cache():
+    return LRUCache(max_entries=TABLE_INDEX_ENTRIES)
+
+# build() は表を作る関数（データが変わった時だけ呼ぶ）
+def table_index(name, build):
+    cache = table_index_cache()
+    key = (name, generation_key)
+    index = cache.get(key)
+    if index is None:
+        with tracer.span('aggregate', table=name):
+            index = TableIndex(build())
+        cache.put(key, index)
+    return index
+
+# ページ送りの表（並べ替え・絞り込みはサーバーで行い、選んだページの行だけをブラウザに送る）
+# 並べ替えは列ごとに1回だけ計算した並び順を使うので、毎回表全体を並べ替えない
+def paged_table(name, build, sort_column=INDEX_COLUMN, ascending=True, width=1200, height=400):
+    index = table_index(name, build)
+    columns = [INDEX_COLUMN] + [str(column) for column in index.table.columns]
+    sort_box, order_box, filter_box, text_box, size_box, page_box = st.columns(6)
+    sort_column = sort_box.selectbox('並べ替える列', columns, index=columns.index(sort_column), key='sort_' + name)
+    ascending = order_box.radio('順序', ('昇順', '降順'), index=0 if ascending else 1, key='order_' + name) == '昇順'
+    filter_column = filter_box.selectbox('絞り込む列', ['なし'] + index.text_columns(), key='filter_' + name)
+    text = text_box.text_input('含む文字', key='text_' + name)
+    page_size = size_box.selectbox('1ページの行数', PAGE_SIZES, key='size_' + name)
+    rows = index.rows(sort_column, ascending, None if filter_column == 'なし' else filter_column, text)
+    pages = page_count(rows, page_size)
+    page = min(int(page_box.number_input('ページ (全{}ページ)'.format(pages), min_value=1, value=1, step=1,
+                                         key='page_' + name)), pages)
+    st.dataframe(index.page(rows, page, page_size), width=width, height=height)
+    first = (page - 1) * page_size
+    st.write('{}件中 {}～{}件目'.format(len(rows), min(first + 1, len(rows)), min(first + page_size, len(rows))))
+    return index
+
+
+# サイドバーにラジオボタンを作成
+genre = st.sidebar.radio(
+     "表示する図表を選択してください",
+     tuple(VIEWS))
+
+# csvのダウンロードをgzipで圧縮するか
+export_gzip = st.sidebar.checkbox('CSVをgzipで圧縮してダウンロード')
+
+# 長い時系列のビューは、上段に詳細表示する期間をサイドバーで選択（下段は全期間を間引いて表示）
+# 選んだ期間のデータだけを全件で描画するので、全期間を選ぶと点が多い時は間引かれます
+def select_range(view):
+    x = prepare_view(view)['x']
+    if len(x) == 0 or x[0] == x[-1]:
+        return None
+    first, last = pd.Timestamp(x[0]).to_pydatetime(), pd.Timestamp(x[-1]).to_pydatetime()
+    return st.sidebar.slider('上段のグラフに表示する期間', min_value=first, max_value=last, value=(first, last))
+
+
+# 描画（選択されたビューだけデータと図を作成し、HTMLはメモリから表示・ダウンロード）
+selected_view = VIEWS[genre]
+x_range = select_range(selected_view) if selected_view.ranged else None
+fig_html, fig_height = render_view(selected_view, x_range)
+components.html(fig_html.decode('utf-8'), height=fig_height + 50,
+                width=None if selected_view.use_container_width else 850)
+btn = st.download_button(label="Download Fig", data=fig_html, file_name=selected_view.file_name, mime="text/html")
+if selected_view.stats is not None:
+    for label, value in selected_view.stats(frames):
+        st.write(label, value)
+st.markdown('''
+***
+''')
+
 
-st.write('ツイートごとのデータ (2017/4～最新更新)')
+st.write('ツイートごとのデータ (サイドバーで選択した期間)')
 
-df_index = df.sort_index(ascending=False)
-st.dataframe(df_index, width=1200, height=400)
+# 新しい順に表示
+tweets_index = paged_table('tweets', lambda: df, ascending=False)
 
 # 表をCSVでダウンロード
-@st.cache(ttl=3600)
-def convert_df(df):
-    return df.to_csv().encode('utf-8')
-
-csv1 = convert_df(df_index)
-st.download_button("Download CSV", csv1, "tweet_data_new.csv", "text/csv")
+csv_download('tweets', lambda: tweets_index.table.iloc[tweets_index.rows(INDEX_COLUMN, False)], "tweet_data_new.csv")
 
 st.markdown('''
 ***
@@ -119,271 +427,44 @@ st.markdown('''
 
 st.write('フォロワー数の推移 (12時間ごと更新)')
 
-# 保存時間でグループ分け
-df_save_time = df.groupby('save_time').mean()
+# 保存時間ごとのフォロワー数(ロールアップ)
+with tracer.span('aggregate', table='followers_num'):
+    df_save_time = followers_by_save_time(frames)
 df_followers_num = df_save_time['followers'].astype('int').sort_index(ascending=False) 
 st.dataframe(df_followers_num, width=1200, height=400)
 
 # 表をCSVでダウンロード
-csv1_1 = convert_df(df_followers_num)
-st.download_button("Download CSV", csv1_1, "followers_num_new.csv", "text/csv")
+csv_download('followers_num', df_followers_num, "followers_num_new.csv")
 
 st.markdown('''
 ***
 ''')
 
-# フォロワー数グラフ作成用の辞書
-x = df_save_time.index
-y = df_save_time['followers']
-date = x.strftime('%Y-%m-%d %H:%M:%S')
-source = ColumnDataSource(data = dict(x = x, y = y, date=date))
-
-# tooltips設定
-TOOLTIPS = [('date and time', '@date'), ('followers', '@y')]
 
-# グラフ全体の設定
-fig1 = figure(tools = "hover, save", tooltips=TOOLTIPS,
-           title='最新フォロワー数', plot_width=800, plot_height=400, 
-           x_axis_label='date', y_axis_label='followers', x_axis_type='datetime', background_fill_color='DarkGreen')
+st.write('フォロワーに関するデータ (サイドバーで選択した期間)')
 
-# X軸の設定
-x_format = "%m/%d"
-fig1.xaxis.formatter = DatetimeTickFormatter(days=[x_format], months=[x_format], years=[x_format])
+followers_index = paged_table('followers', lambda: df_followers, ascending=False)
 
-# 折れ線図
-fig1.line('x', 'y', line_width=3, legend_label='フォロワー数', source=source, color='Aqua')
-
-# 散布図
-fig1.circle('x', 'y', size=15, fill_alpha=0.5, source=source, color='Aqua')
-
-# 凡例の位置
-fig1.legend.location = 'top_left'
-
-
-# サイドバーにラジオボタンを作成
-genre = st.sidebar.radio(
-     "表示する図表を選択してください",
-     ('フォロワー数 最新',
-      'ツイートごと いいね数 最新', 
-      '時刻ごと いいね数 最新',
-      'フォロワーごと フォロワー数 最新',
-      'フォロワー 頻出ワードランク',       
-      '月間インプレッション フォロワー',
-      'ツイートごとインプレッション数',
-      '時刻ごとインプレッション数'
-      ))
-
-# 描画
-if genre == 'フォロワー数 最新':
-    output_file('followers_num_new.html')
-    save(fig1)
-    st.bokeh_chart(fig1, use_container_width=False)
-    with open("followers_num_new.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="followers_num_new.html", mime="text/html")
-    st.markdown('''
-    ***
-    ''')
-
-
-# ツイート時間でグループ分け
-df_created_at = df.groupby('created_at').mean()
-
-# ツイートごと「いいね数」グラフ作成用の辞書
-x = df_created_at.index
-y = df_created_at['favorited'].astype(int)
-date = x.astype(str)
-source = ColumnDataSource(data = dict(x=x, y=y, date=date))
-
-# tooltips設定
-TOOLTIPS = [('ツイート日時', '@date'), ('いいね数', '@y')]
-
-# グラフ全体の設定
-p = figure(tools = "hover, save", tooltips=TOOLTIPS, title='ツイートごとの「いいね数」 (2017/4～最新更新)', plot_width=800, plot_height=400,
-           x_range = [x[0], x[-1]], x_axis_label='ツイート日時', y_axis_label='favorited', x_axis_type='datetime', background_fill_color='DarkGreen')
-
-# X軸の設定
-x_format = "%Y/%m/%d"
-p.xaxis.formatter = DatetimeTickFormatter(days=[x_format], months=[x_format], years=[x_format])
-
-# 折れ線図
-p.line('x', 'y', legend_label='「いいね」数', source=source, color='Magenta')
-
-# 散布図
-p.asterisk('x', 'y', size=10, fill_alpha=0.5, source=source, color='Magenta')
-
-# 凡例の位置
-p.legend.location = 'top_left'
-
-# rangetoolの作成
-# rangetoolは、グラフの描画範囲をスライダーで変更することができます。
-# rangetool用のグラフの設定を追加
-select = figure(title="上段のグラフの表示範囲をスライダーで指定",
-                plot_height=100, plot_width=800, y_range=p.y_range,
-                x_axis_type="datetime", y_axis_type=None,
-                tools="", toolbar_location=None, background_fill_color="#efefef")
-
-# Rangetoolの設定
-range_rool = RangeTool(x_range=p.x_range) # Rangetoolのx_rangeの範囲を設定（p.x_range)
-range_rool.overlay.fill_color = "navy"    # overlay.fill_colorはスライダーの色を指定
-range_rool.overlay.fill_alpha = 0.2       # 透明度の指定
-
-select.line(x=x, y=y) # p.lineと同様にx軸とy軸の設定
-select.ygrid.grid_line_color = None
-select.add_tools(range_rool) # range_roolを追加
-select.toolbar.active_multi = range_rool
-
-# 描画
-if genre == 'ツイートごと いいね数 最新':
-    output_file('favorited_new.html')
-    fig2 = column(p,select)
-    save(fig2)
-    st.bokeh_chart(fig2, use_container_width=False)
-    with open("favorited_new.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="favorited_new.html", mime="text/html")
-    st.markdown('''
-    ***
-    ''')
-
-
-# 時刻でグループ分け
-df_created_at['hour'] = df_created_at.index.hour
-df_hour = df_created_at.groupby('hour').mean()
-
-# 時刻ごとグラフ作成用の辞書
-x = df_hour.index
-y = df_hour['favorited'].astype(int)
-y2 = df_hour['retweeted'].astype(int)
-
-source = ColumnDataSource(data = dict(x = x, y = y, y2=y2))
-
-# tooltips設定
-TOOLTIPS1 = [('時刻', '@x'), ('いいね数', '@y')]
-TOOLTIPS2 = [('時刻', '@x'), ('リツイート数', '@y2')]
-
-# グラフ全体の設定
-p1 = figure(tools = "hover, save", tooltips=TOOLTIPS1, title='いいね数 (時刻ごと平均)  2017年4月～最新更新',
-            plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='いいね数',
-            background_fill_color='DarkGreen')
-
-p2 = figure(tools = "hover, save", tooltips=TOOLTIPS2, title='リツイート数 (時刻ごと平均)  2017年4月～最新更新',
-            plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='リツイート数',
-            background_fill_color='DarkGreen')
-
-# 棒グラフ
-p1.vbar(x='x', width=0.5, top='y', legend_label='いいね数(平均)', source=source, color='Lime')
-p2.vbar(x='x', width=0.5, top='y2', legend_label='リツイート数(平均)', source=source, color='Magenta')
-
-# 凡例の位置
-p1.legend.location = 'top_left'
-p2.legend.location = 'top_left'
-
-# 描画
-if genre == '時刻ごと いいね数 最新':
-    output_file('hours_new.html')
-    fig3 = column(p1, p2)
-    save(fig3)
-    st.bokeh_chart(fig3, use_container_width=False)
-    with open("hours_new.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="hours_new.html", mime="text/html")
-    st.write('いいね数の平均', df_created_at['favorited'].mean()) 
-    st.write('いいね数の中央値', df_created_at['favorited'].median())
-    st.write('リツイート数の平均', df_created_at['retweeted'].mean()) 
-    st.write('リツイート数の中央値', df_created_at['retweeted'].median())
-    st.markdown('''
-    ***
-    ''')
-
-
-st.write('フォロワーに関するデータ (2017/4～最新更新)')
-
-st.dataframe(df_followers.sort_index(ascending=False), width=1200, height=400)
-
-csv2 = convert_df(df_followers.sort_index(ascending=False))
-st.download_button("Download CSV", csv2, "followers_data_new.csv", "text/csv")
+csv_download('followers', lambda: followers_index.table.iloc[followers_index.rows(INDEX_COLUMN, False)],
+             "followers_data_new.csv")
 
 st.markdown('''
 ***
 ''')
 
 
-df_followers_mean = df_followers.groupby('user_id').mean()
-
-# 「フォロワー数」と「フォロー数」グラフ作成用の辞書
-x = df_followers_mean['folowers_count']
-y = df_followers_mean['friends_count']
-
-source = ColumnDataSource(data = dict(x = x, y = y))
-
-# tooltips設定
-TOOLTIPS4 = [('フォロワー数', '@x'), ('フォロー数', '@y')]
-
-# グラフ全体の設定
-fig4 = figure(tools = "hover, save", tooltips=TOOLTIPS4, title='フォロワーごとの「フォロワー数」「フォロー数」(2017/4～最新更新)',
-            plot_width=800, plot_height=400, x_axis_label='フォロワー数', y_axis_label='フォロー数',
-            background_fill_color='Darkgreen')
-
-# 散布図
-fig4.circle('x', 'y', size=15, fill_alpha=0.7, source=source, color='Aqua', legend_label='「フォロワー数」と「フォロー数」')
-
-# 凡例の位置
-fig4.legend.location = 'top_left'
-
-# 描画
-if genre == 'フォロワーごと フォロワー数 最新':
-    output_file('followers_data_new.html')
-    save(fig4)
-    st.bokeh_chart(fig4, use_container_width=True)
-    with open("followers_data_new.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="followers_data_new.html", mime="text/html")
-    st.markdown('''
-    ***
-    ''')
-
-
-
-st.write('フォロワー プロフィール欄の頻出ワードランキング (2017/4～) :google colabで分析')
-df_wordrank_new = df_wordrank.set_axis(['word', 'count'], axis=1)
+st.write('フォロワー プロフィール欄の頻出ワードランキング (現在のフォロワー、収集時に更新)')
+with tracer.span('aggregate', table='wordrank'):
+    df_wordrank_new = wordrank_table(frames)
 
 st.dataframe(df_wordrank_new, width=1000, height=600)
 
-csv3 = convert_df(df_wordrank_new)
-st.download_button("Download CSV", csv3, "followers_wordrank", "text/csv")
+csv_download('wordrank', df_wordrank_new, "followers_wordrank")
 
 st.markdown('''
 ***
 ''')
 
-# 横棒グラフで上から順になるようにソート
-df_wordrank_sort = df_wordrank_new.sort_index(ascending=False)
-
-# フォロワーのプロフィール欄ランキンググラフ作成用の辞書
-y = df_wordrank_sort['word']
-x = df_wordrank_sort['count']
-source = ColumnDataSource(data = dict(x = x, y = y))
-
-# tooltips設定
-TOOLTIPS = [('キーワード', '@y'), ('回数', '@x')]
-
-output_file('follower_wordrank.html')
-
-# グラフ全体の設定
-fig_word = figure(tools = "hover, save", tooltips=TOOLTIPS, title='フォロワー プロフィール欄の頻出ワード (2017/4～)',
-            plot_width=800, plot_height=1600, x_axis_label='回数', y_axis_label='word', y_range=y,
-            background_fill_color='Navy')
-
-fig_word.hbar(y='y', height=0.8, left=0, right='x', source=source, color='Lime')
-
-
-# 描画
-if genre == 'フォロワー 頻出ワードランク':
-    save(fig_word)
-    st.bokeh_chart(fig_word, use_container_width=False)
-    with open("follower_wordrank.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="follower_wordrank.html", mime="text/html")
-    st.markdown('''
-    ***
-    ''')
-
 
 # Twitterアナリティクスの月ごとデータ(2017/04-2021/09)
 st.title('Twitterアナリティクスのデータ：月間更新')
@@ -392,266 +473,45 @@ st.write('Twitterアナリティクスの月ごとデータ(2017/04-2021/09)')
 
 st.dataframe(df_month, width=1200, height=400)
 
-csv3 = convert_df(df_month)
-st.download_button("Download CSV", csv3, "monthly_data.csv", "text/csv")
+csv_download('month', df_month, "monthly_data.csv")
 
 st.markdown('''
 ***
 ''')
 
 
-# 過去のグラフ作成用の辞書
-x = df_month.index
-y = df_month['フォロワー数']
-y2 = df_month['インプレッション数']
-y3 = df_month['ツイート数']
-y4 = df_month['プロフィールアクセス']
-
-date = x.astype(str)
-date2 = x.strftime('%Y-%m')
-source = ColumnDataSource(data = dict(x = x, y = y, y2=y2, y3=y3, y4=y4, date=date, date2=date2))
-
-# tooltips設定
-TOOLTIPS_1 = [('date', '@date'), ('followers', '@y')]
-TOOLTIPS_2 = [('date', '@date2'), ('Impression', '@y2')]
-TOOLTIPS_3 = [('date', '@date2'), ('Tweets', '@y3')]
-TOOLTIPS_4 = [('date', '@date2'), ('Profile Access', '@y4')]
-
-# グラフ全体の設定
-p1 = figure(tools = "hover, save", tooltips=TOOLTIPS_1, title='月ごとフォロワー数(2017/4-2021/9)', plot_width=800, plot_height=400, 
-           x_axis_label='date', y_axis_label='followers', x_axis_type='datetime',
-           background_fill_color='Navy')
-
-p2 = figure(tools = "hover, save", tooltips=TOOLTIPS_2, title='月間インプレッション数(2017/4-2021/9 Monthly)', plot_width=800, plot_height=400, 
-           x_axis_label='date', y_axis_label='Impression', x_axis_type='datetime',
-           background_fill_color='Navy')
-
-p3 = figure(tools = "hover, save", tooltips=TOOLTIPS_3, title='月間ツイート数(2017/4-2021/9 Monthly)', plot_width=800, plot_height=400, 
-           x_axis_label='date', y_axis_label='Tweets', x_axis_type='datetime',
-           background_fill_color='Navy')
-
-p4 = figure(tools = "hover, save", tooltips=TOOLTIPS_4, title='月間プロフィールアクセス数(2017/4-2021/9 Monthly)', plot_width=800, plot_height=400, 
-           x_axis_label='date', y_axis_label='Profile Access', x_axis_type='datetime',
-           background_fill_color='Navy')
-
-
-# X軸の設定
-x_format = "%Y/%m"
-p1.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
-p2.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
-p3.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
-p4.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
-
-# y軸の設定
-p2.y_range=Range1d(start=0,end=1000000)
-
-# 折れ線図
-p1.line('x', 'y', legend_label='フォロワー数', source=source, color='Aqua')
-
-# 棒グラフ
-p2.vbar(x=x, width=0.5, bottom=0, top=y2, color='Lime', legend_label='インプレッション数')
-p3.vbar(x=x, width=0.5, bottom=0, top=y3, color='Yellow', legend_label='ツイート数')
-p4.vbar(x=x, width=0.5, bottom=0, top=y4, color='Magenta', legend_label='プロフィールアクセス数')
-
-# 散布図
-p1.circle('x', 'y', size=10, fill_alpha=0.5, source=source, color='Aqua')
-p2.cross('x', 'y2', size=10, fill_alpha=0.5, source=source, color='Lime')
-p3.asterisk('x', 'y3', size=10, fill_alpha=0.5, source=source, color='Yellow')
-p4.square('x', 'y4', size=10, fill_alpha=0.5, source=source, color='Magenta')
-
-
-# 凡例の位置
-p1.legend.location = 'top_left'
-p2.legend.location = 'top_left'
-p3.legend.location = 'top_left'
-p4.legend.location = 'top_left'
-
-
-if genre == '月間インプレッション フォロワー':
-    output_file('monthly_data.html')
-    fig5 = column(p1, p2, p3, p4)
-    save(fig5)
-    st.bokeh_chart(fig5, use_container_width=False)
-    with open("monthly_data.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="monthly_data.html", mime="text/html")
-    st.markdown('''
-    ***
-    ''')
-
-
 # Twitterアナリティクスのツイートごとデータ(2020/10-2021/09)
 st.write('Twitterアナリティクスのツイートごとデータ(2020/10-2021/09)')
 
-time_index_df = tweets_df.sort_values(by='時間').set_index('時間')
-time_index_df = time_index_df.drop('Unnamed: 0', axis=1)
-st.dataframe(time_index_df, width=1200, height=400)
+analytics_index = paged_table('analytics', lambda: analytics_time_index(frames))
 
-csv4 = convert_df(time_index_df)
-st.download_button("Download CSV", csv4, "tweet_data.csv", "text/csv")
+csv_download('analytics', analytics_index.table, "tweet_data.csv")
 
 st.markdown('''
 ***
 ''')
 
 
-# グラフ作成用の辞書
-x = time_index_df.index
-date = x.strftime('%Y-%m-%d %H:%M:%S')
-y = time_index_df['インプレッション']
-y2 = time_index_df['エンゲージメント']
-
-source = ColumnDataSource(data = dict(x = x, y = y, y2=y2, date=date))
-
-# tooltips設定
-hover_tool_5 = HoverTool(tooltips = [('date', '@date'), ('Impressiion', '@y')], mode='mouse')
-hover_tool_6 = HoverTool(tooltips = [('date', '@date'), ('Engagement', '@y2')], mode='mouse')
-
-# グラフ全体の設定
-p1 = figure(tools=[hover_tool_6, hover_tool_5], title='インプレッション数とエンゲージメント数 (ツイートごと)  2020年10月～2021年9月',
-            plot_width=800, plot_height=400, x_axis_label='date', y_axis_label='Impression', x_axis_type='datetime',
-           x_range = [x[0], x[-1]], y_range= [0, 100000], background_fill_color='Navy')
-
-# X軸の設定
-x_format = "%Y/%m"
-p1.xaxis.formatter = DatetimeTickFormatter(months=[x_format], years=[x_format])
-
-# 折れ線図
-p1.vbar(x='x', top='y', legend_label='インプレッション数', source=source, color='Lime')
-p1.vbar(x='x', top='y2', legend_label='エンゲージメント数', source=source, color='Magenta')
-
-# 散布図
-p1.asterisk('x', 'y', size=10, fill_alpha=0.5, source=source, color='Lime')
-p1.asterisk('x', 'y2', size=10, fill_alpha=0.5, source=source, color='Magenta')
-
-
-# 凡例の位置
-p1.legend.location = 'top_left'
-
-# rangetoolの作成
-# rangetoolは、グラフの描画範囲をスライダーで変更することができます。
-# rangetool用のグラフの設定を追加
-select1 = figure(title="上段のグラフの表示範囲をスライダーで指定",
-                plot_height=100, plot_width=800, y_range= [0, 500000],
-                x_axis_type="datetime", y_axis_type=None,
-                tools="", toolbar_location=None, background_fill_color="#efefef")
-
-# Rangetoolの設定
-range_tool = RangeTool(x_range=p1.x_range) # Rangetoolのx_rangeの範囲を設定
-range_tool.overlay.fill_color = "Navy"    # overlay.fill_colorはスライダーの色を指定
-range_tool.overlay.fill_alpha = 0.2       # 透明度の指定
-
-select1.line(x=x, y=y) # p.lineと同様にx軸とy軸の設定
-select1.ygrid.grid_line_color = None
-select1.add_tools(range_tool) # range_roolを追加
-select1.toolbar.active_multi = range_tool
-
-
-# 描画
-if genre == 'ツイートごとインプレッション数':
-    output_file('impression.html')
-    fig6 = column(p1, select1)
-    save(fig6)
-    st.bokeh_chart(fig6, use_container_width=False)
-    with open("impression.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="impression.html", mime="text/html")
-    st.markdown('''
-    ***
-    ''')
-
-         
 # Twitterアナリティクスのツイートデータ(ツイート時刻ごと)(2020/10-2021/09)
 st.write('Twitterアナリティクスのツイートデータ(ツイート時刻ごと)(2020/10-2021/09)')
-time_df = tweets_df[["時刻", "ツイート本文", "インプレッション", "エンゲージメント", "ユーザープロフィールクリック"]]
-
-st.dataframe(time_df, width=1200, height=400)
+hourly_index = paged_table('hourly', lambda: analytics_time_df(frames))
 
-csv5 = convert_df(time_df)
-st.download_button("Download CSV", csv5, "hourly_data.csv", "text/csv")
+csv_download('hourly', hourly_index.table, "hourly_data.csv")
 
 st.markdown('''
 ***
 ''')
 
 
-# 1パーセンタイル、99パーセンタイルを指定
-q_min = time_df['インプレッション'].quantile(0.01) 
-q_max = time_df['インプレッション'].quantile(0.99)
-
-# 1パーセンタイル以下、99パーセンタイル以上の外れ値を除去
-new_time_df = time_df.query('@q_min < インプレッション < @q_max')
-
-# 時刻ごとのツイート数
-df_count = new_time_df.groupby(["時刻"]).count()
-
-# 時刻ごとの平均インプレッション数
-df_mean = new_time_df.groupby(["時刻"]).mean()
+# 外れ値を除いた時刻ごとの平均インプレッション数
+with tracer.span('aggregate', table='hourly_mean'):
+    df_mean, df_count = analytics_hourly(frames)
 
 st.write('Twitterアナリティクスのツイートデータ(時刻ごと平均)(2020/10-2021/09)')
 st.dataframe(df_mean, width=1200, height=400)
 
-csv6 = convert_df(df_mean)
-st.download_button("Download CSV", csv6, "hourly_mean.csv", "text/csv")
+csv_download('hourly_mean', df_mean, "hourly_mean.csv")
 
 st.markdown('''
 ***
 ''')
-
-
-# グラフ作成用の辞書
-x = df_mean.index
-y = df_mean['インプレッション'].astype(int)
-y2 = df_mean['エンゲージメント'].astype(int)
-y3 = df_mean['ユーザープロフィールクリック'].astype(int)
-x4 = df_count.index
-y4 = df_count['インプレッション']
-
-source = ColumnDataSource(data = dict(x = x, x4=x4, y = y, y2=y2, y3=y3, y4=y4))
-
-# tooltips設定
-TOOLTIPS_11 = [('hour', '@x'), ('Impressiion', '@y')]
-TOOLTIPS_12 = [('hour', '@x'), ('Engagement', '@y2')]
-TOOLTIPS_13 = [('hour', '@x'), ('Profile Access', '@y3')]
-TOOLTIPS_14 = [('hour', '@x4'), ('Tweet', '@y4')]
-
-# グラフ全体の設定
-p1 = figure(tools = "hover, save", tooltips=TOOLTIPS_11, title='インプレッション数 (時刻ごと平均)  2020年10月～2021年9月 ※外れ値を処理',
-            plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Impression',
-            background_fill_color='Navy')
-
-p2 = figure(tools = "hover, save", tooltips=TOOLTIPS_12, title='エンゲージメント数 (時刻ごと平均)  2020年10月～2021年9月 ※外れ値を処理',
-            plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Engagement',
-            background_fill_color='Navy')
-
-p3 = figure(tools = "hover, save", tooltips=TOOLTIPS_13, title='プロフィールアクセス数 (時刻ごと平均)  2020年10月～2021年9月 ※外れ値を処理',
-            plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Profile Access',
-            background_fill_color='Navy')
-
-p4 = figure(tools = "hover, save", tooltips=TOOLTIPS_14, title='ツイート数 (時刻ごと件数)  2020年10月～2021年9月 ※外れ値を処理',
-            plot_width=800, plot_height=400, x_axis_label='hour', y_axis_label='Tweet',
-            background_fill_color='Navy')
-
-
-# 棒グラフ
-p1.vbar(x='x', width=0.5, top='y', legend_label='インプレッション数(平均)', source=source, color='Lime')
-p2.vbar(x='x', width=0.5, top='y2', legend_label='エンゲージメント数(平均)', source=source, color='Magenta')
-p3.vbar(x='x', width=0.5, top='y3', legend_label='プロフィールアクセス数(平均)', source=source, color='OrangeRed')
-p4.vbar(x='x4', width=0.5, top='y4', legend_label='ツイート数', source=source, color='AquaMarine')
-
-# 凡例の位置
-p1.legend.location = 'top_left'
-p2.legend.location = 'top_left'
-p3.legend.location = 'top_left'
-p4.legend.location = 'top_left'
-
-# 描画
-if genre == '時刻ごとインプレッション数':
-    output_file('hourly_data.html')
-    fig7 = column(p1, p2, p3, p4)
-    save(fig7)
-    st.bokeh_chart(fig7, use_container_width=False)
-    with open("hourly_data.html", "rb") as fp:
-        btn = st.download_button(label="Download Fig", data=fp, file_name="hourly_data.html", mime="text/html")
-    st.markdown('''
-    ***
-    ''')
-